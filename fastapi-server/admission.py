@@ -0,0 +1,276 @@
+import os
+import time
+import asyncio
+import contextvars
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+import resources
+from telemetry import Counter, Gauge, get_logger
+
+logger = get_logger("admission")
+
+# Interactive requests (uploads) are always served before bulk ones (backfills)
+lanes = ("interactive", "bulk")
+
+# Analyses run at once per process; more would only split the same CPUs further
+max_concurrent = resources.concurrency
+# Bulk work never takes the last slot, so an upload does not wait behind a backfill;
+# with a single slot (one core) the interactive lane gets one more of its own instead
+bulk_max_concurrent = int(os.environ.get("MOZARTIFY_BULK_MAX_CONCURRENT", str(max(1, max_concurrent - 1))))
+# Requests waiting per lane before new ones are turned away with 429
+queue_limit = int(os.environ.get("MOZARTIFY_QUEUE_LIMIT", "32"))
+# Deadlines for requests that do not send X-Mozartify-Deadline (seconds)
+default_deadlines = {
+    "interactive": float(os.environ.get("MOZARTIFY_DEADLINE_SECONDS", "120")),
+    "bulk": float(os.environ.get("MOZARTIFY_BULK_DEADLINE_SECONDS", "600")),
+}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: float = 1.0):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class RequestCancelled(BaseException):
+    """Raised at a checkpoint once the client has gone or the deadline has passed.
+
+    A BaseException, like asyncio.CancelledError, so the services' catch-all
+    `except Exception` handlers do not turn it into a 500.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Ticket:
+    """Lane, deadline and cancellation state of one admitted request."""
+
+    def __init__(self, lane: str, deadline: float = None):
+        self.lane = lane
+        self.deadline = deadline
+        self.reason = None
+
+    def cancel(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() > self.deadline:
+            self.reason = "deadline"
+        return self.reason is not None
+
+
+_ticket = contextvars.ContextVar("mozartify_ticket", default=None)
+
+
+def checkpoint():
+    """Stop the current request's work between stages if nobody is waiting for it any more.
+
+    Works in worker threads too, since run_blocking copies the request's context.
+    """
+    ticket = _ticket.get()
+    if ticket is not None and ticket.cancelled:
+        raise RequestCancelled(ticket.reason)
+
+
+class AdmissionController:
+    """A bounded number of concurrent analyses, handed out by lane.
+
+    Waiting requests are granted slots interactive lane first, and the
+    interactive lane can always run one request whatever the bulk lane
+    holds. A request is rejected up front with 429 when its lane's queue is
+    full, or with 503 when the queue ahead of it (at the recent average
+    service time) would already take it past its deadline.
+    """
+
+    def __init__(self, concurrency: int = max_concurrent, bulk_concurrency: int = bulk_max_concurrent,
+                 queue_limit: int = queue_limit):
+        self.concurrency = concurrency
+        self.bulk_concurrency = min(bulk_concurrency, concurrency)
+        self.queue_limit = queue_limit
+        self.active = {lane: 0 for lane in lanes}
+        self._waiters = {lane: deque() for lane in lanes}
+        # Moving average of how long an admitted request holds its slot
+        self.service_seconds = None
+
+    def _can_start(self, lane: str) -> bool:
+        free = sum(self.active.values()) < self.concurrency
+        if lane == "interactive":
+            # Even when bulk work holds every slot, one upload can still start
+            return free or self.active["interactive"] == 0
+        return free and self.active["bulk"] < self.bulk_concurrency
+
+    def _dispatch(self):
+        for lane in lanes:
+            waiters = self._waiters[lane]
+            while waiters and self._can_start(lane):
+                future = waiters.popleft()
+                if not future.done():
+                    self.active[lane] += 1
+                    future.set_result(None)
+
+    def queued(self, lane: str) -> int:
+        return len(self._waiters[lane])
+
+    def estimated_wait(self, lane: str):
+        """Seconds until a new request in lane would start, or None before any request has finished."""
+        if self.service_seconds is None:
+            return None
+        ahead = self.queued("interactive") + (self.queued("bulk") if lane == "bulk" else 0)
+        slots = self.bulk_concurrency if lane == "bulk" else self.concurrency
+        return (ahead // slots + 1) * self.service_seconds
+
+    async def acquire(self, lane: str, deadline: float = None, reject: bool = True):
+        if not self._waiters[lane] and self._can_start(lane):
+            self.active[lane] += 1
+            return
+
+        wait = self.estimated_wait(lane)
+        if reject:
+            if self.queued(lane) >= self.queue_limit:
+                rejected.inc(lane=lane, reason="queue_full")
+                raise AdmissionRejected(429, "Too many requests queued, retry later.", wait or 1.0)
+            if deadline is not None and wait is not None and time.monotonic() + wait + self.service_seconds > deadline:
+                rejected.inc(lane=lane, reason="deadline")
+                raise AdmissionRejected(503, "Server too busy to finish before the deadline.", wait)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(future)
+        timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Granted a slot just as the wait ended
+                self.release(lane)
+            else:
+                future.cancel()
+                try:
+                    self._waiters[lane].remove(future)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                rejected.inc(lane=lane, reason="deadline")
+                raise AdmissionRejected(503, "Deadline passed while queued.", self.estimated_wait(lane) or 1.0)
+            raise
+
+    def release(self, lane: str, seconds: float = None):
+        self.active[lane] -= 1
+        if seconds is not None:
+            self.service_seconds = seconds if self.service_seconds is None else 0.8 * self.service_seconds + 0.2 * seconds
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, lane: str, deadline: float = None, reject: bool = True):
+        await self.acquire(lane, deadline, reject)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(lane, time.monotonic() - started)
+
+
+controller = AdmissionController()
+
+rejected = Counter("mozartify_admission_rejected_total", "Requests turned away before starting.", ("lane", "reason"))
+cancelled = Counter("mozartify_requests_cancelled_total", "Admitted requests stopped at a checkpoint.", ("reason",))
+Gauge(
+    "mozartify_admission_queued", "Requests waiting for an analysis slot.", ("lane",),
+    collect=lambda: [({"lane": lane}, controller.queued(lane)) for lane in lanes],
+)
+Gauge(
+    "mozartify_admission_active", "Requests holding an analysis slot.", ("lane",),
+    collect=lambda: [({"lane": lane}, controller.active[lane]) for lane in lanes],
+)
+
+
+def request_ticket(headers: Headers) -> Ticket:
+    # X-Mozartify-Priority: interactive|bulk and X-Mozartify-Deadline: seconds from now
+    lane = headers.get("x-mozartify-priority", "interactive").lower()
+    if lane not in lanes:
+        lane = "interactive"
+    try:
+        seconds = float(headers["x-mozartify-deadline"])
+    except (KeyError, ValueError):
+        seconds = default_deadlines[lane]
+    return Ticket(lane, time.monotonic() + seconds if seconds > 0 else None)
+
+
+class AdmissionMiddleware:
+    """Admission control for the expensive routes in paths.
+
+    Requests on other routes pass straight through. An admitted request's
+    ticket is cancelled when the client disconnects, and work stops at the
+    next checkpoint(); a request past its deadline gets a 504.
+    """
+
+    def __init__(self, app, paths=(), controller: AdmissionController = controller):
+        self.app = app
+        self.paths = set(paths)
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        ticket = request_ticket(Headers(scope=scope))
+        try:
+            await self.controller.acquire(ticket.lane, ticket.deadline)
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                {"detail": e.detail}, status_code=e.status_code,
+                headers={"Retry-After": str(max(1, round(e.retry_after)))},
+            )
+            return await response(scope, receive, send)
+
+        # Read the client's messages ourselves so a disconnect is seen while the endpoint is busy
+        messages = asyncio.Queue()
+        disconnected = False
+
+        async def watch():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    ticket.cancel("disconnected")
+                    return
+
+        async def wrapped_receive():
+            if disconnected:
+                return {"type": "http.disconnect"}
+            return await messages.get()
+
+        response_started = False
+
+        async def wrapped_send(message):
+            nonlocal response_started
+            response_started = response_started or message["type"] == "http.response.start"
+            await send(message)
+
+        watcher = asyncio.create_task(watch())
+        token = _ticket.set(ticket)
+        started = time.monotonic()
+        try:
+            await self.app(scope, wrapped_receive, wrapped_send)
+        except RequestCancelled as e:
+            cancelled.inc(reason=e.reason)
+            logger.info("Stopped %s %s: %s", scope["method"], scope["path"], e.reason)
+            if not response_started:
+                # 499 (client closed request) is never read, but keeps the request metrics honest
+                if e.reason == "deadline":
+                    response = JSONResponse({"detail": "Deadline exceeded."}, status_code=504)
+                else:
+                    response = JSONResponse({"detail": "Client disconnected."}, status_code=499)
+                await response(scope, wrapped_receive, send)
+        finally:
+            disconnected = True
+            watcher.cancel()
+            _ticket.reset(token)
+            self.controller.release(ticket.lane, time.monotonic() - started)
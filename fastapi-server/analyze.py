@@ -0,0 +1,209 @@
+from fastapi import FastAPI, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List, Optional
+import httpx
+import json
+import asyncio
+import importlib
+import resources  # sets the BLAS thread limits, so before numpy
+from audio_loader import fetch_audio, decode_audio, close_http_client
+from workers import run_blocking
+from budget import CombinedBudget
+from prediction_cache import prediction_cache
+from telemetry import TelemetryMiddleware, metrics_response
+from admission import AdmissionMiddleware, RequestCancelled, controller
+from model_registry import startup_models, readiness_response
+from job_store import job_store
+from jobs import JobRunner
+import emotion
+import gender
+import genre
+
+# One download and one decode per track, shared by every tagger
+app = FastAPI()
+app.router.add_event_handler("startup", startup_models)
+app.router.add_event_handler("shutdown", close_http_client)
+
+# Only /analyze is admitted; job items take bulk slots from the same controller
+app.add_middleware(AdmissionMiddleware, paths=("/analyze",))
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(TelemetryMiddleware)
+
+class AnalyzeRequest(BaseModel):
+    fileUrl: str
+    emotion: bool = True
+    gender: bool = True
+    genre: bool = True
+    # Source separation is slow, so instrument tagging is opt-in
+    instrument: bool = False
+    # Overrides every selected tagger's analysis budget; 0 analyses the whole track
+    max_seconds: Optional[float] = None
+
+class AnalyzeResponse(BaseModel):
+    predicted_mood: Optional[str] = None
+    gender: Optional[str] = None
+    genre: Optional[str] = None
+    top_genres: Optional[list] = None
+    top_instruments: Optional[str] = None
+
+# Each tagger samples the shared decode within its own budget; genre and
+# instrument also index the track's embedding under file_url for /similar
+def run_emotion(audio, max_seconds=None, file_url=None):
+    return {"predicted_mood": emotion.prediction2d(audio, emotion.budget.with_max_seconds(max_seconds))}
+
+def run_gender(audio, max_seconds=None, file_url=None):
+    request_budget = gender.budget.with_max_seconds(max_seconds)
+    return {"gender": gender.predict_from_audio(audio, request_budget=request_budget)}
+
+def run_genre(audio, max_seconds=None, file_url=None):
+    top_genre, top_genres = genre.predict_from_audio(audio, genre.budget.with_max_seconds(max_seconds), file_url)
+    return {"genre": top_genre, "top_genres": top_genres}
+
+def run_instrument(audio, max_seconds=None, file_url=None):
+    # Imported on first use so torch and Open-Unmix are only loaded when asked for
+    instrument = importlib.import_module("instrument")
+    request_budget = instrument.budget.with_max_seconds(max_seconds)
+    return {"top_instruments": instrument.predict_from_audio(audio, request_budget, file_url)}
+
+taggers = {
+    "emotion": run_emotion,
+    "gender": run_gender,
+    "genre": run_genre,
+    "instrument": run_instrument,
+}
+
+def decode_for_taggers(content, selected: list, max_seconds=None):
+    # Only the regions the selected taggers' budgets sample are decoded
+    budget = CombinedBudget(
+        importlib.import_module(name).budget.with_max_seconds(max_seconds) for name in selected
+    )
+    return decode_audio(content, budget)
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
+
+@app.get("/ready")
+async def ready():
+    return readiness_response()
+
+async def analyze_track(file_url: str, selected: list, max_seconds: Optional[float] = None) -> dict:
+    try:
+        content = await fetch_audio(file_url)
+        audio = await run_blocking(decode_for_taggers, content, selected, max_seconds)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error decoding file: {str(e)}")
+
+    # Fan out to the selected taggers; total latency is that of the slowest one
+    results = await asyncio.gather(
+        *(run_blocking(taggers[name], audio, max_seconds, file_url) for name in selected),
+        return_exceptions=True,
+    )
+
+    tags = {}
+    for name, result in zip(selected, results):
+        if isinstance(result, (HTTPException, RequestCancelled)):
+            raise result
+        if isinstance(result, Exception):
+            raise HTTPException(status_code=500, detail=f"Error predicting {name}: {str(result)}")
+        if isinstance(result, BaseException):
+            # e.g. CancelledError: not a tagger failure, so passed on as is
+            raise result
+        tags.update(result)
+    return tags
+
+def selected_taggers(request) -> list:
+    selected = [name for name in taggers if getattr(request, name)]
+    if not selected:
+        raise HTTPException(status_code=400, detail="No taggers selected.")
+    return selected
+
+@app.post("/analyze", response_model=AnalyzeResponse)
+async def analyze(request: AnalyzeRequest) -> AnalyzeResponse:
+    if not request.fileUrl:
+        raise HTTPException(status_code=400, detail="No file URL provided.")
+
+    selected = selected_taggers(request)
+    tags = await analyze_track(request.fileUrl, selected, request.max_seconds)
+    return AnalyzeResponse(**tags)
+
+# Bulk tagging: jobs are queued in SQLite and drained by background workers,
+# so a backfill survives restarts without re-analysing finished tracks
+
+async def process_job_item(file_url: str, options: dict) -> dict:
+    # Job items wait for bulk slots instead of being rejected, and /analyze requests go first
+    async with controller.slot("bulk", reject=False):
+        return await analyze_track(file_url, options["taggers"], options.get("max_seconds"))
+
+job_runner = JobRunner(job_store, process_job_item)
+app.router.add_event_handler("startup", job_runner.start)
+app.router.add_event_handler("shutdown", job_runner.stop)
+
+class JobRequest(BaseModel):
+    fileUrls: List[str]
+    emotion: bool = True
+    gender: bool = True
+    genre: bool = True
+    instrument: bool = False
+    max_seconds: Optional[float] = None
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: JobRequest):
+    if not request.fileUrls or not all(request.fileUrls):
+        raise HTTPException(status_code=400, detail="No file URLs provided.")
+
+    options = {"taggers": selected_taggers(request), "max_seconds": request.max_seconds}
+    # The job store is synchronous SQLite, so it is only called off the event loop. Not through
+    # run_blocking: these quick calls must not queue behind analyses in the worker pool
+    job_id = await run_in_threadpool(job_store.create_job, request.fileUrls, options)
+    job_runner.notify()
+    return await run_in_threadpool(job_store.get_job, job_id)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, after: int = 0, limit: int = 1000):
+    # Poll with after= set to the last completed_order seen to page through results
+    job = await run_in_threadpool(job_store.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    job["items"] = await run_in_threadpool(job_store.finished_items, job_id, after, limit)
+    return job
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, after: int = 0):
+    if await run_in_threadpool(job_store.get_job, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    async def lines():
+        # One NDJSON line per finished item, then a final line with the job summary
+        last = after
+        while True:
+            job = await run_in_threadpool(job_store.get_job, job_id)
+            for item in await run_in_threadpool(job_store.finished_items, job_id, last):
+                last = item["completed_order"]
+                yield json.dumps(item) + "\n"
+            if job["status"] == "completed" and last >= job["done"] + job["failed"]:
+                yield json.dumps(job) + "\n"
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# For running the server
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8002)
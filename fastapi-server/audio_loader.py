@@ -0,0 +1,377 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import librosa
+import httpx
+import decoders
+from telemetry import stage
+from admission import checkpoint
+from feature_store import feature_store
+
+_http_client = None
+_http_client_loop = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """The pooled client downloads share, so they reuse connections to Firebase Storage.
+
+    Created on first use, and again after close_http_client() or in another
+    event loop, whose connections this loop could not use.
+    """
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=int(os.environ.get("MOZARTIFY_HTTP_MAX_CONNECTIONS", "20")),
+                max_keepalive_connections=10,
+            ),
+            follow_redirects=True,
+        )
+        _http_client_loop = loop
+    return _http_client
+
+# Downloads larger than this are spooled to a temporary file instead of held in memory
+spool_threshold_bytes = int(float(os.environ.get("MOZARTIFY_SPOOL_THRESHOLD_MB", "64")) * 1024 ** 2)
+# Recordings longer than this are decoded block by block when analysed in full
+streaming_threshold_seconds = float(os.environ.get("MOZARTIFY_STREAMING_THRESHOLD_SECONDS", "900"))
+stream_block_seconds = float(os.environ.get("MOZARTIFY_STREAM_BLOCK_SECONDS", "30"))
+
+
+class SpooledAudio:
+    """A downloaded file kept on disk; decoders read it through open().
+
+    The file is removed once nothing references the download any more.
+    """
+
+    def __init__(self, path: str, size: int, digest: str):
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __del__(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def source_digest(content) -> str:
+    # Hash of the downloaded file itself, before decoding
+    if isinstance(content, SpooledAudio):
+        return content.digest
+    return hashlib.blake2b(content, digest_size=20).hexdigest()
+
+
+class DecodedAudio:
+    """A track decoded once at its native rate, shared by every tagger.
+
+    When only parts of a track were analysed, waveform holds those excerpts
+    back to back and segment_bounds their (start, end) sample ranges in it.
+
+    A deferred instance knows its shape and content hash but only decodes
+    when its samples are first read, so taggers whose features are already
+    in the feature store never pay for the decode.
+
+    A streamed instance is a very long recording that is never decoded as a
+    whole by the taggers that support it: they read blocks() instead, and
+    excerpts and head() seek-decode just the samples they cover.
+    """
+
+    def __init__(self, waveform: np.ndarray, sample_rate: int, segment_bounds=None):
+        # Always keep a (channels, samples) layout, even for mono files
+        if waveform.ndim == 1:
+            waveform = waveform[np.newaxis, :]
+        self._waveform = waveform
+        self._shape = waveform.shape
+        self._load = None
+        self._load_lock = None
+        self.sample_rate = sample_rate
+        self.segment_bounds = segment_bounds
+        self._mono = None
+        self._resampled = {}
+        self._content_hash = None
+        self._source = None
+        # Digest of the file it was decoded from, the same whatever the budget; set by decode_audio
+        self.source_id = None
+
+    @classmethod
+    def deferred(cls, load, sample_rate: int, shape, content_hash: str, segment_bounds=None) -> "DecodedAudio":
+        # load() returns the (channels, samples) waveform when it is first needed
+        audio = cls.__new__(cls)
+        audio._waveform = None
+        audio._shape = tuple(shape)
+        audio._load = load
+        audio._load_lock = threading.Lock()
+        audio.sample_rate = sample_rate
+        audio.segment_bounds = [tuple(bounds) for bounds in segment_bounds] if segment_bounds else None
+        audio._mono = None
+        audio._resampled = {}
+        audio._content_hash = content_hash
+        audio._source = None
+        audio.source_id = None
+        return audio
+
+    @classmethod
+    def streamed(cls, source, sample_rate: int, shape, content_hash: str) -> "DecodedAudio":
+        # Reading .waveform still decodes everything; blocks() keeps memory bounded
+        audio = cls.deferred(lambda: decoders.decode(source)[0], sample_rate, shape, content_hash)
+        audio._source = source
+        return audio
+
+    @property
+    def is_streamed(self) -> bool:
+        return self._source is not None
+
+    def blocks(self, block_seconds: float = None):
+        """Yield the mono signal in consecutive float32 blocks of about block_seconds."""
+        block_frames = int((block_seconds or stream_block_seconds) * self.sample_rate)
+        if self._source is None:
+            for start in range(0, len(self.mono), block_frames):
+                yield self.mono[start:start + block_frames]
+            return
+        for block in decoders.blocks(self._source, block_frames):
+            yield librosa.to_mono(block)
+
+    def _decode_range(self, start: int, end: int) -> np.ndarray:
+        # Half-frame offsets so the decoders' int(seconds * rate) lands on exactly start and end - start
+        waveform, _ = decoders.decode(
+            self._source, (start + 0.5) / self.sample_rate, (end - start + 0.5) / self.sample_rate
+        )
+        waveform = waveform[np.newaxis, :] if waveform.ndim == 1 else waveform
+        return waveform[:, :end - start]
+
+    def head(self, seconds: float) -> "DecodedAudio":
+        # The first seconds of the track; only those are decoded for a streamed one
+        end = min(int(seconds * self.sample_rate), self._shape[1])
+        if self._source is None or self._waveform is not None:
+            return DecodedAudio(self.waveform[:, :end], self.sample_rate)
+        return DecodedAudio(self._decode_range(0, end), self.sample_rate)
+
+    @property
+    def waveform(self) -> np.ndarray:
+        if self._waveform is None:
+            with self._load_lock:
+                if self._waveform is None:
+                    waveform = self._load()
+                    self._waveform = waveform[np.newaxis, :] if waveform.ndim == 1 else waveform
+        return self._waveform
+
+    @classmethod
+    def concatenate(cls, parts: list) -> "DecodedAudio":
+        bounds = []
+        offset = 0
+        for part in parts:
+            bounds.append((offset, offset + part.waveform.shape[1]))
+            offset += part.waveform.shape[1]
+        # Parts may differ in channel count when decoded separately; keep the smallest
+        channels = min(part.channels for part in parts)
+        waveform = np.concatenate([part.waveform[:channels] for part in parts], axis=1)
+        return cls(waveform, parts[0].sample_rate, bounds)
+
+    @property
+    def is_excerpt(self) -> bool:
+        return self.segment_bounds is not None
+
+    def segments(self) -> list:
+        # Each excerpt as its own DecodedAudio view; a full track is a single segment
+        if self.segment_bounds is None:
+            return [self]
+        return [DecodedAudio(self.waveform[:, start:end], self.sample_rate) for start, end in self.segment_bounds]
+
+    def excerpt(self, regions: list) -> "DecodedAudio":
+        # regions are (offset, duration) pairs in seconds
+        ranges = []
+        for offset, duration in regions:
+            start = min(int(offset * self.sample_rate), self._shape[1])
+            end = min(start + int(duration * self.sample_rate), self._shape[1])
+            ranges.append((start, end))
+
+        def load():
+            if self._source is not None and self._waveform is None:
+                return np.concatenate([self._decode_range(start, end) for start, end in ranges], axis=1)
+            return np.concatenate([self.waveform[:, start:end] for start, end in ranges], axis=1)
+
+        bounds = []
+        offset = 0
+        for start, end in ranges:
+            bounds.append((offset, offset + end - start))
+            offset += end - start
+        # Named by the parent and the ranges, so the excerpt's hash is known without decoding
+        digest = hashlib.blake2b(f"{self.content_hash}:{ranges}".encode(), digest_size=20).hexdigest()
+        if self._waveform is not None:
+            audio = DecodedAudio(load(), self.sample_rate, bounds)
+            audio._content_hash = digest
+            return audio
+        return DecodedAudio.deferred(load, self.sample_rate, (self._shape[0], offset), digest, bounds)
+
+    @property
+    def channels(self) -> int:
+        return self._shape[0]
+
+    @property
+    def duration(self) -> float:
+        return self._shape[1] / self.sample_rate
+
+    @property
+    def mono(self) -> np.ndarray:
+        # Same down-mix as librosa.load(..., mono=True)
+        if self._mono is None:
+            self._mono = librosa.to_mono(self.waveform)
+        return self._mono
+
+    @property
+    def content_hash(self) -> str:
+        # Hash of the decoded samples, so re-uploads under a new URL or token still match
+        if self._content_hash is None:
+            digest = hashlib.blake2b(digest_size=20)
+            digest.update(f"{self.sample_rate}:{self.waveform.shape}:{self.segment_bounds}".encode())
+            digest.update(np.ascontiguousarray(self.waveform).data)
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    def interleaved(self) -> np.ndarray:
+        # Channel-interleaved samples, the layout pydub's get_array_of_samples() returns
+        return self.waveform.T.reshape(-1)
+
+    def at_rate(self, sample_rate: int, layout: str = "mono") -> np.ndarray:
+        """Mono or channel-interleaved float32 samples at sample_rate.
+
+        Each (rate, layout) is resampled once per decode and shared by every
+        tagger that asks for it.
+        """
+        key = (sample_rate, layout)
+        if key not in self._resampled:
+            samples = self.mono if layout == "mono" else self.interleaved()
+            samples = samples.astype(np.float32, copy=False)
+            if sample_rate != self.sample_rate:
+                samples = librosa.resample(y=samples, orig_sr=self.sample_rate, target_sr=sample_rate)
+            self._resampled[key] = samples
+        return self._resampled[key]
+
+
+async def fetch_audio(file_url: str):
+    """The response body as bytes, or as SpooledAudio once it outgrows spool_threshold_bytes."""
+    # Stream the body so the event loop keeps serving other requests meanwhile
+    content = bytearray()
+    spool = None
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with stage("download"):
+            async with get_http_client().stream("GET", file_url) as response:
+                response.raise_for_status()
+                async for block in response.aiter_bytes():
+                    checkpoint()
+                    if spool is not None:
+                        spool.write(block)
+                        digest.update(block)
+                        continue
+                    content.extend(block)
+                    if len(content) > spool_threshold_bytes:
+                        spool = tempfile.NamedTemporaryFile(prefix="mozartify-", suffix=".audio", delete=False)
+                        spool.write(content)
+                        digest.update(content)
+                        content = None
+    except BaseException:
+        if spool is not None:
+            spool.close()
+            os.remove(spool.name)
+        raise
+    if spool is None:
+        return bytes(content)
+    spool.close()
+    return SpooledAudio(spool.name, os.path.getsize(spool.name), digest.hexdigest())
+
+
+async def close_http_client():
+    global _http_client
+    client, _http_client = _http_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def decode_audio(content, budget=None) -> DecodedAudio:
+    # Tracks decoded before are returned deferred: their hash and shape are
+    # known, and the samples are only decoded if a tagger misses the feature store
+    digest = source_digest(content)
+    source_key = feature_store.make_key("decoded", digest, budget=repr(budget))
+    meta = feature_store.get_meta(source_key)
+    if meta is not None:
+        audio = DecodedAudio.deferred(
+            lambda: _decode_audio(content, budget).waveform,
+            meta["sample_rate"], meta["shape"], meta["content_hash"], meta["segment_bounds"],
+        )
+        audio.source_id = digest
+        return audio
+
+    # Very long recordings analysed in full are not decoded up front at all
+    if budget is None or not budget.max_seconds:
+        info = decoders.probe(content)
+        if info is not None and info.duration > streaming_threshold_seconds:
+            shape = (info.channels, int(round(info.duration * info.sample_rate)))
+            audio = DecodedAudio.streamed(content, info.sample_rate, shape, f"source:{digest}")
+            audio.source_id = digest
+            return audio
+
+    audio = _decode_audio(content, budget)
+    audio.source_id = digest
+    if getattr(budget, "keeps_length", False):
+        # Which regions were decoded depends on the taggers asked for; name it by the file
+        # instead, so the taggers' excerpts hash the same whichever were selected
+        audio._content_hash = f"source:{digest}"
+    try:
+        feature_store.put_meta(source_key, {
+            "sample_rate": audio.sample_rate,
+            "shape": list(audio.waveform.shape),
+            "content_hash": audio.content_hash,
+            "segment_bounds": audio.segment_bounds,
+        })
+    except OSError:
+        pass
+    return audio
+
+
+@stage("decode")
+def _decode_audio(content, budget=None) -> DecodedAudio:
+    # With a budget, seek to and decode only the regions it samples
+    if budget is not None and budget.max_seconds:
+        duration = decoders.probe_duration(content)
+        regions = budget.plan(duration) if duration else None
+        if regions and getattr(budget, "keeps_length", False):
+            return _decode_in_place(content, regions, duration)
+        if regions:
+            parts = []
+            for offset, region_duration in regions:
+                checkpoint()
+                waveform, sample_rate = decoders.decode(content, offset, region_duration)
+                parts.append(DecodedAudio(waveform, sample_rate))
+            return DecodedAudio.concatenate(parts)
+
+    waveform, sample_rate = decoders.decode(content)
+    audio = DecodedAudio(waveform, sample_rate)
+    return budget.apply(audio) if budget is not None else audio
+
+
+def _decode_in_place(content, regions: list, duration: float) -> DecodedAudio:
+    # The whole track's length, with only the regions decoded; untouched zero pages cost no memory
+    checkpoint()
+    waveform = None
+    for (offset, _), (part, sample_rate) in zip(regions, decoders.decode_regions(content, regions)):
+        part = part[np.newaxis, :] if part.ndim == 1 else part
+        if waveform is None:
+            waveform = np.zeros((part.shape[0], int(round(duration * sample_rate))), dtype=np.float32)
+        start = min(int(offset * sample_rate), waveform.shape[1])
+        end = min(start + part.shape[1], waveform.shape[1])
+        channels = min(part.shape[0], waveform.shape[0])
+        waveform[:channels, start:end] = part[:channels, :end - start]
+    return DecodedAudio(waveform, sample_rate)
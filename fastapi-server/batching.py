@@ -0,0 +1,142 @@
+import os
+import time
+import queue
+import threading
+import weakref
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import numpy as np
+from telemetry import Gauge
+
+default_max_batch_size = int(os.environ.get("MOZARTIFY_BATCH_MAX_SIZE", "64"))
+default_max_latency_ms = float(os.environ.get("MOZARTIFY_BATCH_MAX_LATENCY_MS", "5"))
+
+_predictors = weakref.WeakSet()
+
+Gauge(
+    "mozartify_batch_queue_depth", "Inputs waiting for the next model batch.", ("model",),
+    collect=lambda: [({"model": p.name}, p._queue.qsize()) for p in list(_predictors)],
+)
+
+
+class BatchingPredictor:
+    """Coalesces predict() calls from concurrent requests into one model batch.
+
+    Callers block on their own slice of the output. A batch is flushed once it
+    holds max_batch_size rows or max_latency_ms has passed since its first row.
+    Multi-input models take a list of arrays with matching row counts and
+    return a list of outputs.
+    """
+
+    def __init__(self, model, max_batch_size: int = default_max_batch_size,
+                 max_latency_ms: float = default_max_latency_ms, name: str = "model"):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.name = name
+        self.batches = 0
+        self.rows = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self._worker.start()
+        _predictors.add(self)
+
+    def predict(self, x):
+        future = Future()
+        self._queue.put((x, future))
+        while True:
+            try:
+                return future.result(timeout=1.0)
+            except FutureTimeout:
+                # A model call may take any time, but not with nobody left to make it
+                if not self._worker.is_alive():
+                    raise RuntimeError(f"Batching worker for {self.name} has stopped")
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "mean_batch_rows": self.rows / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+    def _run(self):
+        while True:
+            groups = {}
+            try:
+                self._collect(groups)
+                for group in groups.values():
+                    self._flush(group)
+            except Exception as e:
+                # Keep serving later calls; whoever is still waiting gets the error
+                for group in groups.values():
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _collect(self, groups: dict):
+        # Requests whose tensors cannot be stacked together run as separate batches
+        rows = self._add(groups, self._queue.get())
+        deadline = time.monotonic() + self.max_latency
+        while rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            rows += self._add(groups, item)
+
+    def _add(self, groups: dict, item) -> int:
+        x, future = item
+        try:
+            rows, signature = _rows(x), _signature(x)
+        except Exception as e:
+            # Not an array (or list of arrays); only this caller fails
+            future.set_exception(TypeError(f"Cannot batch input of type {type(x).__name__}: {e}"))
+            return 0
+        groups.setdefault(signature, []).append(item)
+        return rows
+
+    def _flush(self, items):
+        try:
+            if len(items) == 1:
+                batch = items[0][0]
+            else:
+                batch = _concatenate([x for x, _ in items])
+            y_pred = self.model.predict(batch, verbose=0)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.rows += _rows(batch)
+        offset = 0
+        for x, future in items:
+            future.set_result(_slice(y_pred, offset, offset + _rows(x)))
+            offset += _rows(x)
+
+
+# Helpers that treat a list of arrays (one per model input or output) like a single array
+
+def _rows(x) -> int:
+    return len(x[0]) if isinstance(x, (list, tuple)) else len(x)
+
+
+def _signature(x):
+    if isinstance(x, (list, tuple)):
+        return tuple((a.shape[1:], a.dtype) for a in x)
+    return (x.shape[1:], x.dtype)
+
+
+def _concatenate(xs):
+    if isinstance(xs[0], (list, tuple)):
+        return [np.concatenate(parts, axis=0) for parts in zip(*xs)]
+    return np.concatenate(xs, axis=0)
+
+
+def _slice(y, start: int, end: int):
+    if isinstance(y, (list, tuple)):
+        return [a[start:end] for a in y]
+    return y[start:end]
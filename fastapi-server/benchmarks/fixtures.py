@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import soundfile as sf
+
+sample_rate = 44100
+durations = {"30s": 30, "3min": 180, "10min": 600}
+kinds = ("tone", "noise", "mixed")
+formats = ("wav", "mp3")
+
+
+def synthesize(kind: str, seconds: float, sr: int = sample_rate, seed: int = 0) -> np.ndarray:
+    """Deterministic stereo test signal of shape (samples, 2)."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    if kind == "tone":
+        # A harmonic tone whose pitch steps every two seconds
+        pitch = 220.0 * 2 ** (np.floor(t / 2) % 12 / 12)
+        phase = 2 * np.pi * np.cumsum(pitch) / sr
+        left = sum(np.sin(phase * h) / h for h in range(1, 6)) * 0.3
+        right = np.roll(left, sr // 100)
+    elif kind == "noise":
+        left = rng.standard_normal(t.size) * 0.1
+        right = rng.standard_normal(t.size) * 0.1
+    elif kind == "mixed":
+        tone = synthesize("tone", seconds, sr, seed)[:, 0]
+        noise = rng.standard_normal(t.size) * 0.05
+        # Decaying clicks on every beat at 120 bpm stand in for percussion
+        clicks = np.exp(-(t % 0.5) * 40) * rng.standard_normal(t.size) * 0.3
+        left = tone + noise + clicks
+        right = tone * 0.8 + noise + clicks
+    else:
+        raise ValueError(f"Unknown fixture kind: {kind}")
+    return np.stack([left, right], axis=1).astype(np.float32)
+
+
+def fixture_path(directory: str, kind: str, duration: str, fmt: str) -> str:
+    return os.path.join(directory, f"{kind}_{duration}.{fmt}")
+
+
+def ensure_fixtures(directory: str, kinds=kinds, durations=durations, formats=formats) -> dict:
+    """Write any missing fixtures and return {name: path}. Files are reused across runs."""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for kind in kinds:
+        for duration, seconds in durations.items():
+            signal = None
+            for fmt in formats:
+                path = fixture_path(directory, kind, duration, fmt)
+                if not os.path.exists(path):
+                    if fmt == "mp3" and "MP3" not in sf.available_formats():
+                        print(f"Skipping {path}: this libsndfile cannot write MP3")
+                        continue
+                    if signal is None:
+                        signal = synthesize(kind, seconds)
+                    sf.write(path, signal, sample_rate, format=fmt.upper())
+                paths[os.path.basename(path)] = path
+    return paths
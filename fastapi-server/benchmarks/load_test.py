@@ -0,0 +1,396 @@
+"""End-to-end load test of the audio services against a local stand-in for Firebase Storage.
+
+Generates a corpus of distinct synthetic tracks, serves it over HTTP and starts
+each service under uvicorn in its own process (or targets running ones with
+--url), then drives the predict endpoints with a weighted request mix, either
+closed-loop at a fixed concurrency or open-loop at a Poisson arrival rate.
+Reports throughput, p50/p95/p99 latency, error rates and peak RSS per service.
+
+    cd fastapi-server
+    python -m benchmarks.load_test --services genre gender --concurrency 4 --requests 40
+    python -m benchmarks.load_test --mix genre=3 emotion=1 --rate 2 --duration 60 --save benchmarks/baselines/load.json
+    python -m benchmarks.load_test --compare benchmarks/baselines/load.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import platform
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+import numpy as np
+import httpx
+import soundfile as sf
+from benchmarks import fixtures
+from benchmarks.run_benchmarks import all_services, default_fixture_dir, prepare_models, serve_directory, server_directory
+
+# Route and the request field holding the download URL, per service
+endpoints = {
+    "genre": ("/predict-genre", "fileUrl"),
+    "emotion": ("/predict-emotion", "fileUrl"),
+    "gender": ("/predict-gender/", "file_url"),
+    "instrument": ("/predict-instrument", "fileUrl"),
+}
+
+
+def ensure_corpus(directory: str, size: int, track_length: str, fmt: str, kinds=fixtures.kinds) -> list:
+    """Write any missing corpus tracks and return their file names.
+
+    Every track gets its own seed and gain, so no two decode to the same
+    samples and repeated requests only hit the caches when a file repeats.
+    """
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for i in range(size):
+        kind = kinds[i % len(kinds)]
+        name = f"load_{kind}_{track_length}_{i}.{fmt}"
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            signal = fixtures.synthesize(kind, fixtures.durations[track_length], seed=i) * (0.6 + 0.4 * i / size)
+            sf.write(path, signal, fixtures.sample_rate, format=fmt.upper())
+        names.append(name)
+    return names
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalService:
+    """A service running under uvicorn in its own process, so its memory is its own."""
+
+    def __init__(self, name: str, log_dir: str, env: dict):
+        self.name = name
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", f"{name}:app", "--host", "127.0.0.1", "--port", str(self.port)],
+                cwd=server_directory, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with {self.process.returncode}, see {self.log_path}")
+            try:
+                if (await client.get(f"{self.url}/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+        raise RuntimeError(f"{self.name} not ready after {timeout:.0f}s, see {self.log_path}")
+
+    def peak_rss(self):
+        # VmHWM is the process's high-water mark, model loading included
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+async def scrape_rss(client: httpx.AsyncClient, url: str):
+    # Fallback for services not started here: the resident memory gauge on /metrics
+    try:
+        text = (await client.get(f"{url}/metrics")).text
+    except httpx.HTTPError:
+        return None
+    for line in text.splitlines():
+        if line.startswith("mozartify_process_resident_memory_bytes "):
+            return float(line.split()[1])
+    return None
+
+
+async def send(client: httpx.AsyncClient, service: str, base_url: str, file_url: str, headers: dict) -> dict:
+    route, field = endpoints[service]
+    started = time.perf_counter()
+    try:
+        response = await client.post(f"{base_url}{route}", json={field: file_url}, headers=headers)
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = f"error:{type(e).__name__}"
+    return {"service": service, "status": status, "latency": time.perf_counter() - started}
+
+
+async def drive(client, targets: dict, weights: dict, file_urls: list, args) -> tuple:
+    """Issue requests until --requests or --duration is reached; returns (records, elapsed seconds)."""
+    rng = random.Random(args.seed)
+    services = list(weights)
+    headers = {"X-Mozartify-Priority": args.priority}
+    if args.deadline:
+        headers["X-Mozartify-Deadline"] = str(args.deadline)
+    records = []
+    issued = 0
+    started = time.monotonic()
+
+    def next_request():
+        nonlocal issued
+        if issued >= args.requests or time.monotonic() - started >= args.duration:
+            return None
+        issued += 1
+        service = rng.choices(services, weights=[weights[s] for s in services])[0]
+        return service, file_urls[rng.randrange(len(file_urls))]
+
+    async def issue(service, file_url):
+        records.append(await send(client, service, targets[service], file_url, headers))
+
+    if args.rate:
+        # Open loop: arrivals do not wait for earlier responses, as with real uploads
+        tasks = []
+        while (request := next_request()) is not None:
+            tasks.append(asyncio.create_task(issue(*request)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    else:
+        async def worker():
+            while (request := next_request()) is not None:
+                await issue(*request)
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return records, time.monotonic() - started
+
+
+def summarize(records: list, elapsed: float) -> dict:
+    ok = sorted(record["latency"] for record in records if record["status"] == 200)
+    errors = Counter(str(record["status"]) for record in records if record["status"] != 200)
+    summary = {
+        "requests": len(records),
+        "ok": len(ok),
+        "errors": dict(errors),
+        "error_rate": round(1 - len(ok) / len(records), 4) if records else 0.0,
+        "throughput": round(len(ok) / elapsed, 4) if elapsed else 0.0,
+    }
+    if ok:
+        p50, p95, p99 = np.percentile(ok, [50, 95, 99])
+        summary["latency"] = {
+            "p50": round(float(p50), 4),
+            "p95": round(float(p95), 4),
+            "p99": round(float(p99), 4),
+            "max": round(ok[-1], 4),
+            "mean": round(float(np.mean(ok)), 4),
+        }
+    return summary
+
+
+def parse_mix(mix: list, services: list) -> dict:
+    if not mix:
+        return {service: 1.0 for service in services}
+    weights = {}
+    for entry in mix:
+        service, _, weight = entry.partition("=")
+        if service not in endpoints:
+            raise SystemExit(f"Unknown service in --mix: {service}")
+        weights[service] = float(weight or 1)
+    return weights
+
+
+def parse_urls(urls: list) -> dict:
+    targets = {}
+    for entry in urls or []:
+        service, _, url = entry.partition("=")
+        if service not in endpoints or not url:
+            raise SystemExit(f"--url expects service=http://host:port, got {entry}")
+        targets[service] = url.rstrip("/")
+    return targets
+
+
+async def run_load(args) -> dict:
+    weights = parse_mix(args.mix, args.services)
+    external = parse_urls(args.url)
+    models = "external" if set(weights) <= set(external) else prepare_models(args.standin_models)
+
+    names = ensure_corpus(args.fixture_dir, args.corpus_size, args.track_length, args.format)
+    file_server, base_url = serve_directory(args.fixture_dir)
+    file_urls = [f"{base_url}/{name}" for name in names]
+
+    log_dir = tempfile.mkdtemp(prefix="mozartify-load-")
+    env = dict(os.environ)
+    if not args.cache:
+        # Every run starts cold: a fresh prediction cache and no stored features
+        env["MOZARTIFY_CACHE_PATH"] = os.path.join(log_dir, "predictions.sqlite3")
+        env["MOZARTIFY_FEATURE_STORE"] = "0"
+
+    local = {}
+    limits = httpx.Limits(max_connections=max(args.concurrency, 10) * 4, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        try:
+            targets = {}
+            for service in weights:
+                if service in external:
+                    targets[service] = external[service]
+                else:
+                    local[service] = LocalService(service, log_dir, env)
+                    targets[service] = local[service].url
+            for service, process in list(local.items()):
+                try:
+                    await process.wait_ready(client, args.startup_timeout)
+                except RuntimeError as e:
+                    print(f"Skipping {service}: {e}", file=sys.stderr)
+                    process.stop()
+                    del local[service], targets[service], weights[service]
+            if not weights:
+                raise SystemExit("No service could be started")
+
+            # Each service's first requests pay one-off costs (graph tracing, lazy imports)
+            for service in weights:
+                for i in range(args.warmup):
+                    await send(client, service, targets[service], file_urls[i % len(file_urls)], {})
+
+            peak_rss = {service: None for service in weights}
+
+            async def watch_memory():
+                while True:
+                    for service in weights:
+                        if service not in local:
+                            rss = await scrape_rss(client, targets[service])
+                            if rss is not None:
+                                peak_rss[service] = max(rss, peak_rss[service] or 0)
+                    await asyncio.sleep(0.5)
+
+            watcher = asyncio.create_task(watch_memory())
+            try:
+                records, elapsed = await drive(client, targets, weights, file_urls, args)
+            finally:
+                watcher.cancel()
+            for service, process in local.items():
+                peak_rss[service] = process.peak_rss()
+        finally:
+            for process in local.values():
+                process.stop()
+            file_server.shutdown()
+
+    results = {}
+    for service in weights:
+        results[service] = summarize([record for record in records if record["service"] == service], elapsed)
+        results[service]["peak_rss_bytes"] = peak_rss[service]
+    total = summarize(records, elapsed)
+    for service, summary in results.items():
+        latency = summary.get("latency", {})
+        rss = summary["peak_rss_bytes"]
+        print(f"{service}: {summary['ok']}/{summary['requests']} ok, {summary['throughput']:.2f} req/s, "
+              f"p50={latency.get('p50', float('nan')):.3f}s p95={latency.get('p95', float('nan')):.3f}s "
+              f"p99={latency.get('p99', float('nan')):.3f}s, "
+              f"peak RSS {f'{rss / 1024 ** 2:.0f} MiB' if rss else 'n/a'}", file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "models": models,
+            "mix": weights,
+            "mode": f"open loop at {args.rate} req/s" if args.rate else f"closed loop x{args.concurrency}",
+            "corpus": {"size": args.corpus_size, "track_length": args.track_length, "format": args.format},
+            "cache": args.cache,
+            "elapsed_seconds": round(elapsed, 3),
+            "logs": log_dir,
+        },
+        "total": total,
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """Services whose throughput fell, or whose p95 latency or error rate rose, past the threshold."""
+    regressions = []
+    for service, current in report["results"].items():
+        previous = baseline.get("results", {}).get(service)
+        if previous is None:
+            continue
+        checks = [("throughput", previous["throughput"], current["throughput"],
+                   current["throughput"] < previous["throughput"] * (1 - threshold))]
+        if "latency" in previous and "latency" in current:
+            p95_before, p95_now = previous["latency"]["p95"], current["latency"]["p95"]
+            checks.append(("p95", p95_before, p95_now, p95_now > p95_before * (1 + threshold)))
+        # Error rates are compared in absolute terms; one failed request in a hundred is a regression
+        checks.append(("error_rate", previous["error_rate"], current["error_rate"],
+                       current["error_rate"] > previous["error_rate"] + 0.01))
+        for metric, before, now, regressed in checks:
+            if regressed:
+                regressions.append({"service": service, "metric": metric, "baseline": before, "current": now})
+    return regressions
+
+
+def build_parser(description: str = __doc__) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--services", nargs="+", default=["genre", "emotion", "gender"], choices=all_services,
+                        help="services to load evenly when --mix is not given (instrument needs torch)")
+    parser.add_argument("--mix", nargs="+", help="weighted request mix, e.g. genre=3 emotion=1 gender=1")
+    parser.add_argument("--url", nargs="+", help="use a running service instead of starting one, e.g. genre=http://host:8001")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight in closed-loop mode")
+    parser.add_argument("--rate", type=float, help="open-loop Poisson arrival rate in requests/s")
+    parser.add_argument("--requests", type=int, default=100, help="stop after this many requests")
+    parser.add_argument("--duration", type=float, default=300, help="or after this many seconds")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured requests per service first")
+    parser.add_argument("--priority", default="interactive", choices=("interactive", "bulk"))
+    parser.add_argument("--deadline", type=float, help="X-Mozartify-Deadline to send, in seconds")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--corpus-size", type=int, default=20)
+    parser.add_argument("--track-length", default="30s", choices=list(fixtures.durations))
+    parser.add_argument("--format", default="mp3", choices=fixtures.formats)
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the services' prediction cache and feature store (default: start cold)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--standin-models", action="store_true",
+                        help="use stand-in models even if the trained ones are present")
+    parser.add_argument("--fixture-dir", default=default_fixture_dir)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--save", help="store this run as a baseline file")
+    parser.add_argument("--compare", help="baseline file to check this run against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative drop in throughput or rise in p95 (default 0.2)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    report = asyncio.run(run_load(args))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        report["regressions"] = compare(report, baseline, args.threshold)
+        for key in ("mix", "mode", "corpus", "cache", "models"):
+            if baseline.get("meta", {}).get(key) != report["meta"][key]:
+                print(f"Warning: baseline was run with a different {key}: {baseline.get('meta', {}).get(key)}",
+                      file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    for path in (args.output, args.save):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['service']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
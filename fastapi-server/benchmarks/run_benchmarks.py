@@ -0,0 +1,258 @@
+"""Per-stage benchmarks for the audio services on synthetic audio.
+
+Times download, decode, feature extraction and inference separately for each
+service on deterministic fixtures. When the trained models are not present
+under fastapi-server/model, small stand-in models with the same file names and
+input shapes are generated instead.
+
+    cd fastapi-server
+    python -m benchmarks.run_benchmarks --durations 30s 3min --repeat 3
+    python -m benchmarks.run_benchmarks --save-baseline benchmarks/baselines/local.json
+    python -m benchmarks.run_benchmarks --compare benchmarks/baselines/local.json --threshold 0.25
+
+benchmarks/baselines/reference-1cpu-standin.json is a reference run on one
+core with stand-in models (see benchmarks/baselines/README.md). Timings only
+compare on the same hardware and models, so --compare refuses a baseline
+recorded with a different CPU count or models unless --allow-mismatch is given.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import argparse
+import tempfile
+import threading
+import importlib
+import statistics
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import numpy as np
+from benchmarks import fixtures, standin_models
+
+server_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_fixture_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fixtures")
+all_services = ("genre", "emotion", "gender", "instrument")
+
+
+def prepare_models(use_standins: bool) -> str:
+    real_dir = os.path.join(server_directory, "model")
+    if not use_standins and standin_models.real_models_present(real_dir):
+        return "real"
+    standin_dir = os.path.join(tempfile.gettempdir(), "mozartify-standin-models")
+    standin_models.write_standin_models(standin_dir)
+    # Must be set before the services are imported, since they load models at import time
+    os.environ["MOZARTIFY_MODEL_DIR"] = standin_dir
+    return "standin"
+
+
+def serve_directory(directory: str):
+    # Local stand-in for Firebase Storage so the download stage can be timed
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def service_stages(service: str, separation: bool) -> list:
+    """(stage name, function of the context dict) pairs, run in order."""
+    module = importlib.import_module(service)
+    if service == "genre":
+        return [
+            ("genre.load_and_preprocess_data",
+             lambda ctx: module.load_and_preprocess_data(ctx["audio"].mono, ctx["audio"].sample_rate)),
+            ("genre.model_prediction",
+             lambda ctx: module.model_prediction(ctx["genre.load_and_preprocess_data"])),
+        ]
+    if service == "emotion":
+        return [
+            ("emotion.audioPreprocessing", lambda ctx: module.audioPreprocessing(ctx["audio"])),
+            ("emotion.feature2d", lambda ctx: module.feature2d(ctx["emotion.audioPreprocessing"], 22050)),
+            ("emotion.model.predict",
+             lambda ctx: module.batched_ensemble.predict(
+                 [np.stack([x]) for x in module.emotion_features(ctx["audio"])])),
+        ]
+    if service == "gender":
+        return [
+            ("gender.chunk_mfcc_means",
+             lambda ctx: module.chunk_mfcc_means(ctx["audio"].mono, ctx["audio"].sample_rate, 30, 2)),
+            ("gender.model.predict", lambda ctx: module.gender_model.predict(ctx["gender.chunk_mfcc_means"])),
+        ]
+    if service == "instrument":
+        stages = []
+        if separation:
+            stages.append(("instrument.separate_audio", lambda ctx: module.separate_audio(ctx["audio"])))
+        else:
+            # Without separation the mix itself stands in for the accompaniment
+            stages.append(("instrument.mono_mix", lambda ctx: ctx["audio"].mono))
+        source = stages[0][0]
+        stages += [
+            ("instrument.load_and_preprocess_data_parallel",
+             lambda ctx: module.load_and_preprocess_data_parallel(ctx[source], ctx["audio"].sample_rate)),
+            ("instrument.model_prediction",
+             lambda ctx: module.model_prediction(ctx["instrument.load_and_preprocess_data_parallel"])),
+        ]
+        return stages
+    raise ValueError(f"Unknown service: {service}")
+
+
+def run(args) -> dict:
+    models = prepare_models(args.standin_models)
+    # Stages are timed from scratch on every repeat, so nothing may come from the feature store
+    os.environ["MOZARTIFY_FEATURE_STORE"] = "0"
+    from audio_loader import fetch_audio, decode_audio
+
+    paths = fixtures.ensure_fixtures(
+        args.fixture_dir,
+        kinds=args.kinds,
+        durations={name: fixtures.durations[name] for name in args.durations},
+        formats=args.formats,
+    )
+    stages = []
+    for service in args.services:
+        try:
+            stages += service_stages(service, args.separation)
+        except ImportError as e:
+            print(f"Skipping {service}: {e}", file=sys.stderr)
+
+    # Load and warm the models up front so their first stage is not timed with the load
+    from model_registry import registry
+    registry.warm()
+
+    server, base_url = serve_directory(args.fixture_dir)
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for name, path in sorted(paths.items()):
+            url = f"{base_url}/{os.path.basename(path)}"
+            timings = {}
+            for _ in range(args.repeat):
+                ctx = {}
+                pipeline = [
+                    ("download", lambda ctx: loop.run_until_complete(fetch_audio(url))),
+                    ("decode", lambda ctx: decode_audio(ctx["download"])),
+                ] + stages
+                for stage, func in pipeline:
+                    started = time.perf_counter()
+                    ctx[stage] = func(ctx)
+                    timings.setdefault(stage, []).append(time.perf_counter() - started)
+                    if stage == "decode":
+                        ctx["audio"] = ctx["decode"]
+            results[name] = {
+                stage: {
+                    "median": statistics.median(runs),
+                    "min": min(runs),
+                    "runs": [round(run, 6) for run in runs],
+                }
+                for stage, runs in timings.items()
+            }
+            print(f"{name}: " + ", ".join(f"{stage}={value['median']:.3f}s" for stage, value in results[name].items()),
+                  file=sys.stderr)
+    finally:
+        server.shutdown()
+        loop.close()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "models": models,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float, min_seconds: float) -> list:
+    """Stages whose median regressed by more than the threshold against the baseline."""
+    # A baseline may tighten or loosen individual stages, e.g. {"thresholds": {"decode": 0.5}}
+    overrides = baseline.get("thresholds", {})
+    regressions = []
+    for fixture, stages in report["results"].items():
+        for stage, value in stages.items():
+            reference = baseline.get("results", {}).get(fixture, {}).get(stage)
+            if reference is None:
+                continue
+            limit = overrides.get(stage, threshold)
+            current, previous = value["median"], reference["median"]
+            if current > previous * (1 + limit) and current - previous > min_seconds:
+                regressions.append({
+                    "fixture": fixture,
+                    "stage": stage,
+                    "baseline": previous,
+                    "current": current,
+                    "ratio": round(current / previous, 3) if previous else None,
+                    "threshold": limit,
+                })
+    return regressions
+
+
+# Timings are only comparable when these match between the baseline and the run
+comparable_meta = ("cpu_count", "models")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--services", nargs="+", default=list(all_services), choices=all_services)
+    parser.add_argument("--kinds", nargs="+", default=list(fixtures.kinds), choices=fixtures.kinds)
+    parser.add_argument("--durations", nargs="+", default=list(fixtures.durations), choices=list(fixtures.durations))
+    parser.add_argument("--formats", nargs="+", default=list(fixtures.formats), choices=fixtures.formats)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--separation", action="store_true",
+                        help="include Open-Unmix separation (downloads umxl weights on first use)")
+    parser.add_argument("--standin-models", action="store_true",
+                        help="use stand-in models even if the trained ones are present")
+    parser.add_argument("--fixture-dir", default=default_fixture_dir)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--save-baseline", help="store this run as a baseline file")
+    parser.add_argument("--compare", help="baseline file to check this run against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative slowdown of a stage's median (default 0.25)")
+    parser.add_argument("--min-seconds", type=float, default=0.01,
+                        help="ignore slowdowns smaller than this many seconds")
+    parser.add_argument("--allow-mismatch", action="store_true",
+                        help="compare even if the baseline was recorded on other hardware or models")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report = run(args)
+
+    if baseline is not None:
+        mismatched = {
+            key: (baseline.get("meta", {}).get(key), report["meta"][key])
+            for key in comparable_meta if baseline.get("meta", {}).get(key) != report["meta"][key]
+        }
+        if mismatched and not args.allow_mismatch:
+            # Checked after the run too, since which models are used is only known then
+            raise SystemExit(f"{args.compare} was recorded under other conditions (baseline, now): {mismatched}; "
+                             "save a baseline on this machine or pass --allow-mismatch")
+        report["regressions"] = compare(report, baseline, args.threshold, args.min_seconds)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    for path in (args.output, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['fixture']} {regression['stage']}: "
+                  f"{regression['baseline']:.3f}s -> {regression['current']:.3f}s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+
+# Input shapes and class counts the services feed their models
+keras_models = {
+    ("genre", "Trained_model.h5"): ((128, 128, 1), 10),
+    ("instrument", "Trained_model.h5"): ((128, 128, 1), 28),
+    ("emotion", "Conv2D_spec_agumented.h5"): ((300, 300, 1), 4),
+    ("emotion", "Conv2D_mfcc_agumented.h5"): ((120, 600, 1), 4),
+    ("emotion", "Conv2D_mel_agumented.h5"): ((300, 400, 1), 4),
+}
+gender_model = ("gender", "gender_classifier.pkl")
+
+
+def real_models_present(model_dir: str) -> bool:
+    paths = [os.path.join(model_dir, *parts) for parts in list(keras_models) + [gender_model]]
+    return all(os.path.exists(path) for path in paths)
+
+
+def build_keras_standin(input_shape, num_classes):
+    import tensorflow as tf
+
+    # Small but shaped like the real CNNs: conv, pool, dense softmax
+    inputs = tf.keras.Input(shape=input_shape)
+    x = tf.keras.layers.Conv2D(16, 3, activation="relu")(inputs)
+    x = tf.keras.layers.MaxPooling2D(4)(x)
+    x = tf.keras.layers.Conv2D(32, 3, activation="relu")(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(num_classes, activation="softmax")(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def write_standin_models(model_dir: str):
+    """Create stand-in model files with the real file names under model_dir."""
+    import joblib
+    from sklearn.linear_model import LogisticRegression
+
+    for parts, (input_shape, num_classes) in keras_models.items():
+        path = os.path.join(model_dir, *parts)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            build_keras_standin(input_shape, num_classes).save(path)
+
+    path = os.path.join(model_dir, *gender_model)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rng = np.random.default_rng(0)
+        features = rng.standard_normal((64, 128))
+        labels = np.arange(64) % 2
+        joblib.dump(LogisticRegression(max_iter=200).fit(features, labels), path)
@@ -0,0 +1,141 @@
+"""Search for the fastest CPU thread split (see resources.py) for a given core count.
+
+Runs the load test once per candidate split, with the services pinned to
+--cores CPUs: how many analyses run at once, how large TensorFlow's and
+torch's shared intra-op pool is, and how many threads each exported
+(TFLite/ONNX) model gets (inter-op and BLAS threads optionally too). Candidates
+are ranked by throughput, then p95 latency; runs with more than 1% errors are
+disqualified. An "unbudgeted" run, with every library sized to all cores as
+before the budget existed, is included for reference.
+
+    cd fastapi-server
+    python -m benchmarks.thread_search --cores 4 --services genre --requests 40
+    python -m benchmarks.thread_search --cores 8 --mix genre=3 emotion=1 --intraop-threads 4 8 --output split.json
+
+All load test options (--mix, --rate, --concurrency, ...) apply to every run.
+"""
+import os
+import sys
+import json
+import asyncio
+import itertools
+from contextlib import contextmanager
+from benchmarks.load_test import build_parser, run_load
+
+
+def available_cpus() -> list:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def powers_of_two(limit: int) -> list:
+    values = [1 << i for i in range(limit.bit_length()) if 1 << i <= limit]
+    return values if limit in values else values + [limit]
+
+
+def candidates(cores: int, concurrency_options=None, inference_options=None, intraop_options=None,
+               interop_options=(1,), blas_options=(1,)) -> list:
+    """(name, environment) per split to try; by default every concurrency that keeps all cores busy."""
+    splits = [("unbudgeted", {
+        "MOZARTIFY_MAX_CONCURRENT": str(cores),
+        "MOZARTIFY_INTRAOP_THREADS": str(cores),
+        "MOZARTIFY_INFERENCE_THREADS": str(cores),
+        "MOZARTIFY_INTEROP_THREADS": str(cores),
+        "MOZARTIFY_BLAS_THREADS": str(cores),
+    })]
+    for concurrency, intraop, interop, blas in itertools.product(
+        concurrency_options or powers_of_two(cores), intraop_options or [cores], interop_options, blas_options,
+    ):
+        for threads in inference_options or [max(1, cores // concurrency)]:
+            name = f"concurrency={concurrency} intraop={intraop} inference={threads} interop={interop} blas={blas}"
+            splits.append((name, {
+                "MOZARTIFY_MAX_CONCURRENT": str(concurrency),
+                "MOZARTIFY_INTRAOP_THREADS": str(intraop),
+                "MOZARTIFY_INFERENCE_THREADS": str(threads),
+                "MOZARTIFY_INTEROP_THREADS": str(interop),
+                "MOZARTIFY_BLAS_THREADS": str(blas),
+            }))
+    return splits
+
+
+@contextmanager
+def patched_environ(overrides: dict):
+    # run_load hands os.environ to the services it starts
+    saved = dict(os.environ)
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def rank(runs: list) -> list:
+    eligible = [run for run in runs if run["total"]["error_rate"] <= 0.01 and "latency" in run["total"]]
+    return sorted(eligible, key=lambda run: (-run["total"]["throughput"], run["total"]["latency"]["p95"]))
+
+
+def main(argv=None):
+    parser = build_parser(__doc__)
+    parser.add_argument("--cores", type=int, default=len(available_cpus()), help="cores to plan for and pin to")
+    parser.add_argument("--concurrency-options", type=int, nargs="+",
+                        help="concurrent analyses to try (default: powers of two up to --cores)")
+    parser.add_argument("--intraop-threads", type=int, nargs="+",
+                        help="TensorFlow/torch intra-op pool sizes to try (default: cores)")
+    parser.add_argument("--inference-threads", type=int, nargs="+",
+                        help="threads per exported model to try (default: cores / concurrency)")
+    parser.add_argument("--interop-threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--blas-threads", type=int, nargs="+", default=[1])
+    parser.set_defaults(requests=40)
+    args = parser.parse_args(argv)
+    if args.url:
+        raise SystemExit("The search starts its own services; --url is not supported")
+    cpus = available_cpus()
+    if args.cores > len(cpus):
+        raise SystemExit(f"--cores {args.cores} but only {len(cpus)} CPUs are available")
+
+    pinned = {
+        "MOZARTIFY_CPUS": str(args.cores),
+        "MOZARTIFY_CPU_AFFINITY": ",".join(str(cpu) for cpu in cpus[:args.cores]),
+    }
+    splits = candidates(args.cores, args.concurrency_options, args.inference_threads, args.intraop_threads,
+                        args.interop_threads, args.blas_threads)
+    runs = []
+    for name, environment in splits:
+        print(f"Running {name}", file=sys.stderr)
+        environment = {**pinned, **environment}
+        if name == "unbudgeted":
+            # What each library picks by itself: every core, everywhere
+            environment.update({variable: str(args.cores) for variable in (
+                "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+            )})
+        with patched_environ(environment):
+            report = asyncio.run(run_load(args))
+        runs.append({"name": name, "environment": environment, "total": report["total"],
+                     "results": report["results"]})
+
+    ranked = rank(runs)
+    for run in runs:
+        total = run["total"]
+        p95 = total.get("latency", {}).get("p95", float("nan"))
+        marker = "*" if ranked and run is ranked[0] else " "
+        print(f"{marker} {run['name']:<64} {total['throughput']:.2f} req/s  p95={p95:.3f}s  "
+              f"errors={total['error_rate']:.1%}", file=sys.stderr)
+    if ranked:
+        best = ranked[0]
+        print("Best split for {} cores:\n{}".format(args.cores, "\n".join(
+            f"  {variable}={value}" for variable, value in best["environment"].items()
+            if variable.startswith("MOZARTIFY_") and variable != "MOZARTIFY_CPU_AFFINITY"
+        )), file=sys.stderr)
+
+    text = json.dumps({"cores": args.cores, "best": ranked[0]["name"] if ranked else None, "runs": runs}, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
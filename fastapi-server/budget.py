@@ -0,0 +1,96 @@
+import os
+from typing import Optional
+from audio_loader import DecodedAudio
+
+
+class AnalysisBudget:
+    """Caps how many seconds of a track a tagger analyses.
+
+    Longer tracks are sampled as evenly spread segments of segment_seconds,
+    each centred in its own equal share of the track, so the excerpt covers
+    the beginning, middle and end instead of just the opening.
+    """
+
+    def __init__(self, max_seconds: Optional[float] = None, segment_seconds: float = 30.0):
+        self.max_seconds = max_seconds
+        self.segment_seconds = segment_seconds
+
+    @classmethod
+    def from_env(cls, service: str, default_max_seconds: Optional[float], segment_seconds: float) -> "AnalysisBudget":
+        value = os.environ.get(f"MOZARTIFY_{service.upper()}_BUDGET_SECONDS")
+        if value is None:
+            max_seconds = default_max_seconds
+        else:
+            # An empty or zero value analyses the whole track
+            max_seconds = float(value) if value and float(value) > 0 else None
+        return cls(max_seconds, segment_seconds)
+
+    def with_max_seconds(self, max_seconds: Optional[float]) -> "AnalysisBudget":
+        # Per-request override; None keeps the service default, 0 disables the budget
+        if max_seconds is None:
+            return self
+        return AnalysisBudget(max_seconds if max_seconds > 0 else None, self.segment_seconds)
+
+    def plan(self, duration: float):
+        """(offset, duration) regions in seconds to analyse, or None for the whole track."""
+        if not self.max_seconds or duration <= self.max_seconds:
+            return None
+        segment = min(self.segment_seconds, self.max_seconds)
+        num_segments = max(1, int(self.max_seconds // segment))
+        stride = duration / num_segments
+        return [(i * stride + (stride - segment) / 2, segment) for i in range(num_segments)]
+
+    def apply(self, audio: DecodedAudio) -> DecodedAudio:
+        # Audio that was already decoded as an excerpt is left alone
+        if audio.is_excerpt:
+            return audio
+        regions = self.plan(audio.duration)
+        return audio.excerpt(regions) if regions else audio
+
+    def __repr__(self):
+        return f"AnalysisBudget(max_seconds={self.max_seconds}, segment_seconds={self.segment_seconds})"
+
+
+class CombinedBudget:
+    """The regions several taggers' budgets sample, for decoding a track once for all of them.
+
+    A track decoded with it keeps its full length, with only the union of
+    those regions decoded and the rest left silent, so each tagger still
+    applies its own budget to it and reads exactly its own regions.
+    """
+
+    # Decoded around each region, so rounding to samples never reaches silence
+    margin_seconds = 1.0
+    keeps_length = True
+
+    def __init__(self, budgets):
+        self.budgets = list(budgets)
+
+    @property
+    def max_seconds(self) -> Optional[float]:
+        # None as soon as one tagger analyses whole tracks
+        limits = [budget.max_seconds for budget in self.budgets]
+        return sum(limits) if limits and all(limits) else None
+
+    def plan(self, duration: float):
+        regions = []
+        for budget in self.budgets:
+            planned = budget.plan(duration)
+            if planned is None:
+                return None
+            regions.extend(planned)
+        merged = []
+        for offset, region_duration in sorted(regions):
+            start = max(0.0, offset - self.margin_seconds)
+            end = min(duration, offset + region_duration + self.margin_seconds)
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [(start, end - start) for start, end in merged]
+
+    def apply(self, audio: DecodedAudio) -> DecodedAudio:
+        return audio
+
+    def __repr__(self):
+        return f"CombinedBudget({self.budgets!r})"
@@ -0,0 +1,98 @@
+"""Measure how often budgeted analysis agrees with full-track analysis.
+
+Runs each tagger twice over every audio file in a local directory, once on the
+whole track and once within an analysis budget, bypassing the prediction cache.
+
+    python budget_agreement.py path/to/corpus --taggers genre gender emotion --max-seconds 60
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+from audio_loader import decode_audio
+
+audio_extensions = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+
+
+def tagger_functions(name):
+    # compute runs the uncached pipeline; label picks the value that is compared
+    module = importlib.import_module(name)
+    if name == "genre":
+        return module, module.compute_genre, lambda result: result[0]
+    if name == "gender":
+        return module, lambda audio: module.compute_gender(audio, 30, 2), lambda result: result
+    if name == "emotion":
+        return module, module.compute_prediction2d, lambda result: result
+    if name == "instrument":
+        return module, module.compute_top_instruments, lambda result: result.split(", ")[0]
+    raise ValueError(f"Unknown tagger: {name}")
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="directory of audio files")
+    parser.add_argument("--taggers", nargs="+", default=["genre", "gender", "emotion"])
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="budget to test; defaults to each service's configured budget")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    args = parser.parse_args(argv)
+
+    files = sorted(
+        os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+        if name.lower().endswith(audio_extensions)
+    )
+    if not files:
+        parser.error(f"No audio files found in {args.corpus}")
+
+    taggers = {name: tagger_functions(name) for name in args.taggers}
+    results = {name: [] for name in args.taggers}
+
+    for path in files:
+        with open(path, "rb") as f:
+            audio = decode_audio(f.read())
+        for name, (module, compute, label) in taggers.items():
+            budget = module.budget.with_max_seconds(args.max_seconds)
+            full, full_seconds = timed(compute, audio)
+            budgeted, budget_seconds = timed(compute, budget.apply(audio))
+            results[name].append({
+                "file": os.path.basename(path),
+                "duration": round(audio.duration, 2),
+                "full": label(full),
+                "budgeted": label(budgeted),
+                "full_seconds": round(full_seconds, 3),
+                "budget_seconds": round(budget_seconds, 3),
+            })
+            print(f"{name} {os.path.basename(path)}: full={label(full)} budgeted={label(budgeted)}", file=sys.stderr)
+
+    report = {}
+    for name, rows in results.items():
+        agree = sum(row["full"] == row["budgeted"] for row in rows)
+        full_total = sum(row["full_seconds"] for row in rows)
+        budget_total = sum(row["budget_seconds"] for row in rows)
+        report[name] = {
+            "budget": repr(taggers[name][0].budget.with_max_seconds(args.max_seconds)),
+            "tracks": len(rows),
+            "agreement": agree / len(rows),
+            "full_seconds": round(full_total, 3),
+            "budget_seconds": round(budget_total, 3),
+            "speedup": round(full_total / budget_total, 2) if budget_total else None,
+            "disagreements": [row for row in rows if row["full"] != row["budgeted"]],
+        }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import os
+import json
+import shutil
+import threading
+import subprocess
+from collections import namedtuple
+from io import BytesIO
+from typing import Optional
+import numpy as np
+import soundfile as sf
+from telemetry import get_logger
+
+logger = get_logger("decoders")
+
+# "auto" tries soundfile, then ffmpeg, then librosa/audioread; or force one backend
+decoder_name = os.environ.get("MOZARTIFY_DECODER", "auto")
+
+
+AudioInfo = namedtuple("AudioInfo", ["duration", "sample_rate", "channels"])
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _open(content):
+    # Bytes in memory, or a download spooled to disk that exposes open()
+    return content.open() if hasattr(content, "open") else BytesIO(content)
+
+
+class SoundfileDecoder:
+    """libsndfile decode straight to float32 (WAV, FLAC, OGG and, since 1.1, MP3).
+
+    Reads the same frames librosa.load(sr=None, mono=False) does, in one
+    allocation. The (channels, samples) result is a transposed view of the
+    interleaved frames, so DecodedAudio.interleaved() needs no copy.
+    """
+
+    name = "soundfile"
+
+    def available(self) -> bool:
+        return True
+
+    def probe(self, content) -> Optional[AudioInfo]:
+        try:
+            with _open(content) as source:
+                info = sf.info(source)
+        except Exception:
+            return None
+        return AudioInfo(info.duration, info.samplerate, info.channels)
+
+    def decode(self, content, offset: float = 0.0, duration: Optional[float] = None):
+        try:
+            with _open(content) as source, sf.SoundFile(source) as f:
+                sample_rate = f.samplerate
+                if offset:
+                    f.seek(int(offset * sample_rate))
+                frames = int(duration * sample_rate) if duration is not None else -1
+                data = f.read(frames=frames, dtype="float32", always_2d=True)
+        except (sf.LibsndfileError, RuntimeError, TypeError) as e:
+            raise DecodeError(str(e)) from e
+        return data.T, sample_rate
+
+    def decode_regions(self, content, regions: list) -> list:
+        # One open file for all regions: reopening an MP3 to seek costs a scan from its start each time
+        parts = []
+        try:
+            with _open(content) as source, sf.SoundFile(source) as f:
+                for offset, duration in regions:
+                    f.seek(int(offset * f.samplerate))
+                    data = f.read(frames=int(duration * f.samplerate), dtype="float32", always_2d=True)
+                    parts.append((data.T, f.samplerate))
+        except (sf.LibsndfileError, RuntimeError, TypeError) as e:
+            raise DecodeError(str(e)) from e
+        return parts
+
+    def blocks(self, content, block_frames: int):
+        with _open(content) as source, sf.SoundFile(source) as f:
+            for block in f.blocks(blocksize=block_frames, dtype="float32", always_2d=True):
+                yield block.T
+
+
+class FfmpegDecoder:
+    """Decodes anything ffmpeg reads by piping the bytes through it as raw float32."""
+
+    name = "ffmpeg"
+
+    def available(self) -> bool:
+        return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+    def _run(self, command: list, content) -> subprocess.CompletedProcess:
+        # Spooled downloads are handed over as the process's stdin file, bytes are piped in
+        if hasattr(content, "open"):
+            with content.open() as source:
+                return subprocess.run(command, stdin=source, capture_output=True)
+        return subprocess.run(command, input=content, capture_output=True)
+
+    def _probe(self, content) -> dict:
+        result = self._run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries",
+             "stream=sample_rate,channels:format=duration", "-of", "json", "pipe:0"],
+            content,
+        )
+        if result.returncode != 0:
+            raise DecodeError(result.stderr.decode(errors="replace").strip())
+        info = json.loads(result.stdout)
+        if not info.get("streams"):
+            raise DecodeError("No audio stream found")
+        return info
+
+    def probe(self, content) -> Optional[AudioInfo]:
+        try:
+            info = self._probe(content)
+            stream = info["streams"][0]
+            return AudioInfo(float(info["format"]["duration"]), int(stream["sample_rate"]), int(stream["channels"]))
+        except (DecodeError, KeyError, ValueError):
+            return None
+
+    def _command(self, offset: float = 0.0, duration: Optional[float] = None) -> list:
+        command = ["ffmpeg", "-v", "error", "-nostdin"]
+        if offset:
+            command += ["-ss", str(offset)]
+        command += ["-i", "pipe:0"]
+        if duration is not None:
+            command += ["-t", str(duration)]
+        return command + ["-f", "f32le", "-acodec", "pcm_f32le", "pipe:1"]
+
+    def decode(self, content, offset: float = 0.0, duration: Optional[float] = None):
+        stream = self._probe(content)["streams"][0]
+        sample_rate, channels = int(stream["sample_rate"]), int(stream["channels"])
+        result = self._run(self._command(offset, duration), content)
+        if result.returncode != 0:
+            raise DecodeError(result.stderr.decode(errors="replace").strip())
+        # A read-only view of ffmpeg's output; nothing downstream writes to the waveform
+        data = np.frombuffer(result.stdout, dtype=np.float32)
+        return data[: len(data) - len(data) % channels].reshape(-1, channels).T, sample_rate
+
+    def blocks(self, content, block_frames: int):
+        channels = int(self._probe(content)["streams"][0]["channels"])
+        source = content.open() if hasattr(content, "open") else None
+        process = subprocess.Popen(
+            self._command(), stdin=source or subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        if source is None:
+            # Feed in-memory bytes from a thread so a full stdout pipe cannot deadlock stdin
+            def feed():
+                try:
+                    process.stdin.write(content)
+                except (BrokenPipeError, ValueError):
+                    pass
+                finally:
+                    process.stdin.close()
+            threading.Thread(target=feed, daemon=True).start()
+        try:
+            block_bytes = block_frames * channels * 4
+            while True:
+                raw = process.stdout.read(block_bytes)
+                if not raw:
+                    break
+                data = np.frombuffer(raw, dtype=np.float32)
+                yield data[: len(data) - len(data) % channels].reshape(-1, channels).T
+        finally:
+            process.kill()
+            process.wait()
+            if source is not None:
+                source.close()
+
+
+class LibrosaDecoder:
+    """The previous librosa.load path, kept as a last resort for formats only audioread handles."""
+
+    name = "librosa"
+
+    def available(self) -> bool:
+        return True
+
+    def probe(self, content) -> Optional[AudioInfo]:
+        # audioread only reports channels once it decodes, so these files are never streamed
+        return None
+
+    def decode(self, content, offset: float = 0.0, duration: Optional[float] = None):
+        import librosa
+        try:
+            with _open(content) as source:
+                waveform, sample_rate = librosa.load(source, sr=None, mono=False, offset=offset, duration=duration)
+        except Exception as e:
+            raise DecodeError(str(e)) from e
+        return waveform, sample_rate
+
+    def blocks(self, content, block_frames: int):
+        # Not bounded: audioread has no seekable file-like reader here
+        waveform, _ = self.decode(content)
+        waveform = waveform[np.newaxis, :] if waveform.ndim == 1 else waveform
+        for start in range(0, waveform.shape[1], block_frames):
+            yield waveform[:, start:start + block_frames]
+
+
+backends = {decoder.name: decoder for decoder in (SoundfileDecoder(), FfmpegDecoder(), LibrosaDecoder())}
+
+
+def decoder_chain() -> list:
+    if decoder_name != "auto":
+        return [backends[decoder_name]]
+    return [decoder for decoder in backends.values() if decoder.available()]
+
+
+def decode_regions(content, regions: list) -> list:
+    """(waveform, sample rate) for each (offset, duration) region, in order, from the first backend that reads it."""
+    errors = []
+    for decoder in decoder_chain():
+        try:
+            if hasattr(decoder, "decode_regions"):
+                return decoder.decode_regions(content, regions)
+            return [decoder.decode(content, offset, duration) for offset, duration in regions]
+        except DecodeError as e:
+            errors.append(f"{decoder.name}: {e}")
+            logger.debug("%s could not decode the file: %s", decoder.name, e)
+    raise DecodeError("; ".join(errors) or "No decoder available")
+
+
+def _probed(content):
+    for decoder in decoder_chain():
+        info = decoder.probe(content)
+        if info is not None:
+            return decoder, info
+    # Formats no backend can probe are only measured by decoding
+    return None, None
+
+
+def probe(content) -> Optional[AudioInfo]:
+    return _probed(content)[1]
+
+
+def probe_duration(content) -> Optional[float]:
+    info = probe(content)
+    return info.duration if info is not None else None
+
+
+def blocks(content, block_frames: int):
+    """Yield (channels, frames) float32 blocks in order, holding one block at a time."""
+    decoder, _ = _probed(content)
+    yield from (decoder or backends["librosa"]).blocks(content, block_frames)
+
+
+def decode(content, offset: float = 0.0, duration: Optional[float] = None):
+    """(waveform (channels, samples) float32, native sample rate) from the first backend that reads it."""
+    errors = []
+    for decoder in decoder_chain():
+        try:
+            return decoder.decode(content, offset, duration)
+        except DecodeError as e:
+            errors.append(f"{decoder.name}: {e}")
+            logger.debug("%s could not decode the file: %s", decoder.name, e)
+    raise DecodeError("; ".join(errors) or "No decoder available")
@@ -0,0 +1,440 @@
+import os
+import json
+import time
+import queue
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from inference_runtime import OptimizedModel
+from workers import run_blocking
+from telemetry import Gauge, stage, get_logger
+
+logger = get_logger("embeddings")
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+default_index_dir = os.path.join(current_directory, "cache", "embeddings")
+
+index_enabled = os.environ.get("MOZARTIFY_EMBEDDING_INDEX", "1") == "1"
+index_dir = os.environ.get("MOZARTIFY_EMBEDDING_INDEX_DIR", default_index_dir)
+# Rows scored per matrix product; bounds the temporaries of a search whatever the catalog size
+block_rows = int(os.environ.get("MOZARTIFY_SIMILARITY_BLOCK_ROWS", "65536"))
+# Approximate mode re-ranks this many signature matches per requested result
+candidates_per_result = int(os.environ.get("MOZARTIFY_SIMILARITY_CANDIDATES", "20"))
+# Cached tracks waiting to be indexed in the background; more are picked up on a later request
+backfill_pending = int(os.environ.get("MOZARTIFY_EMBEDDING_BACKFILL_PENDING", "8"))
+signature_bits = 128
+
+
+def with_embedding_output(model, group: str):
+    """The Keras model with a second output: the activations its classifier head reads.
+
+    That is the last layer before the output with one vector per input,
+    unless MOZARTIFY_<GROUP>_EMBEDDING_LAYER names another.
+    """
+    import tensorflow as tf
+
+    name = os.environ.get(f"MOZARTIFY_{group.upper()}_EMBEDDING_LAYER")
+    if name:
+        layer = model.get_layer(name)
+    else:
+        layer = next((layer for layer in reversed(model.layers[:-1]) if len(layer.output.shape) == 2), None)
+        if layer is None:
+            logger.warning("No embedding layer found in the %s model, tracks will not be indexed", group)
+            return model
+    return tf.keras.Model(model.inputs, [model.output, layer.output], name=f"{model.name}_embedding")
+
+
+def split_outputs(y_pred):
+    # (probabilities, chunk embeddings or None) from a model wrapped by with_embedding_output or not
+    if isinstance(y_pred, (list, tuple)):
+        return y_pred[0], y_pred[1]
+    return y_pred, None
+
+
+def l2_normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def pool_embeddings(chunk_embeddings):
+    """One vector per track: the mean of its chunks' embeddings, unit length."""
+    if chunk_embeddings is None or len(chunk_embeddings) == 0:
+        return None
+    return l2_normalize(np.mean(chunk_embeddings, axis=0))
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+    return np.unpackbits(words.view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int32)
+
+
+class EmbeddingIndex:
+    """Unit-length track embeddings in a float32 matrix on disk, searched by cosine similarity.
+
+    vectors.f32 holds one row per track and is read memory-mapped; rows.jsonl
+    maps rows to track ids and URLs and is only ever appended to, whether a
+    track is added, re-analysed or seen under a new URL. signatures.u64 holds
+    a random-hyperplane bit signature per row, which the approximate mode
+    scans by Hamming distance before re-ranking the closest rows exactly.
+    Writers hold a file lock, so several service processes can share a
+    directory; readers pick up new rows on their next search.
+    """
+
+    def __init__(self, directory: str, block_rows: int = block_rows):
+        self.directory = directory
+        self.block_rows = block_rows
+        self.dim = None
+        self._vectors = None
+        self._signatures = None
+        self._planes = None
+        self._row_ids = []
+        self._row_urls = []
+        self._ids = {}
+        self._urls = {}
+        self._rows_offset = 0
+        # Tracks run through the model again to index them that still are not
+        self._backfills = set()
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _set_dim(self, dim: int):
+        self.dim = dim
+        # The same hyperplanes in every process, so signatures stay comparable
+        rng = np.random.default_rng(dim)
+        self._planes = rng.standard_normal((signature_bits, dim)).astype(np.float32)
+
+    def _signature(self, vector: np.ndarray) -> np.ndarray:
+        return np.packbits(self._planes @ vector > 0).view(np.uint64)
+
+    def _refresh(self):
+        # Caller holds self._lock
+        if self.dim is None:
+            try:
+                with open(self._path("meta.json")) as f:
+                    self._set_dim(json.load(f)["dim"])
+            except (OSError, ValueError, KeyError):
+                return
+        try:
+            with open(self._path("rows.jsonl"), "rb") as f:
+                f.seek(self._rows_offset)
+                data = f.read()
+        except OSError:
+            data = b""
+        # A line still being written is read on the next refresh
+        complete = data[:data.rfind(b"\n") + 1]
+        self._rows_offset += len(complete)
+        for line in complete.splitlines():
+            entry = json.loads(line)
+            row = entry["row"]
+            if row == len(self._row_ids):
+                self._row_ids.append(entry["id"])
+                self._row_urls.append(None)
+            self._ids[entry["id"]] = row
+            if entry.get("url"):
+                self._row_urls[row] = entry["url"]
+                self._urls[entry["url"]] = row
+
+        rows = len(self._row_ids)
+        if self._vectors is None or len(self._vectors) != rows:
+            if rows:
+                self._vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r",
+                                          shape=(rows, self.dim))
+                self._signatures = np.memmap(self._path("signatures.u64"), dtype=np.uint64, mode="r",
+                                             shape=(rows, signature_bits // 64))
+
+    def _write_row(self, name: str, row: int, data: bytes):
+        path = self._path(name)
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            f.seek(row * len(data))
+            f.write(data)
+
+    def add(self, track_id: str, embedding: np.ndarray, url: str = None):
+        """Store (or replace) a track's embedding."""
+        vector = l2_normalize(embedding)
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                self._set_dim(len(vector))
+                with open(self._path("meta.json"), "w") as f:
+                    json.dump({"dim": self.dim, "signature_bits": signature_bits, "created_at": time.time()}, f)
+            elif len(vector) != self.dim:
+                raise ValueError(f"Embedding has {len(vector)} dimensions, the index {self.dim}")
+            row = self._ids.get(track_id, len(self._row_ids))
+            # The vector lands before the row that points at it, so readers never see a row without one
+            self._write_row("vectors.f32", row, vector.tobytes())
+            self._write_row("signatures.u64", row, self._signature(vector).tobytes())
+            self._append_row(row, track_id, url)
+            self._backfills.discard(track_id)
+            self._refresh()
+
+    def link(self, track_id: str, url: str):
+        """Record a URL for an indexed track, so it can be looked up by it."""
+        if not url:
+            return
+        with self._lock:
+            self._refresh()
+            row = self._ids.get(track_id)
+            if row is None or self._row_urls[row] == url:
+                return
+        with self._lock, self._file_lock():
+            self._append_row(row, track_id, url)
+            self._refresh()
+
+    def _append_row(self, row: int, track_id: str, url: str = None):
+        with open(self._path("rows.jsonl"), "a") as f:
+            f.write(json.dumps({"row": row, "id": track_id, "url": url}) + "\n")
+
+    def __contains__(self, track_id: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return track_id in self._ids
+
+    def claim_backfill(self, track_id: str) -> bool:
+        """True the first time an unindexed track is asked for, so it is recomputed at most once per process."""
+        with self._lock:
+            self._refresh()
+            if track_id in self._ids or track_id in self._backfills:
+                return False
+            self._backfills.add(track_id)
+            return True
+
+    def release_backfill(self, track_id: str):
+        with self._lock:
+            self._backfills.discard(track_id)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._row_ids)
+
+    def lookup(self, track_id: str = None, url: str = None):
+        """Row of a track by id or URL, or None."""
+        with self._lock:
+            self._refresh()
+            return self._ids.get(track_id) if track_id else self._urls.get(url)
+
+    def track(self, row: int) -> dict:
+        return {"track_id": self._row_ids[row], "url": self._row_urls[row]}
+
+    def _top_rows(self, score, rows: int, k: int, exclude: int = None):
+        # Best k rows by score(start, end), one block at a time
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, rows, self.block_rows):
+            end = min(rows, start + self.block_rows)
+            scores = score(start, end).astype(np.float32, copy=False)
+            if exclude is not None and start <= exclude < end:
+                scores[exclude - start] = -np.inf
+            block = np.arange(start, end)
+            best_scores = np.concatenate([best_scores, scores])
+            best_rows = np.concatenate([best_rows, block])
+            if len(best_scores) > k:
+                keep = np.argpartition(best_scores, -k)[-k:]
+                best_scores, best_rows = best_scores[keep], best_rows[keep]
+        order = np.argsort(-best_scores, kind="stable")
+        return best_rows[order], best_scores[order]
+
+    def search(self, query: np.ndarray, k: int = 10, approximate: bool = False, exclude: int = None) -> list:
+        """The k rows most similar to query as (row, cosine similarity) pairs, best first."""
+        with self._lock:
+            self._refresh()
+            vectors, signatures = self._vectors, self._signatures
+        if vectors is None:
+            return []
+        query = l2_normalize(query)
+        rows = len(vectors)
+        if approximate:
+            signature = self._signature(query)
+            candidates, _ = self._top_rows(
+                lambda start, end: -_popcount(np.asarray(signatures[start:end]) ^ signature),
+                rows, max(k * candidates_per_result, 100), exclude,
+            )
+            # Sorted rows read the memory map front to back
+            candidates = np.sort(candidates[candidates != exclude])
+            scores = np.asarray(vectors[candidates]) @ query
+            keep = np.argsort(-scores, kind="stable")[:k]
+            found = list(zip(candidates[keep], scores[keep]))
+        else:
+            found = zip(*self._top_rows(lambda start, end: np.asarray(vectors[start:end]) @ query, rows, k, exclude))
+        return [(int(row), float(score)) for row, score in found if np.isfinite(score)]
+
+    def similar(self, track_id: str = None, url: str = None, k: int = 10, approximate: bool = False,
+                min_similarity: float = None) -> dict:
+        """Tracks most similar to an indexed one; raises KeyError if it is not indexed."""
+        row = self.lookup(track_id, url)
+        if row is None:
+            raise KeyError(track_id or url)
+        query = np.asarray(self._vectors[row])
+        found = self.search(query, k, approximate, exclude=row)
+        return {
+            **self.track(row),
+            "mode": "approximate" if approximate else "exact",
+            "catalog_size": len(self._row_ids),
+            "similar": [
+                {**self.track(match), "similarity": round(score, 6)}
+                for match, score in found if min_similarity is None or score >= min_similarity
+            ],
+        }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_for(name: str, handle, version: str):
+    """The embedding index of the model a handle serves, or None if it cannot produce embeddings.
+
+    Each model file and version gets its own index, since a retrained model's
+    embeddings are not comparable with the old ones.
+    """
+    if not index_enabled:
+        return None
+    model = handle.model
+    # Exported models, and Keras models in which with_embedding_output found no layer
+    if isinstance(model, OptimizedModel) or len(getattr(model, "outputs", ())) < 2:
+        return None
+    model_id = hashlib.sha256(handle.fingerprint(version).encode()).hexdigest()[:16]
+    directory = os.path.join(index_dir, f"{name}-{model_id}")
+    with _indexes_lock:
+        if directory not in _indexes:
+            _indexes[directory] = (name, EmbeddingIndex(directory))
+        return _indexes[directory][1]
+
+
+def _add_embedding(index, track_id: str, embedding, track_url: str = None):
+    if index is None or embedding is None:
+        return
+    try:
+        index.add(track_id, embedding, track_url)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not index %s: %s", track_id, e)
+
+
+class Backfill:
+    """Indexes tracks served from the prediction cache, one at a time on a background thread.
+
+    Requests only queue the work, so a restart with a large cache does not
+    slow them down. When the queue is full a track is skipped until it is
+    requested again.
+    """
+
+    def __init__(self, max_pending: int = backfill_pending):
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, index, track_id: str, compute, track_url: str = None) -> bool:
+        try:
+            self._queue.put_nowait((index, track_id, compute, track_url))
+        except queue.Full:
+            index.release_backfill(track_id)
+            return False
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-backfill", daemon=True)
+                self._thread.start()
+        return True
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            index, track_id, compute, track_url = self._queue.get()
+            try:
+                _, embedding = compute()
+            except Exception:
+                logger.exception("Could not compute the embedding of %s", track_id)
+                continue
+            _add_embedding(index, track_id, embedding, track_url)
+
+
+backfill = Backfill()
+
+
+def cached_prediction(cache, key: str, compute, index, track_id: str, track_url: str = None):
+    """cache.get_or_compute for a tagger whose compute() returns (prediction, track embedding).
+
+    New embeddings are added to index. A track served from the cache that is
+    not indexed yet is queued for the background backfill.
+    """
+    computed = []
+
+    def run():
+        prediction, embedding = compute()
+        computed.append(True)
+        _add_embedding(index, track_id, embedding, track_url)
+        return prediction
+
+    prediction = cache.get_or_compute(key, run)
+    if index is not None:
+        if not computed and index.claim_backfill(track_id):
+            backfill.submit(index, track_id, compute, track_url)
+        index.link(track_id, track_url)
+    return prediction
+
+
+class SimilarRequest(BaseModel):
+    # An indexed track, by the URL it was analysed from or its id
+    fileUrl: Optional[str] = None
+    trackId: Optional[str] = None
+    k: int = 10
+    # Signature prefilter then exact re-ranking; for large catalogs
+    approximate: bool = False
+    # e.g. 0.98 to find near-duplicates
+    min_similarity: Optional[float] = None
+
+
+def similarity_router(name: str, handle, version: str) -> APIRouter:
+    """POST /similar for a service: the catalog tracks closest to an analysed one, from stored embeddings only."""
+    router = APIRouter()
+
+    def similar_tracks(request: SimilarRequest) -> dict:
+        index = index_for(name, handle, version)
+        if index is None:
+            raise HTTPException(status_code=503, detail=f"The served {name} model does not produce embeddings.")
+        try:
+            with stage("similarity", name):
+                return index.similar(request.trackId, request.fileUrl, request.k, request.approximate,
+                                     request.min_similarity)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Track not indexed yet; run {name} prediction on it first.")
+
+    @router.post("/similar")
+    async def similar(request: SimilarRequest):
+        if not request.fileUrl and not request.trackId:
+            raise HTTPException(status_code=400, detail="Provide fileUrl or trackId.")
+        if not 1 <= request.k <= 1000:
+            raise HTTPException(status_code=400, detail="k must be between 1 and 1000.")
+        return await run_blocking(similar_tracks, request)
+
+    return router
+
+
+Gauge(
+    "mozartify_embedding_index_rows", "Tracks in each embedding index.", ("index",),
+    collect=lambda: [({"index": name}, len(index._row_ids)) for name, index in list(_indexes.values())],
+)
+Gauge(
+    "mozartify_embedding_backfill_pending", "Cached tracks waiting to be indexed.",
+    collect=lambda: [({}, backfill.pending())],
+)
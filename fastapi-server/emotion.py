@@ -5,16 +5,32 @@ from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import requests
+import httpx
+import resources  # sets the BLAS thread limits, so before numpy
 import numpy as np
-from tensorflow.keras.models import load_model
 import librosa
-from pydub import AudioSegment
-import io
-import random
+from typing import Optional
+from audio_loader import DecodedAudio, fetch_audio, decode_audio, close_http_client
+from workers import run_blocking
+from prediction_cache import prediction_cache
+from feature_store import feature_store
+from model_registry import registry, model_file, startup_models, readiness_response
+from inference_runtime import serving_path, serving_loader
+from batching import BatchingPredictor
+from spectral import Spectrogram
+from emotion_ensemble import EmotionEnsemble, majority_vote
+from budget import AnalysisBudget
+from telemetry import TelemetryMiddleware, metrics_response, stage, get_logger, log_sampled
+from admission import AdmissionMiddleware, checkpoint
+import logging
+
+logger = get_logger("emotion")
 
 app = FastAPI()
+app.router.add_event_handler("startup", startup_models)
+app.router.add_event_handler("shutdown", close_http_client)
 
+app.add_middleware(AdmissionMiddleware, paths=("/predict-emotion",))
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://127.0.0.1:5173"],  # Add both origins
@@ -22,108 +38,151 @@ app.add_middleware(
     allow_methods=["*"],  # Allow all HTTP methods
     allow_headers=["*"],  # Allow all headers
 )
+app.add_middleware(TelemetryMiddleware)
 
+# One inter-op thread per branch of the fused ensemble, so they run concurrently
+resources.reserve_interop_threads(3)
+
+
+def load_model(model_path):
+    # TensorFlow is imported by the loader so the server can start before it is
+    resources.configure_tensorflow()
+    from tensorflow.keras.models import load_model
+    return load_model(model_path)
 
 # Load models once to avoid reloading them on every request
-model_spec_path = "C:/Users/ADMIN/OneDrive/Documents/GitHub/mozartify/fastapi-server/model/emotion/Conv2D_spec_agumented.h5"
-model_mfcc_path = "C:/Users/ADMIN/OneDrive/Documents/GitHub/mozartify/fastapi-server/model/emotion/Conv2D_mfcc_agumented.h5"
-model_mel_path = "C:/Users/ADMIN/OneDrive/Documents/GitHub/mozartify/fastapi-server/model/emotion/Conv2D_mel_agumented.h5"
+model_spec_path = model_file("emotion", "Conv2D_spec_agumented.h5")
+model_mfcc_path = model_file("emotion", "Conv2D_mfcc_agumented.h5")
+model_mel_path = model_file("emotion", "Conv2D_mel_agumented.h5")
 
 try:
-    model_spec = load_model(model_spec_path)
-    model_mfcc = load_model(model_mfcc_path)
-    model_mel = load_model(model_mel_path)
-    print("Models loaded successfully.")
+    model_spec = registry.register("emotion-spec", serving_path(model_spec_path, "emotion"), serving_loader(load_model))
+    model_mfcc = registry.register("emotion-mfcc", serving_path(model_mfcc_path, "emotion"), serving_loader(load_model))
+    model_mel = registry.register("emotion-mel", serving_path(model_mel_path, "emotion"), serving_loader(load_model))
+    # The three models run as one fused graph, and tracks from concurrent
+    # requests share one call to it
+    ensemble = EmotionEnsemble([model_spec, model_mfcc, model_mel])
+    batched_ensemble = BatchingPredictor(ensemble, name="emotion")
+    # Trace the fused graph before the first real request
+    registry.add_warmup("emotion", lambda: batched_ensemble.predict([
+        np.zeros((1, 300, 300, 1), dtype=np.float32),
+        np.zeros((1, 120, 600, 1), dtype=np.float32),
+        np.zeros((1, 300, 400, 1), dtype=np.float32),
+    ]))
 except Exception as e:
-    print("Error loading models. Please check the paths and model files:", e)
+    logger.error("Error loading models. Please check the paths and model files: %s", e)
     raise
 
+# Bump when preprocessing changes so cached predictions are not reused
+MODEL_VERSION = "1"
+# Bump when feature extraction changes so stored features are recomputed
+FEATURE_VERSION = "1"
+
+# Long tracks are sampled as evenly spread 30 s segments, analysed back to back
+budget = AnalysisBudget.from_env("emotion", default_max_seconds=180, segment_seconds=30)
+
 class FileUrlRequest(BaseModel):
     fileUrl: str
+    max_seconds: Optional[float] = None
 
-def audioPreprocessing(file_content):
-    audio = AudioSegment.from_file(io.BytesIO(file_content), format="mp3")
-    samples = np.array(audio.get_array_of_samples()).astype(np.float32) / 32768  # Normalize
-    arr = librosa.core.resample(y=samples, orig_sr=audio.frame_rate, target_sr=11025)
-    return arr
+@stage("resample", "emotion")
+def audioPreprocessing(audio: DecodedAudio):
+    # Keep pydub's interleaved sample layout so the features match the old decoder
+    return audio.at_rate(11025, layout="interleaved")
 
 def moodString(f_pred):
     emotions = ["Angry", "Happy", "Relaxed", "Sad"]
     return emotions[f_pred] if f_pred < len(emotions) else "Unknown"
 
 def feature2d(y, sr):
-    stft = librosa.stft(y)
-    stft_db = librosa.amplitude_to_db(abs(stft))
-    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20)
-    mel = librosa.amplitude_to_db(librosa.feature.melspectrogram(y=y, sr=sr), ref=np.max)
+    # One STFT shared by the dB spectrogram, MFCC and mel views
+    spec = Spectrogram(y, sr)
+    stft_db = spec.stft_db()
+    mfccs = spec.mfcc(n_mfcc=20)
+    mel = librosa.amplitude_to_db(spec.mel(), ref=np.max)
     return stft_db, mfccs, mel
 
-def majority_vote(preds):
-    counts = np.bincount(preds)
-    max_count = np.max(counts)
-    top_classes = np.where(counts == max_count)[0]
-    # Randomly select from the top classes in case of a tie
-    return random.choice(top_classes)
-
-def prediction2d(file_content):
-    arr = audioPreprocessing(file_content)
-    f_spec, f_mfcc, f_mel = feature2d(arr, 22050)
+def emotion_features(audio: DecodedAudio):
+    arr = audioPreprocessing(audio)
+    with stage("features", "emotion"):
+        f_spec, f_mfcc, f_mel = feature2d(arr, 22050)
+
+        # Resize features and reshape them for the models' inputs
+        f_spec_reshaped = np.resize(f_spec, (300, 300)).reshape((300, 300, 1))
+        f_mfcc_reshaped = np.resize(f_mfcc, (600, 120)).reshape((120, 600, 1))
+        f_mel_reshaped = np.resize(f_mel, (400, 300)).reshape((300, 400, 1))
+    return f_spec_reshaped, f_mfcc_reshaped, f_mel_reshaped
+
+def stored_emotion_features(audio: DecodedAudio):
+    key = feature_store.make_key(
+        "emotion", audio.content_hash, version=FEATURE_VERSION, sr=11025, n_fft=2048, hop_length=512, n_mfcc=20,
+    )
+    return feature_store.get_or_compute(key, lambda: emotion_features(audio))
+
+def predict_moods(audios: list) -> list:
+    # One fused ensemble call for the whole batch of tracks
+    features = [stored_emotion_features(audio) for audio in audios]
+    checkpoint()
+    inputs = [np.stack(branch) for branch in zip(*features)]
+    with stage("inference", "emotion"):
+        y_probs = batched_ensemble.predict(inputs)
+
+    # Extract predicted classes, one column per model
+    y_preds = np.stack([np.argmax(y_prob, axis=-1) for y_prob in y_probs], axis=1)
+    log_sampled(logger, logging.DEBUG, "Predicted classes (emotion labels) from each model: %s", y_preds.tolist())
 
-    # Resize features for model input
-    f_spec_resized = np.resize(f_spec, (300, 300))
-    f_mfcc_resized = np.resize(f_mfcc, (600, 120))
-    f_mel_resized = np.resize(f_mel, (400, 300))
-
-    # Reshape data for models
-    f_spec_reshaped = f_spec_resized.reshape((1, 300, 300, 1))
-    f_mfcc_reshaped = f_mfcc_resized.reshape((1, 120, 600, 1))
-    f_mel_reshaped = f_mel_resized.reshape((1, 300, 400, 1))
+    # Use majority vote function to get the final prediction
+    final_predictions = majority_vote(y_preds, num_classes=y_probs[0].shape[-1])
+    log_sampled(logger, logging.DEBUG, "Final predictions after majority vote: %s", final_predictions.tolist())
 
-    # Predictions from each model
-    y_prob1 = model_spec.predict(f_spec_reshaped)
-    y_prob2 = model_mfcc.predict(f_mfcc_reshaped)
-    y_prob3 = model_mel.predict(f_mel_reshaped)
+    return [moodString(int(final_prediction)) for final_prediction in final_predictions]
 
-    print("Raw predictions from the Spectrogram model (model_spec):", y_prob1)
-    print("Raw predictions from the MFCC model (model_mfcc):", y_prob2)
-    print("Raw predictions from the Mel Spectrogram model (model_mel):", y_prob3)
+def prediction2d(audio: DecodedAudio, request_budget: AnalysisBudget = budget):
+    audio = request_budget.apply(audio)
+    if audio.is_streamed and not audio.is_excerpt:
+        # The features are statistics over the whole signal, so a very long
+        # recording is always sampled rather than decoded in full
+        audio = (budget if budget.max_seconds else AnalysisBudget(180, 30)).apply(audio)
+    model_id = "+".join(handle.fingerprint(MODEL_VERSION) for handle in (model_spec, model_mfcc, model_mel))
+    key = prediction_cache.make_key("emotion", audio.content_hash, model_id)
+    return prediction_cache.get_or_compute(key, lambda: compute_prediction2d(audio))
 
-    # Extract predicted classes
-    y_pred1 = np.argmax(y_prob1, axis=-1)
-    y_pred2 = np.argmax(y_prob2, axis=-1)
-    y_pred3 = np.argmax(y_prob3, axis=-1)
+def compute_prediction2d(audio: DecodedAudio):
+    return predict_moods([audio])[0]
 
-    print("Predicted classes (emotion labels) from each model:", y_pred1, y_pred2, y_pred3)
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.stats()
 
-    # Use majority vote function to get the final prediction
-    final_prediction = majority_vote([y_pred1[0], y_pred2[0], y_pred3[0]])
-    print(f"Final prediction after majority vote: {final_prediction}")
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
 
-    return moodString(final_prediction)
+@app.get("/ready")
+async def ready():
+    return readiness_response()
 
 @app.post("/predict-emotion")
 async def predict_from_url(request: FileUrlRequest):
     try:
         fileUrl = request.fileUrl
-        print("Received file URL for prediction:", fileUrl)
-        
-        # Download the file from Firebase using the provided URL
-        response = requests.get(fileUrl)
-        response.raise_for_status()  # Check if the download was successful
 
-        print("Successfully downloaded the audio file.")
+        # Download the file from Firebase using the provided URL
+        content = await fetch_audio(fileUrl)
 
         # Process and predict from the downloaded content
-        pred = prediction2d(response.content)
-        print(f"Prediction result: {pred}")
+        request_budget = budget.with_max_seconds(request.max_seconds)
+        audio = await run_blocking(decode_audio, content, request_budget)
+        pred = await run_blocking(prediction2d, audio, request_budget)
+        logger.info("Predicted mood: %s", pred)
 
         return JSONResponse(content={
             "predicted_mood": pred
         })
 
-    except requests.exceptions.RequestException as e:
-        print("Error downloading file from Firebase:", e)
+    except httpx.HTTPError as e:
+        logger.warning("Error downloading file from Firebase: %s", e)
         raise HTTPException(status_code=500, detail="Error downloading file from Firebase")
     except Exception as e:
-        print("Error during prediction:", e)
+        logger.exception("Error during prediction")
         raise HTTPException(status_code=500, detail="Error during prediction")
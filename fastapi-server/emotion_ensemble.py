@@ -0,0 +1,55 @@
+import numpy as np
+from inference_runtime import OptimizedModel
+
+
+class EmotionEnsemble:
+    """The spectrogram, MFCC and mel emotion models run as one fused graph.
+
+    A single tf.function calls all three branches, so one predict() call
+    covers the whole ensemble and TensorFlow's inter-op pool can execute the
+    independent convolutions concurrently. Accepts batches of many tracks.
+    Exported (TFLite/ONNX) models cannot join the graph and run one after another.
+    """
+
+    def __init__(self, handles):
+        # ModelHandles in (spec, mfcc, mel) order; the graph is rebuilt if one is reloaded
+        self.handles = list(handles)
+        self._models = None
+        self._fused = None
+
+    def _build(self, models):
+        # TensorFlow is already loaded with the models by now; importing it
+        # here keeps importing this module cheap
+        import tensorflow as tf
+        signature = [
+            tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)
+            for model in models
+        ]
+
+        @tf.function(input_signature=signature)
+        def fused(*inputs):
+            return tuple(model(x, training=False) for model, x in zip(models, inputs))
+
+        self._models = models
+        self._fused = fused
+
+    def predict(self, inputs, verbose=0):
+        models = tuple(handle.model for handle in self.handles)
+        tensors = [np.asarray(x, dtype=np.float32) for x in inputs]
+        if any(isinstance(model, OptimizedModel) for model in models):
+            return [model.predict(x) for model, x in zip(models, tensors)]
+        if self._models is None or any(a is not b for a, b in zip(models, self._models)):
+            self._build(models)
+        return [output.numpy() for output in self._fused(*tensors)]
+
+
+def majority_vote(preds: np.ndarray, num_classes: int, rng: np.random.Generator = None) -> np.ndarray:
+    """Row-wise majority vote over (tracks, models) class indices.
+
+    Ties are broken uniformly at random among the most voted classes.
+    """
+    rng = rng or np.random.default_rng()
+    counts = np.zeros((preds.shape[0], num_classes))
+    np.add.at(counts, (np.arange(preds.shape[0])[:, np.newaxis], preds), 1)
+    # Vote counts are integers, so noise below 1 only reorders tied classes
+    return np.argmax(counts + rng.random(counts.shape) * 0.5, axis=1)
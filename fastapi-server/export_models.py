@@ -0,0 +1,239 @@
+"""Export the Keras models to TFLite or ONNX and check them against the originals.
+
+Each .h5 model is converted (optionally quantized) next to itself, e.g.
+model/genre/Trained_model.int8.tflite, then both versions predict on features
+extracted by the service itself from a fixture set: synthetic tracks by
+default, or real ones with --audio-dir. Top-1 agreement and top-k overlap are
+written to <export>.parity.json, and the services only serve an export whose
+report passed against the current .h5 (see inference_runtime.serving_path).
+
+    python export_models.py --runtime tflite --quantization int8
+    python export_models.py --runtime onnx --models genre --audio-dir path/to/corpus --min-top1 0.98
+    MOZARTIFY_RUNTIME=tflite MOZARTIFY_QUANTIZATION=int8 uvicorn genre:app --port 8001
+
+Exits 1 if any model fails its parity check.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import importlib
+import statistics
+import numpy as np
+from audio_loader import DecodedAudio, decode_audio
+from budget import AnalysisBudget
+from model_registry import model_file
+from inference_runtime import (
+    TFLiteModel, OnnxModel, runtimes, quantizations, exported_path, parity_report_path, file_digest,
+)
+
+audio_extensions = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+
+# Model files per service, and how many top classes the service reports
+model_groups = {
+    "genre": [("genre", "Trained_model.h5")],
+    "instrument": [("instrument", "Trained_model.h5")],
+    "emotion": [
+        ("emotion", "Conv2D_spec_agumented.h5"),
+        ("emotion", "Conv2D_mfcc_agumented.h5"),
+        ("emotion", "Conv2D_mel_agumented.h5"),
+    ],
+}
+default_top_k = {"genre": 3, "instrument": 6, "emotion": 2}
+
+
+def fixture_audio(audio_dir: str = None, per_kind: int = 4) -> tuple:
+    """(DecodedAudio list, description) of the tracks the parity check runs on."""
+    if audio_dir:
+        paths = sorted(
+            os.path.join(audio_dir, name) for name in os.listdir(audio_dir) if name.lower().endswith(audio_extensions)
+        )
+        # The first minute or so of each track is plenty and keeps the check quick
+        budget = AnalysisBudget(60, 30)
+        audios = []
+        for path in paths:
+            with open(path, "rb") as f:
+                audios.append(decode_audio(f.read(), budget))
+        return audios, f"{len(audios)} tracks from {audio_dir}"
+
+    from benchmarks import fixtures
+    # The tone fixture ignores its seed, so vary the gain too
+    audios = [
+        DecodedAudio(fixtures.synthesize(kind, 30, seed=seed).T * (1.0 - 0.15 * seed), fixtures.sample_rate)
+        for kind in fixtures.kinds for seed in range(per_kind)
+    ]
+    return audios, f"{len(audios)} synthetic 30 s tracks"
+
+
+def group_features(group: str, audios: list) -> list:
+    """One feature array per model in the group, extracted the way the service does."""
+    module = importlib.import_module(group)
+    if group == "genre":
+        return [np.concatenate([module.genre_features(audio) for audio in audios])]
+    if group == "instrument":
+        # The mix stands in for the separated accompaniment, as in the benchmarks
+        return [np.concatenate([
+            module.load_and_preprocess_data_parallel(audio.mono, audio.sample_rate) for audio in audios
+        ])]
+    if group == "emotion":
+        per_track = [module.emotion_features(audio) for audio in audios]
+        return [np.stack(branch) for branch in zip(*per_track)]
+    raise ValueError(f"Unknown model group: {group}")
+
+
+def export_tflite(model, quantization: str, calibration: np.ndarray) -> bytes:
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        # Inputs and outputs stay float32, so callers are unchanged
+        converter.representative_dataset = lambda: ([row[np.newaxis]] for row in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+def export_onnx(model, quantization: str, calibration: np.ndarray) -> bytes:
+    import tensorflow as tf
+    import tf2onnx
+
+    signature = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="input"),)
+    proto, _ = tf2onnx.convert.from_keras(model, input_signature=signature, opset=17)
+    if quantization == "float16":
+        from onnxconverter_common import float16
+        proto = float16.convert_float_to_float16(proto, keep_io_types=True)
+    if quantization not in ("dynamic", "int8"):
+        return proto.SerializeToString()
+
+    from onnxruntime import quantization as ort_quantization
+
+    class Calibration(ort_quantization.CalibrationDataReader):
+        def __init__(self):
+            self.rows = iter(calibration)
+
+        def get_next(self):
+            row = next(self.rows, None)
+            return None if row is None else {"input": row[np.newaxis].astype(np.float32)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        float_path = os.path.join(directory, "float.onnx")
+        quantized_path = os.path.join(directory, "quantized.onnx")
+        with open(float_path, "wb") as f:
+            f.write(proto.SerializeToString())
+        if quantization == "dynamic":
+            ort_quantization.quantize_dynamic(float_path, quantized_path, weight_type=ort_quantization.QuantType.QInt8)
+        else:
+            ort_quantization.quantize_static(float_path, quantized_path, Calibration())
+        with open(quantized_path, "rb") as f:
+            return f.read()
+
+
+exporters = {"tflite": export_tflite, "onnx": export_onnx}
+loaders = {"tflite": TFLiteModel, "onnx": OnnxModel}
+
+
+def parity(reference: np.ndarray, candidate: np.ndarray, top_k: int) -> dict:
+    k = min(top_k, reference.shape[1])
+    reference_top = np.argsort(reference, axis=1)[:, -k:]
+    candidate_top = np.argsort(candidate, axis=1)[:, -k:]
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(reference_top, candidate_top)]
+    return {
+        "samples": len(reference),
+        "top1_agreement": float(np.mean(reference.argmax(axis=1) == candidate.argmax(axis=1))),
+        "top_k": k,
+        "topk_overlap": float(np.mean(overlap)),
+        "max_abs_diff": float(np.max(np.abs(reference - candidate))),
+    }
+
+
+def median_seconds(func, repeat: int = 3) -> float:
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - started)
+    return statistics.median(runs)
+
+
+def export_and_check(keras_path: str, features: np.ndarray, args, top_k: int, fixtures: str) -> dict:
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(keras_path)
+    # Calibrate int8 on half the fixtures and check parity on the other half
+    if args.quantization == "int8":
+        calibration, evaluation = features[::2], features[1::2]
+    else:
+        calibration, evaluation = features, features
+
+    path = exported_path(keras_path, args.runtime, args.quantization)
+    content = exporters[args.runtime](model, args.quantization, calibration)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+    exported = loaders[args.runtime](path)
+    reference = model.predict(evaluation, verbose=0)
+    candidate = exported.predict(evaluation)
+    report = parity(reference, candidate, top_k)
+    report.update({
+        "runtime": args.runtime,
+        "quantization": args.quantization,
+        "fixtures": fixtures,
+        "min_top1": args.min_top1,
+        "min_topk": args.min_topk,
+        "passed": report["top1_agreement"] >= args.min_top1 and report["topk_overlap"] >= args.min_topk,
+        "source": file_digest(keras_path),
+        "exported": file_digest(path),
+        "source_bytes": os.path.getsize(keras_path),
+        "exported_bytes": os.path.getsize(path),
+        "keras_seconds": median_seconds(lambda: model.predict(evaluation, verbose=0)),
+        "exported_seconds": median_seconds(lambda: exported.predict(evaluation)),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    with open(parity_report_path(path), "w") as f:
+        json.dump(report, f, indent=2)
+    return {"model": keras_path, "path": path, **report}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtime", default="tflite", choices=[runtime for runtime in runtimes if runtime != "keras"])
+    parser.add_argument("--quantization", default="none", choices=quantizations)
+    parser.add_argument("--models", nargs="+", default=list(model_groups), choices=list(model_groups))
+    parser.add_argument("--audio-dir", help="check parity on these tracks instead of synthetic ones")
+    parser.add_argument("--fixtures-per-kind", type=int, default=4)
+    parser.add_argument("--min-top1", type=float, default=0.97, help="required top-1 agreement (default 0.97)")
+    parser.add_argument("--min-topk", type=float, default=0.95, help="required top-k overlap (default 0.95)")
+    parser.add_argument("--output", help="also write the combined JSON report to this file")
+    args = parser.parse_args(argv)
+
+    audios, fixtures = fixture_audio(args.audio_dir, args.fixtures_per_kind)
+    results = []
+    for group in args.models:
+        features = group_features(group, audios)
+        for parts, group_features_ in zip(model_groups[group], features):
+            result = export_and_check(model_file(*parts), group_features_, args, default_top_k[group], fixtures)
+            results.append(result)
+            print(f"{'PASS' if result['passed'] else 'FAIL'} {result['path']}: "
+                  f"top-1 {result['top1_agreement']:.3f}, top-{result['top_k']} {result['topk_overlap']:.3f}, "
+                  f"{result['source_bytes'] / 1024 ** 2:.1f} -> {result['exported_bytes'] / 1024 ** 2:.1f} MiB, "
+                  f"{result['keras_seconds'] * 1000:.0f} -> {result['exported_seconds'] * 1000:.0f} ms",
+                  file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from telemetry import Gauge, get_logger
+
+logger = get_logger("features")
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+default_feature_store_dir = os.path.join(current_directory, "cache", "features")
+
+
+class FeatureStore:
+    """Computed feature arrays on disk as .npy files, read back memory-mapped.
+
+    Entries are keyed by decoded-audio hash and the parameters that produced
+    them, so retraining a model or tuning a threshold only reruns inference.
+    A tuple of arrays is stored as numbered parts plus a marker written last,
+    and small JSON metadata can be stored alongside. Least recently used
+    entries are evicted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory: str = default_feature_store_dir, max_bytes: int = 2 * 1024 ** 3,
+                 enabled: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(kind: str, audio_hash: str, **params) -> str:
+        parts = [kind, audio_hash] + [f"{k}={params[k]}" for k in sorted(params)]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def _path(self, key: str, suffix: str) -> str:
+        # Two-level fan-out keeps directories small for large catalogs
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def _write(self, path: str, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        # Readers never see a partially written file
+        os.replace(tmp_path, path)
+        self._grow(os.path.getsize(path))
+
+    def get(self, key: str):
+        """The stored array (or tuple of arrays) memory-mapped read-only, or None."""
+        if not self.enabled:
+            return None
+        try:
+            single = self._path(key, ".npy")
+            if os.path.exists(single):
+                value = np.load(single, mmap_mode="r")
+                self._touch(single)
+            else:
+                marker = self._path(key, ".parts")
+                with open(marker) as f:
+                    count = int(f.read())
+                value = tuple(np.load(self._path(key, f".{i}.npy"), mmap_mode="r") for i in range(count))
+                self._touch(marker)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        if not self.enabled:
+            return
+        if isinstance(value, (tuple, list)):
+            for i, part in enumerate(value):
+                self._write(self._path(key, f".{i}.npy"), lambda f, part=part: np.save(f, np.asarray(part)))
+            self._write(self._path(key, ".parts"), lambda f: f.write(str(len(value)).encode()))
+        else:
+            self._write(self._path(key, ".npy"), lambda f: np.save(f, np.asarray(value)))
+
+    def get_or_compute(self, key: str, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            try:
+                self.put(key, value)
+            except OSError as e:
+                # A full or read-only disk only costs us the reuse
+                logger.warning("Could not store features %s: %s", key, e)
+        return value
+
+    def get_meta(self, key: str):
+        if not self.enabled:
+            return None
+        try:
+            with open(self._path(key, ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_meta(self, key: str, meta: dict):
+        if self.enabled:
+            self._write(self._path(key, ".json"), lambda f: f.write(json.dumps(meta).encode()))
+
+    def _touch(self, path: str):
+        # mtime doubles as the last-used time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _grow(self, nbytes: int):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += nbytes
+            if self._size <= self.max_bytes:
+                return
+            # Evict the least recently used files down to 90% of the bound
+            files = sorted(self._files(), key=lambda entry: entry[2])
+            self._size = sum(size for _, size, _ in files)
+            for path, size, _ in files:
+                if self._size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    self._size -= size
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+feature_store = FeatureStore(
+    os.environ.get("MOZARTIFY_FEATURE_STORE_DIR", default_feature_store_dir),
+    max_bytes=int(float(os.environ.get("MOZARTIFY_FEATURE_STORE_MAX_GB", "2")) * 1024 ** 3),
+    enabled=os.environ.get("MOZARTIFY_FEATURE_STORE", "1") == "1",
+)
+
+Gauge(
+    "mozartify_feature_store_lookups", "Feature store lookups by result.", ("result",),
+    collect=lambda: [({"result": "hit"}, feature_store.hits), ({"result": "miss"}, feature_store.misses)],
+)
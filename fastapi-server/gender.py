@@ -1,14 +1,31 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+import resources  # sets the BLAS thread limits, so before numpy
 import numpy as np
 import librosa
 import joblib
-import requests
-from io import BytesIO
+import httpx
 import sklearn
+from typing import Optional
+from audio_loader import DecodedAudio, fetch_audio, decode_audio, close_http_client
+from workers import run_blocking
+from prediction_cache import prediction_cache
+from feature_store import feature_store
+from model_registry import registry, model_file, startup_models, readiness_response
+from spectral import chunk_mel_spectrograms, stream_chunks
+from budget import AnalysisBudget
+from telemetry import TelemetryMiddleware, metrics_response, stage, get_logger, log_sampled
+from admission import AdmissionMiddleware, checkpoint
+import logging
+
+logger = get_logger("gender")
 
 app = FastAPI()
+app.router.add_event_handler("startup", startup_models)
+app.router.add_event_handler("shutdown", close_http_client)
+
+app.add_middleware(AdmissionMiddleware, paths=("/predict-gender/",))
 
 # Add CORS Middleware
 app.add_middleware(
@@ -18,81 +35,135 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TelemetryMiddleware)
 
 # Define Pydantic model to parse the incoming request body
 class GenderPredictionRequest(BaseModel):
     file_url: str
+    max_seconds: Optional[float] = None
 
 # Define the response model for gender prediction
 class GenderPredictionResult(BaseModel):
     gender: str  # Only return gender (male or female)
 
+# Bump when preprocessing changes so cached predictions are not reused
+MODEL_VERSION = "1"
+# Bump when feature extraction changes so stored features are recomputed
+FEATURE_VERSION = "1"
+
+# Load the gender classifier once at startup; it is reloaded if the file changes
+gender_model = registry.register("gender", model_file("gender", "gender_classifier.pkl"), joblib.load)
+registry.add_warmup("gender", lambda: gender_model.predict(np.zeros((1, 128))))
+
+# Long tracks are sampled as 56 s segments: two full 30 s chunks at the default 28 s step
+budget = AnalysisBudget.from_env("gender", default_max_seconds=168, segment_seconds=56)
+
+def gender_chunk_bounds(num_samples: int, sr: int, chunk_duration: int, overlap_duration: int) -> list:
+    step_size = chunk_duration - overlap_duration
+    return [(start, min(start + chunk_duration * sr, num_samples)) for start in range(0, num_samples, step_size * sr)]
+
+def mfcc_means(y: np.ndarray, sr: int, bounds: list) -> np.ndarray:
+    # One row of mean MFCCs per chunk, so the whole track is classified in one predict call
+    means = []
+    for mel_spectrogram in chunk_mel_spectrograms(y, sr, bounds):
+        mfccs = librosa.feature.mfcc(S=librosa.power_to_db(mel_spectrogram), n_mfcc=128)
+        means.append(np.mean(mfccs.T, axis=0))
+    return np.array(means)
+
+@stage("features", "gender")
+def chunk_mfcc_means(y: np.ndarray, sr: int, chunk_duration: int, overlap_duration: int) -> np.ndarray:
+    return mfcc_means(y, sr, gender_chunk_bounds(len(y), sr, chunk_duration, overlap_duration))
+
+def predict_from_audio(audio: DecodedAudio, chunk_duration: int = 30, overlap_duration: int = 2,
+                       request_budget: AnalysisBudget = budget) -> str:
+    audio = request_budget.apply(audio)
+    key = prediction_cache.make_key(
+        "gender", audio.content_hash, gender_model.fingerprint(MODEL_VERSION),
+        chunk_duration=chunk_duration, overlap_duration=overlap_duration,
+    )
+    return prediction_cache.get_or_compute(
+        key, lambda: compute_gender(audio, chunk_duration, overlap_duration)
+    )
+
+def gender_features(audio: DecodedAudio, chunk_duration: int, overlap_duration: int) -> np.ndarray:
+    return np.concatenate([
+        chunk_mfcc_means(segment.mono, segment.sample_rate, chunk_duration, overlap_duration).reshape(-1, 128)
+        for segment in audio.segments()
+    ])
+
+def stream_gender_votes(audio: DecodedAudio, chunk_duration: int, overlap_duration: int):
+    # (male, female) chunk votes for a streamed recording, one block of chunks at a time
+    sr = audio.sample_rate
+    male_count = female_count = 0
+    batches = stream_chunks(
+        audio.blocks(), chunk_duration * sr, (chunk_duration - overlap_duration) * sr,
+        lambda num_samples: gender_chunk_bounds(num_samples, sr, chunk_duration, overlap_duration),
+    )
+    for y, bounds in batches:
+        checkpoint()
+        with stage("features", "gender"):
+            features = mfcc_means(y, sr, bounds)
+        with stage("inference", "gender"):
+            gender_predictions = gender_model.predict(features)
+        female = int(np.sum(gender_predictions == 1))
+        female_count += female
+        male_count += len(gender_predictions) - female
+    return male_count, female_count
+
+def compute_gender(audio: DecodedAudio, chunk_duration: int, overlap_duration: int) -> str:
+    if audio.is_streamed and not audio.is_excerpt:
+        male_count, female_count = stream_gender_votes(audio, chunk_duration, overlap_duration)
+    else:
+        key = feature_store.make_key(
+            "gender", audio.content_hash, version=FEATURE_VERSION, sr=audio.sample_rate, n_mfcc=128,
+            chunk_duration=chunk_duration, overlap_duration=overlap_duration,
+        )
+        features = feature_store.get_or_compute(key, lambda: gender_features(audio, chunk_duration, overlap_duration))
+        checkpoint()
+        with stage("inference", "gender"):
+            gender_predictions = gender_model.predict(features) if len(features) else np.array([])
+
+        # Determine majority gender prediction
+        female_count = int(np.sum(gender_predictions == 1))
+        male_count = len(gender_predictions) - female_count
+    log_sampled(logger, logging.DEBUG, "Male predictions: %d, Female predictions: %d", male_count, female_count)
+
+    # Based on the majority, return only one gender
+    gender = "Male" if male_count > female_count else "Female"
+    logger.info("Predicted gender: %s", gender)
+    return gender
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
+
+@app.get("/ready")
+async def ready():
+    return readiness_response()
+
 @app.post("/predict-gender/", response_model=GenderPredictionResult)
 async def predict_gender(request: GenderPredictionRequest, chunk_duration: int = 30, overlap_duration: int = 2):
     file_url = request.file_url  # Get file_url from the request
-    print(f"Received file URL: {file_url}")
 
     # Download and process the audio file
     try:
-        print(f"Attempting to download file from {file_url}")
-        response = requests.get(file_url)
-        response.raise_for_status()  # Check if the file is accessible
-        
-        # Create a BytesIO object from the downloaded content (in-memory processing)
-        audio_bytes = BytesIO(response.content)
-        print("File downloaded successfully.")
-
-        # Load audio file with librosa
-        print("Loading audio file with librosa...")
-        y, sr = librosa.load(audio_bytes, sr=None)  # Load directly from in-memory file
-        print(f"Audio file loaded. Sample rate: {sr}, Number of samples: {len(y)}")
-
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to fetch the file: {e}")
+        content = await fetch_audio(file_url)
+
+        # Decode the in-memory file once at its native sample rate
+        request_budget = budget.with_max_seconds(request.max_seconds)
+        audio = await run_blocking(decode_audio, content, request_budget)
+        logger.debug("Audio decoded. Sample rate: %d, Duration: %.1fs", audio.sample_rate, audio.duration)
+
+    except httpx.HTTPError as e:
+        logger.warning("Failed to fetch the file: %s", e)
         raise HTTPException(status_code=400, detail=f"Failed to fetch the file: {e}")
     except Exception as e:
-        print(f"Error downloading or loading audio file: {e}")
+        logger.exception("Error downloading or loading audio file")
         raise HTTPException(status_code=500, detail=f"Error downloading or loading audio file: {e}")
 
-    # Load the gender classifier model
-    model_path = r"C:\Users\ADMIN\OneDrive\Documents\GitHub\mozartify\fastapi-server\model\gender\gender_classifier.pkl"
-    try:
-        print(f"Loading gender classifier model from {model_path}...")
-        model = joblib.load(model_path)
-        print("Model loaded successfully.")
-    except Exception as e:
-        print(f"Error loading the gender classifier model: {e}")
-        raise HTTPException(status_code=500, detail=f"Error loading the gender classifier model: {e}")
-
-    # Perform gender prediction
-    predictions = []
-    step_size = chunk_duration - overlap_duration
-    print(f"Processing audio in chunks (duration: {chunk_duration}s, overlap: {overlap_duration}s)...")
-
-    for start in range(0, len(y), step_size * sr):
-        end = start + chunk_duration * sr
-        chunk = y[start:end]
-
-        if len(chunk) == 0:
-            continue
-        
-        # Extract MFCCs and perform gender prediction
-        print(f"Processing chunk from sample {start} to {end}...")
-        mfccs = librosa.feature.mfcc(y=chunk, sr=sr, n_mfcc=128)
-        mfccs_mean = np.mean(mfccs.T, axis=0)
-        mfccs_mean = mfccs_mean.reshape(1, -1)
-        gender_prediction = model.predict(mfccs_mean)
-        prediction = "female" if gender_prediction == 1 else "male"
-        predictions.append(prediction)
-        print(f"Predicted gender for this chunk: {prediction}")
-
-    # Determine majority gender prediction
-    male_count = predictions.count("male")
-    female_count = predictions.count("female")
-    print(f"Male predictions: {male_count}, Female predictions: {female_count}")
-
-    # Based on the majority, return only one gender
-    gender = "Male" if male_count > female_count else "Female"
-    print(f"Final predicted gender: {gender}")
-
+    gender = await run_blocking(predict_from_audio, audio, chunk_duration, overlap_duration, request_budget)
     return {"gender": gender}
@@ -1,15 +1,34 @@
+import resources  # sets the BLAS thread limits, so before numpy
 import numpy as np
 import librosa
-import tensorflow as tf
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import requests
-from io import BytesIO
+import httpx
 from fastapi.middleware.cors import CORSMiddleware
-import os
+from typing import Optional
+from audio_loader import DecodedAudio, fetch_audio, decode_audio, close_http_client
+from workers import run_blocking
+from prediction_cache import prediction_cache
+from feature_store import feature_store
+from model_registry import registry, model_file, startup_models, readiness_response
+from inference_runtime import serving_path, serving_loader
+from batching import BatchingPredictor
+from embeddings import with_embedding_output, split_outputs, pool_embeddings, l2_normalize, index_for, cached_prediction, similarity_router
+from spectral import chunk_bounds, chunk_mel_spectrograms, stream_chunks
+from budget import AnalysisBudget
+from telemetry import TelemetryMiddleware, metrics_response, stage, get_logger, log_sampled
+from admission import AdmissionMiddleware, checkpoint
+import logging
+
+logger = get_logger("genre")
 
 # Initialize FastAPI app
 app = FastAPI()
+app.router.add_event_handler("startup", startup_models)
+app.router.add_event_handler("shutdown", close_http_client)
+
+# Innermost, so rejections still get CORS headers and show up in the request metrics
+app.add_middleware(AdmissionMiddleware, paths=("/predict-genre",))
 
 # Add CORS middleware
 app.add_middleware(
@@ -19,13 +38,38 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TelemetryMiddleware)
+
+def load_model(model_path):
+    # TensorFlow is imported by the loader so the server can start before it is
+    resources.configure_tensorflow()
+    import tensorflow as tf
+    # Also returns each chunk's penultimate-layer embedding, for /similar
+    return with_embedding_output(tf.keras.models.load_model(model_path), "genre")
+
+# Loaded once at startup; the registry reloads it if the file changes.
+# MOZARTIFY_RUNTIME=tflite|onnx serves a parity-checked export instead.
+model = registry.register(
+    "genre", serving_path(model_file("genre", "Trained_model.h5"), "genre"), serving_loader(load_model)
+)
+# Chunks from concurrent requests share one model.predict call
+batched_model = BatchingPredictor(model, name="genre")
+# Trace the predict function before the first real request
+registry.add_warmup("genre", lambda: batched_model.predict(np.zeros((1, 128, 128, 1), dtype=np.float32)))
+
+# Bump when preprocessing changes so cached predictions are not reused
+MODEL_VERSION = "1"
+# Bump when feature extraction changes so stored features are recomputed
+FEATURE_VERSION = "1"
 
-current_directory = os.path.dirname(os.path.abspath(__file__))
-model_path = os.path.join(current_directory, "model", "genre", "Trained_model.h5")
-model = tf.keras.models.load_model(model_path)
+# Tracks longer than this are sampled as evenly spread 30 s segments
+budget = AnalysisBudget.from_env("genre", default_max_seconds=180, segment_seconds=30)
+
+mel_params = {"n_mels": 128, "fmax": 8000, "n_fft": 2048, "hop_length": 512}
 
 classes = ['Blues', 'Classical', 'Country', 'Disco', 'Hiphop', 'Jazz', 'Metal', 'Pop', 'Reggae', 'Rock']
 
+@stage("features", "genre")
 def load_and_preprocess_data(audio_data: np.ndarray, sample_rate: int, target_shape=(128, 128)):
     data = []
     
@@ -37,46 +81,26 @@ def load_and_preprocess_data(audio_data: np.ndarray, sample_rate: int, target_sh
     chunk_samples = chunk_duration * sample_rate
     overlap_samples = overlap_duration * sample_rate
     
-    num_chunks = int(np.ceil((len(audio_data) - chunk_samples) / (chunk_samples - overlap_samples))) + 1
+    bounds = chunk_bounds(len(audio_data), chunk_samples, chunk_samples - overlap_samples)
     
-    for i in range(num_chunks):
-        start = i * (chunk_samples - overlap_samples)
-        end = start + chunk_samples
-        
-        if end > len(audio_data):
-            end = len(audio_data)
-            start = end - chunk_samples
-        
-        chunk = audio_data[start:end]
-        
-        # Enhanced feature extraction
-        mel_spectrogram = librosa.feature.melspectrogram(
-            y=chunk, 
-            sr=sample_rate,
-            n_mels=128,
-            fmax=8000,  # Limit maximum frequency
-            n_fft=2048,
-            hop_length=512
-        )
-        
-        # Apply log-scaling and normalization
-        mel_spectrogram = librosa.power_to_db(mel_spectrogram, ref=np.max)
-        mel_spectrogram = (mel_spectrogram - mel_spectrogram.mean()) / (mel_spectrogram.std() + 1e-6)
-        
-        mel_spectrogram = np.resize(mel_spectrogram, target_shape)
-        data.append(mel_spectrogram)
+    # Enhanced feature extraction, batched across chunks
+    mel_spectrograms = chunk_mel_spectrograms(audio_data, sample_rate, bounds, **mel_params)
+    
+    for mel_spectrogram in mel_spectrograms:
+        data.append(chunk_input(mel_spectrogram, target_shape))
     
     data = np.array(data)
     data = data[..., np.newaxis]
     return data
 
-def model_prediction(X_test: np.ndarray) -> list:
-    # Apply temperature scaling to soften predictions
-    temperature = 1.5
-    
-    y_pred = model.predict(X_test)
-    
-    # Apply softmax with temperature scaling
+def chunk_input(mel_spectrogram: np.ndarray, target_shape=(128, 128)) -> np.ndarray:
+    # Apply log-scaling and normalization
+    mel_spectrogram = librosa.power_to_db(mel_spectrogram, ref=np.max)
+    mel_spectrogram = (mel_spectrogram - mel_spectrogram.mean()) / (mel_spectrogram.std() + 1e-6)
+    return np.resize(mel_spectrogram, target_shape)
+
+def tempered_softmax(y_pred: np.ndarray, temperature: float = 1.5) -> list:
+    # Apply softmax with temperature scaling to soften predictions
     scaled_predictions = []
     for pred in y_pred:
         # Apply temperature scaling
@@ -85,23 +109,114 @@ def model_prediction(X_test: np.ndarray) -> list:
         exp_preds = np.exp(scaled_logits - np.max(scaled_logits))
         scaled_pred = exp_preds / exp_preds.sum()
         scaled_predictions.append(scaled_pred)
+    return scaled_predictions
+
+@stage("inference", "genre")
+def model_prediction(X_test: np.ndarray):
+    y_pred, embeddings = split_outputs(batched_model.predict(X_test))
     
     # Average predictions across chunks
-    avg_pred = np.mean(scaled_predictions, axis=0)
-    
+    top_genre, top_genres = top_genres_from(np.mean(tempered_softmax(y_pred), axis=0))
+    return top_genre, top_genres, pool_embeddings(embeddings)
+
+def top_genres_from(avg_pred: np.ndarray):
     # Get top 3 genres with adjusted probabilities
     top_indices = np.argsort(avg_pred)[-3:][::-1]
     top_genres = [(classes[i], float(avg_pred[i])) for i in top_indices]
     
-    print("Top 3 Predicted Genres:")
-    for genre, prob in top_genres:
-        print(f"{genre}: {prob:.4f}")
+    log_sampled(logger, logging.DEBUG, "Top 3 predicted genres: %s",
+                ", ".join(f"{genre}: {prob:.4f}" for genre, prob in top_genres))
     
     top_genre = top_genres[0][0]
     return top_genre, top_genres
 
+def genre_features(audio: DecodedAudio) -> np.ndarray:
+    # Chunks never straddle two sampled segments
+    return np.concatenate([
+        load_and_preprocess_data(segment.mono, segment.sample_rate) for segment in audio.segments()
+    ])
+
+def stream_genre(audio: DecodedAudio, target_shape=(128, 128)):
+    """The genre of a streamed recording, predicted one block of chunks at a time.
+
+    Uses the same chunks and normalization as load_and_preprocess_data on the
+    whole track, so a first pass over the blocks finds the peak that
+    librosa.util.normalize would divide by.
+    """
+    sr = audio.sample_rate
+    with stage("features", "genre"):
+        peak = max((np.max(np.abs(block)) for block in audio.blocks() if len(block)), default=np.float32(0))
+    # librosa.util.normalize leaves (near-)silent signals unscaled
+    if peak < np.finfo(np.float32).tiny:
+        peak = np.float32(1)
+
+    chunk_samples, step_samples = 4 * sr, 2 * sr
+    batches = stream_chunks(
+        (block / peak for block in audio.blocks()), chunk_samples, step_samples,
+        lambda num_samples: chunk_bounds(num_samples, chunk_samples, step_samples),
+    )
+    total = np.zeros(len(classes))
+    embedding_total = 0
+    count = 0
+    for y, bounds in batches:
+        checkpoint()
+        with stage("features", "genre"):
+            mel_spectrograms = chunk_mel_spectrograms(y, sr, bounds, **mel_params)
+            X = np.array([chunk_input(mel, target_shape) for mel in mel_spectrograms])[..., np.newaxis]
+        with stage("inference", "genre"):
+            y_pred, embeddings = split_outputs(batched_model.predict(X))
+            scaled_predictions = tempered_softmax(y_pred)
+        total += np.sum(scaled_predictions, axis=0)
+        if embeddings is not None:
+            embedding_total = embedding_total + np.sum(embeddings, axis=0)
+        count += len(scaled_predictions)
+    top_genre, top_genres = top_genres_from(total / count)
+    embedding = l2_normalize(embedding_total / count) if np.ndim(embedding_total) else None
+    return [top_genre, top_genres], embedding
+
+def compute_genre(audio: DecodedAudio):
+    return compute_genre_and_embedding(audio)[0]
+
+def compute_genre_and_embedding(audio: DecodedAudio):
+    """([top genre, top 3 genres], the track's embedding or None)."""
+    # Features of a whole very long recording are neither held in memory nor stored
+    if audio.is_streamed and not audio.is_excerpt:
+        return stream_genre(audio)
+    key = feature_store.make_key(
+        "genre", audio.content_hash, version=FEATURE_VERSION, sr=audio.sample_rate,
+        chunk_duration=4, overlap_duration=2, target_shape=(128, 128), **mel_params,
+    )
+    X_test = feature_store.get_or_compute(key, lambda: genre_features(audio))
+    checkpoint()
+    top_genre, top_genres, embedding = model_prediction(X_test)
+    return [top_genre, top_genres], embedding
+
+def predict_from_audio(audio: DecodedAudio, request_budget: AnalysisBudget = budget, track_url: str = None):
+    # The whole file's identity, so every budget and endpoint indexes the track under one id
+    track_id = audio.source_id or audio.content_hash
+    audio = request_budget.apply(audio)
+    key = prediction_cache.make_key("genre", audio.content_hash, model.fingerprint(MODEL_VERSION))
+    index = index_for("genre", model, MODEL_VERSION)
+    top_genre, top_genres = cached_prediction(
+        prediction_cache, key, lambda: compute_genre_and_embedding(audio), index, track_id, track_url,
+    )
+    return top_genre, top_genres
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
+
+@app.get("/ready")
+async def ready():
+    return readiness_response()
+
 class FileUrlRequest(BaseModel):
     fileUrl: str
+    max_seconds: Optional[float] = None
 
 class PredictionResponse(BaseModel):
     genre: str
@@ -113,18 +228,19 @@ async def predict_genre(request: FileUrlRequest) -> PredictionResponse:
         raise HTTPException(status_code=400, detail="No file URL provided.")
     
     try:
-        response = requests.get(request.fileUrl)
-        response.raise_for_status()
+        request_budget = budget.with_max_seconds(request.max_seconds)
+        content = await fetch_audio(request.fileUrl)
+        audio = await run_blocking(decode_audio, content, request_budget)
         
-        audio_file = BytesIO(response.content)
-        audio_data, sample_rate = librosa.load(audio_file, sr=None)
-        
-        X_test = load_and_preprocess_data(audio_data, sample_rate)
-        top_genre, top_genres = model_prediction(X_test)
+        top_genre, top_genres = await run_blocking(predict_from_audio, audio, request_budget, request.fileUrl)
         
         return PredictionResponse(genre=top_genre, top_genres=top_genres)
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
+        logger.warning("Error downloading file: %s", e)
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
\ No newline at end of file
+        logger.exception("Error processing file")
+        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+
+app.include_router(similarity_router("genre", model, MODEL_VERSION))
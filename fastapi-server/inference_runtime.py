@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import resources
+from telemetry import get_logger
+
+logger = get_logger("runtime")
+
+runtimes = ("keras", "tflite", "onnx")
+quantizations = ("none", "float16", "dynamic", "int8")
+
+# "keras" serves the .h5 models as trained; "tflite" or "onnx" serve the files
+# export_models.py writes next to them. MOZARTIFY_<GROUP>_RUNTIME (e.g.
+# MOZARTIFY_GENRE_RUNTIME) overrides it for one service's models.
+default_runtime = os.environ.get("MOZARTIFY_RUNTIME", "keras")
+# Which export to serve: float32 ("none"), float16 weights, int8 weights
+# ("dynamic") or int8 weights and activations ("int8")
+default_quantization = os.environ.get("MOZARTIFY_QUANTIZATION", "none")
+# Threads per optimized model; defaults to the service's inference thread budget
+runtime_threads = int(os.environ.get("MOZARTIFY_RUNTIME_THREADS", "0")) or resources.inference_threads
+
+
+def runtime_for(group: str):
+    """(runtime, quantization) configured for a group of models, e.g. "genre" or "emotion"."""
+    prefix = f"MOZARTIFY_{group.upper()}_"
+    return (
+        os.environ.get(prefix + "RUNTIME", default_runtime),
+        os.environ.get(prefix + "QUANTIZATION", default_quantization),
+    )
+
+
+def exported_path(keras_path: str, runtime: str, quantization: str = "none") -> str:
+    # model/genre/Trained_model.h5 -> model/genre/Trained_model.int8.tflite
+    base, _ = os.path.splitext(keras_path)
+    suffix = "" if quantization == "none" else f".{quantization}"
+    return f"{base}{suffix}.{runtime}"
+
+
+def parity_report_path(path: str) -> str:
+    return path + ".parity.json"
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def serving_path(keras_path: str, group: str) -> str:
+    """The model file to serve in place of keras_path under the configured runtime.
+
+    An export is only served while its parity report, written by
+    export_models.py, says it passed against this exact .h5 and export;
+    otherwise the .h5 is served and the reason logged.
+    """
+    runtime, quantization = runtime_for(group)
+    if runtime == "keras":
+        return keras_path
+    if runtime not in runtimes or quantization not in quantizations:
+        logger.error("Unknown runtime %s/%s for %s, serving %s", runtime, quantization, group, keras_path)
+        return keras_path
+
+    path = exported_path(keras_path, runtime, quantization)
+    try:
+        with open(parity_report_path(path)) as f:
+            report = json.load(f)
+        current = {"source": file_digest(keras_path), "exported": file_digest(path)}
+    except (OSError, ValueError) as e:
+        logger.warning("No usable export at %s (%s), serving %s", path, e, keras_path)
+        return keras_path
+    if not report.get("passed"):
+        logger.error("%s failed its parity check, serving %s", path, keras_path)
+        return keras_path
+    if any(report.get(key) != digest for key, digest in current.items()):
+        logger.error("Parity report for %s is stale, re-run export_models.py; serving %s", path, keras_path)
+        return keras_path
+    return path
+
+
+def serving_loader(keras_loader):
+    """Wrap a service's Keras loader so it also loads exported .tflite and .onnx files."""
+    def load(path):
+        if path.endswith(".tflite"):
+            return TFLiteModel(path)
+        if path.endswith(".onnx"):
+            return OnnxModel(path)
+        return keras_loader(path)
+    return load
+
+
+class OptimizedModel:
+    """An exported single-input, single-output model with Keras' predict() and input_shape."""
+
+    input_shape = None
+
+    def predict(self, x, verbose=0) -> np.ndarray:
+        raise NotImplementedError
+
+
+def _tflite_interpreter():
+    # The standalone interpreters avoid loading TensorFlow at all
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    import tensorflow as tf
+    return tf.lite.Interpreter
+
+
+class TFLiteModel(OptimizedModel):
+    """A .tflite model run by the TFLite interpreter, which uses XNNPACK on CPU by default.
+
+    The batch dimension is resized in powers of two, padding the rows in
+    between, so varying batch sizes do not reallocate on every call.
+    """
+
+    def __init__(self, path: str, num_threads: int = runtime_threads):
+        self.path = path
+        self._interpreter = _tflite_interpreter()(model_path=path, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self.input_shape = (None,) + tuple(int(n) for n in self._input["shape"][1:])
+        self._batch = None
+        # An interpreter must not be invoked from two threads at once
+        self._lock = threading.Lock()
+
+    def predict(self, x, verbose=0) -> np.ndarray:
+        x = np.asarray(x, dtype=np.float32)
+        rows = len(x)
+        batch = 1 << max(0, rows - 1).bit_length()
+        if batch != rows:
+            x = np.concatenate([x, np.zeros((batch - rows,) + x.shape[1:], dtype=np.float32)])
+        with self._lock:
+            if self._batch != batch:
+                self._interpreter.resize_tensor_input(self._input["index"], [batch, *self.input_shape[1:]])
+                self._interpreter.allocate_tensors()
+                self._batch = batch
+            self._interpreter.set_tensor(self._input["index"], x)
+            self._interpreter.invoke()
+            output = self._interpreter.get_output_details()[0]
+            return self._interpreter.get_tensor(output["index"])[:rows].copy()
+
+
+class OnnxModel(OptimizedModel):
+    """An .onnx model run by ONNX Runtime's CPU execution provider."""
+
+    def __init__(self, path: str, num_threads: int = runtime_threads):
+        import onnxruntime as ort
+
+        self.path = path
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self._session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        model_input = self._session.get_inputs()[0]
+        self._input_name = model_input.name
+        self.input_shape = (None,) + tuple(model_input.shape[1:])
+
+    def predict(self, x, verbose=0) -> np.ndarray:
+        return self._session.run(None, {self._input_name: np.asarray(x, dtype=np.float32)})[0]
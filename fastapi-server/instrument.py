@@ -1,28 +1,40 @@
+import resources  # sets the BLAS thread limits, so before numpy
 import numpy as np
 import librosa
-import torch
-import openunmix
-import torchaudio
-import tensorflow as tf
-from skimage.transform import resize
+import threading
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import requests
-from io import BytesIO
+import httpx
 from fastapi.middleware.cors import CORSMiddleware
-from concurrent.futures import ProcessPoolExecutor
-import functools
-from starlette.requests import Request
-from starlette.middleware.base import BaseHTTPMiddleware
-import asyncio
-import tempfile
 import warnings
 import os
+from typing import Optional
+from audio_loader import DecodedAudio, fetch_audio, decode_audio, close_http_client
+from workers import run_blocking, get_process_pool, shutdown_process_pool, SharedArray, max_process_workers
+from prediction_cache import prediction_cache
+from feature_store import feature_store
+from model_registry import registry, model_file, startup_models, readiness_response
+from inference_runtime import serving_path, serving_loader
+from batching import BatchingPredictor
+from embeddings import with_embedding_output, split_outputs, pool_embeddings, index_for, cached_prediction, similarity_router
+from spectral import chunk_bounds
+from instrument_features import process_shared_chunks
+from budget import AnalysisBudget
+from telemetry import TelemetryMiddleware, metrics_response, stage, get_logger, log_sampled
+from admission import AdmissionMiddleware, checkpoint
+import logging
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Reduce TensorFlow logging
 warnings.filterwarnings('ignore', category=DeprecationWarning)
 warnings.filterwarnings('ignore', category=UserWarning)
 
+logger = get_logger("instrument")
+
 app = FastAPI()
+app.router.add_event_handler("startup", startup_models)
+app.router.add_event_handler("shutdown", close_http_client)
+app.router.add_event_handler("shutdown", shutdown_process_pool)
+
+app.add_middleware(AdmissionMiddleware, paths=("/predict-instrument",))
 
 # Add CORS middleware to allow requests from frontend
 app.add_middleware(
@@ -32,27 +44,53 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-# # Timeout Middleware
-# class TimeoutMiddleware(BaseHTTPMiddleware):
-#     async def dispatch(self, request: Request, call_next):
-#         try:
-#             response = await asyncio.wait_for(call_next(request), timeout=60.0)  # 30 seconds timeout
-#             return response
-#         except asyncio.TimeoutError:
-#             raise HTTPException(status_code=504, detail="Request timeout")
-
-# app.add_middleware(TimeoutMiddleware)
+app.add_middleware(TelemetryMiddleware)
 
 # When loading the model, add compilation
-@functools.lru_cache(maxsize=1)
 def load_model(model_path):
-    model = tf.keras.models.load_model(model_path)
+    # TensorFlow is imported by the loader so the server can start before it is
+    resources.configure_tensorflow()
+    import tensorflow as tf
+    # The second output is each chunk's penultimate-layer embedding, for /similar
+    model = with_embedding_output(tf.keras.models.load_model(model_path), "instrument")
     model.compile()  # Add this line to resolve the compilation warning
     return model
 
-# Load the pre-trained model
-model = load_model("C:/Users/ADMIN/OneDrive/Documents/GitHub/mozartify/fastapi-server/model/instrument/Trained_model.h5")
+# Load the pre-trained model once; the registry reloads it if the file changes
+model = registry.register(
+    "instrument", serving_path(model_file("instrument", "Trained_model.h5"), "instrument"), serving_loader(load_model)
+)
+# Chunks from concurrent requests share one model.predict call
+batched_model = BatchingPredictor(model, name="instrument")
+
+# Bump when preprocessing or separation changes so cached predictions are not reused
+MODEL_VERSION = "2"
+# Bump when separation or feature extraction changes so stored features are recomputed
+FEATURE_VERSION = "1"
+
+# The stem the pipeline has always used: estimates[0, 1] of the full umxl separator
+accompaniment_target = "drums"
+
+# Built once, with only the stem we consume; umxl() reloads its weights on every call.
+# torch and Open-Unmix are imported when it is first needed.
+_separator = None
+_separator_lock = threading.Lock()
+
+def get_separator():
+    global _separator
+    with _separator_lock:
+        if _separator is None:
+            from separation import StemSeparator
+            _separator = StemSeparator(targets=(accompaniment_target,))
+        return _separator
+
+# Trace the model and load the separator weights before the first real request
+registry.add_warmup("instrument", lambda: batched_model.predict(np.zeros((1, 128, 128, 1), dtype=np.float32)))
+registry.add_warmup("separator", lambda: get_separator().separate(np.zeros((2, 44100), dtype=np.float32), 44100))
+
+# Off by default: without a budget only the first 60 s are separated, as before.
+# With one, 12 s segments (five 4 s chunks) are separated across the whole track.
+budget = AnalysisBudget.from_env("instrument", default_max_seconds=None, segment_seconds=12)
 
 # Define instrument classes
 classes = [
@@ -62,85 +100,51 @@ classes = [
     'Tambourine', 'Trombone', 'Trumpet', 'Ukulele', 'Vibraphone', 'Violin'
 ]
 
-# Chunk Processing Function
-def process_chunk(chunk_data, sample_rate, target_shape):
-    mel_spectrogram = librosa.feature.melspectrogram(y=chunk_data, sr=sample_rate)
-    mel_spectrogram = librosa.power_to_db(mel_spectrogram, ref=np.max)
-    mel_spectrogram = resize(np.expand_dims(mel_spectrogram, axis=-1), target_shape)
-    return mel_spectrogram
-
+@stage("features", "instrument")
 def load_and_preprocess_data_parallel(audio_data, sample_rate, target_shape=(128, 128), max_chunks=5):
-    print("Preprocessing audio data...")
     chunk_duration = 4  # seconds
     overlap_duration = 2  # seconds
 
     chunk_samples = chunk_duration * sample_rate
     overlap_samples = overlap_duration * sample_rate
 
-    num_chunks = min(int(np.ceil((len(audio_data) - chunk_samples) / (chunk_samples - overlap_samples))) + 1, max_chunks)
+    bounds = chunk_bounds(len(audio_data), chunk_samples, chunk_samples - overlap_samples, max_chunks)
 
-    chunks = []
-    with ProcessPoolExecutor() as executor:
+    # The pool outlives the request; workers read the audio from shared memory
+    executor = get_process_pool()
+    with SharedArray(np.ascontiguousarray(audio_data, dtype=np.float32)) as shared_audio:
         chunk_futures = []
-        for i in range(num_chunks):
-            start = i * (chunk_samples - overlap_samples)
-            end = start + chunk_samples
-
-            if end > len(audio_data):
-                end = len(audio_data)
-                start = end - chunk_samples
-
-            chunk_data = audio_data[start:end]
-            chunk_futures.append(executor.submit(process_chunk, chunk_data, sample_rate, target_shape))
+        for group in np.array_split(np.arange(len(bounds)), min(len(bounds), max_process_workers)):
+            group_bounds = [bounds[i] for i in group]
+            chunk_futures.append(executor.submit(
+                process_shared_chunks, shared_audio.spec, sample_rate, group_bounds, target_shape
+            ))
 
-        chunks = [future.result() for future in chunk_futures]
+        chunks = [chunk for future in chunk_futures for chunk in future.result()]
 
-    print(f"Extracted {len(chunks)} chunks with shape {chunks[0].shape}")
+    log_sampled(logger, logging.DEBUG, "Extracted %d chunks with shape %s", len(chunks), chunks[0].shape)
     return np.array(chunks)
 
-def separate_audio(audio_content: BytesIO, max_duration=60):
-    print("Starting audio separation...")
-    separator = openunmix.umxl()
-
-    try:
-        # Load only a portion of the audio to reduce processing time
-        audio, sample_rate = torchaudio.load(audio_content)
-        
-        # Trim audio to max_duration if necessary
-        if audio.shape[1] > max_duration * sample_rate:
-            audio = audio[:, :int(max_duration * sample_rate)]
-        
-        print(f"Audio loaded with shape {audio.shape} and sample rate {sample_rate}")
-    except Exception as e:
-        print(f"Error loading audio file: {e}")
-        return None
-
-    if audio.dim() == 1:
-        audio = audio.unsqueeze(0).unsqueeze(0)
-    elif audio.dim() == 2:
-        audio = audio.unsqueeze(0)
+@stage("separation", "instrument")
+def separate_audio(decoded: DecodedAudio, max_duration=60):
+    # Use only a portion of the audio to reduce processing time
+    sample_rate = decoded.sample_rate
+    audio = decoded.head(max_duration).waveform
 
-    with torch.no_grad():
-        estimates = separator(audio)
-    print("Separation complete.")
+    stems = get_separator().separate(audio, sample_rate)
 
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmpfile:
-            torchaudio.save(tmpfile.name, estimates[0, 1], sample_rate)
-            print(f"Accompaniment saved to {tmpfile.name}")
-            return tmpfile.name
-    except Exception as e:
-        print(f"Error saving accompaniment to file: {e}")
-        return None
+    # Down-mix in memory, as loading the saved stem with librosa used to
+    return librosa.to_mono(stems[accompaniment_target])
 
+@stage("inference", "instrument")
 def model_prediction(chunks):
-    print(f"Input shape to model: {chunks.shape}")
-    y_pred = model.predict(chunks)
-    return y_pred
+    # (class probabilities, chunk embeddings or None) per chunk
+    return split_outputs(batched_model.predict(chunks))
 
 # Request and Response Models
 class FileUrlRequest(BaseModel):
     fileUrl: str
+    max_seconds: Optional[float] = None
 
 class PredictionResponse(BaseModel):
     top_instruments: str
@@ -152,51 +156,89 @@ def list_top_instruments(y_pred, classes, top_n=6):
     instrument_probabilities = [(classes[i], mean_probabilities[i]) for i in range(len(classes))]
     sorted_instruments = sorted(instrument_probabilities, key=lambda x: x[1], reverse=True)
     
-    print("Top instruments with probabilities:", sorted_instruments[:top_n])
+    log_sampled(logger, logging.DEBUG, "Top instruments with probabilities: %s", sorted_instruments[:top_n])
 
     top_instruments = [instrument for instrument, _ in sorted_instruments[:top_n]]
     top_instruments = ", ".join(top_instruments)
     
     return top_instruments
 
+def predict_from_audio(decoded: DecodedAudio, request_budget: AnalysisBudget = budget, track_url: str = None):
+    track_id = decoded.source_id or decoded.content_hash
+    decoded = request_budget.apply(decoded)
+    key = prediction_cache.make_key("instrument", decoded.content_hash, model.fingerprint(MODEL_VERSION))
+    index = index_for("instrument", model, MODEL_VERSION)
+    return cached_prediction(
+        prediction_cache, key, lambda: compute_instruments_and_embedding(decoded), index, track_id, track_url,
+    )
+
+def instrument_features(decoded: DecodedAudio, max_chunks: int) -> np.ndarray:
+    chunks = []
+    for segment in decoded.segments():
+        checkpoint()
+        audio_data = separate_audio(segment)
+        checkpoint()
+
+        # Process the accompaniment audio to get features and predictions
+        chunks.append(load_and_preprocess_data_parallel(audio_data, decoded.sample_rate, max_chunks=max_chunks))
+    return np.concatenate(chunks)
+
+def compute_top_instruments(decoded: DecodedAudio):
+    return compute_instruments_and_embedding(decoded)[0]
+
+def compute_instruments_and_embedding(decoded: DecodedAudio):
+    # Spread the usual five chunks over the sampled segments
+    max_chunks = max(1, 5 // len(decoded.segment_bounds or [None]))
+
+    # Separation dominates the cost, so the separated chunk features are what is stored
+    key = feature_store.make_key(
+        "instrument", decoded.content_hash, version=FEATURE_VERSION, sr=decoded.sample_rate,
+        target=accompaniment_target, max_duration=60, max_chunks=max_chunks, target_shape=(128, 128),
+    )
+    chunks = feature_store.get_or_compute(key, lambda: instrument_features(decoded, max_chunks))
+    checkpoint()
+    y_pred, embeddings = model_prediction(chunks)
+    top_instruments = list_top_instruments(y_pred, classes)
+    logger.info("Top instruments: %s", top_instruments)
+    return top_instruments, pool_embeddings(embeddings)
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
+
+@app.get("/ready")
+async def ready():
+    return readiness_response()
+
 @app.post("/predict-instrument", response_model=PredictionResponse)
 async def process_audio_from_url(request: FileUrlRequest):
-    print("Received file URL:", request.fileUrl)
     if not request.fileUrl:
         raise HTTPException(status_code=400, detail="No file URL provided.")
     
     try:
         # Download the file from Firebase URL
-        response = requests.get(request.fileUrl)
-        response.raise_for_status()
-
-        # Use BytesIO to simulate a file-like object for librosa
-        audio_file = BytesIO(response.content)
+        content = await fetch_audio(request.fileUrl)
         
         # Process the audio
-        print("Processing audio file...")
-        accompaniment_file = separate_audio(audio_file)
-
-        if accompaniment_file is not None:
-            # Preprocess the audio content
-            audio_data, sample_rate = librosa.load(accompaniment_file, sr=None)
-            print(f"Audio loaded with shape {audio_data.shape} and sample rate {sample_rate}")
-
-            # Process the accompaniment audio to get features and predictions
-            chunks = load_and_preprocess_data_parallel(audio_data, sample_rate)
-            y_pred = model_prediction(chunks)
-            top_instruments = list_top_instruments(y_pred, classes)
-            print("Top instruments:", top_instruments)
-            return PredictionResponse(top_instruments=top_instruments)
-        else:
-            raise HTTPException(status_code=500, detail="Audio separation failed")
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading file: {str(e)}")
+        request_budget = budget.with_max_seconds(request.max_seconds)
+        audio = await run_blocking(decode_audio, content, request_budget)
+        top_instruments = await run_blocking(predict_from_audio, audio, request_budget, request.fileUrl)
+        return PredictionResponse(top_instruments=top_instruments)
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
+        logger.warning("Error downloading file: %s", e)
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
     except Exception as e:
-        print(f"Error processing file: {str(e)}")
+        logger.exception("Error processing file")
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
+app.include_router(similarity_router("instrument", model, MODEL_VERSION))
+
 # For running the server
 if __name__ == "__main__":
     import uvicorn
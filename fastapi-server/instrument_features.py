@@ -0,0 +1,25 @@
+import numpy as np
+import librosa
+from skimage.transform import resize
+from spectral import chunk_mel_spectrograms
+from workers import attach_shared_array
+
+# Kept free of TensorFlow and torch imports so process-pool workers start quickly
+
+
+def process_chunks(audio_data, sample_rate, bounds, target_shape):
+    features = []
+    for mel_spectrogram in chunk_mel_spectrograms(audio_data, sample_rate, bounds):
+        mel_spectrogram = librosa.power_to_db(mel_spectrogram, ref=np.max)
+        features.append(resize(np.expand_dims(mel_spectrogram, axis=-1), target_shape))
+    return features
+
+
+def process_shared_chunks(audio_spec, sample_rate, bounds, target_shape):
+    # Reads the accompaniment from shared memory instead of a pickled copy
+    shm, audio_data = attach_shared_array(audio_spec)
+    try:
+        return process_chunks(audio_data, sample_rate, bounds, target_shape)
+    finally:
+        del audio_data
+        shm.close()
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+default_job_db_path = os.path.join(current_directory, "data", "jobs.sqlite3")
+
+# Items interrupted this many times (e.g. by crashes mid-track) are failed instead of retried
+max_attempts = 3
+
+
+class JobStore:
+    """Bulk tagging jobs and their per-track items, persisted in SQLite.
+
+    Items move pending -> running -> done/failed. Finished items get an
+    increasing completed_order within their job, so progress can be streamed
+    in completion order. Items still running when the process stopped are
+    returned to pending by requeue_interrupted().
+    """
+
+    def __init__(self, path: str = default_job_db_path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, options TEXT NOT NULL, created_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS job_items ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, file_url TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, "
+            "completed_order INTEGER, updated_at REAL NOT NULL, PRIMARY KEY (job_id, idx));"
+            "CREATE INDEX IF NOT EXISTS job_items_status ON job_items (status);"
+            "CREATE INDEX IF NOT EXISTS job_items_completed ON job_items (job_id, completed_order);"
+        )
+        self._conn.commit()
+
+    def create_job(self, file_urls: list, options: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, options, created_at) VALUES (?, ?, ?)",
+                (job_id, json.dumps(options), now),
+            )
+            self._conn.executemany(
+                "INSERT INTO job_items (job_id, idx, file_url, status, updated_at) VALUES (?, ?, ?, 'pending', ?)",
+                [(job_id, idx, file_url, now) for idx, file_url in enumerate(file_urls)],
+            )
+            self._conn.commit()
+        return job_id
+
+    def claim_next(self):
+        """Mark the oldest pending item running and return it with its job's options, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT i.job_id, i.idx, i.file_url, i.attempts, j.options FROM job_items i "
+                "JOIN jobs j ON j.id = i.job_id WHERE i.status = 'pending' "
+                "ORDER BY j.created_at, i.idx LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE job_items SET status = 'running', attempts = attempts + 1, updated_at = ? "
+                "WHERE job_id = ? AND idx = ?",
+                (time.time(), row["job_id"], row["idx"]),
+            )
+            self._conn.commit()
+        return {
+            "job_id": row["job_id"],
+            "idx": row["idx"],
+            "file_url": row["file_url"],
+            "options": json.loads(row["options"]),
+        }
+
+    def finish_item(self, job_id: str, idx: int, result=None, error: str = None):
+        with self._lock:
+            self._finish(job_id, idx, result, error)
+            self._conn.commit()
+
+    def _finish(self, job_id: str, idx: int, result, error):
+        self._conn.execute(
+            "UPDATE job_items SET status = ?, result = ?, error = ?, updated_at = ?, "
+            "completed_order = (SELECT COALESCE(MAX(completed_order), 0) + 1 FROM job_items WHERE job_id = ?) "
+            "WHERE job_id = ? AND idx = ?",
+            (
+                "failed" if error is not None else "done",
+                json.dumps(result) if result is not None else None,
+                error,
+                time.time(),
+                job_id, job_id, idx,
+            ),
+        )
+
+    def requeue_interrupted(self) -> int:
+        """Return items left running by a previous process to the queue; completed items are kept."""
+        with self._lock:
+            exhausted = self._conn.execute(
+                "SELECT job_id, idx FROM job_items WHERE status = 'running' AND attempts >= ?", (max_attempts,)
+            ).fetchall()
+            for row in exhausted:
+                self._finish(row["job_id"], row["idx"], None, "Interrupted too many times")
+            requeued = self._conn.execute(
+                "UPDATE job_items SET status = 'pending', updated_at = ? WHERE status = 'running'", (time.time(),)
+            ).rowcount
+            self._conn.commit()
+        return requeued
+
+    def get_job(self, job_id: str):
+        with self._lock:
+            job = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+        total = sum(counts.values())
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        return {
+            "job_id": job_id,
+            "status": "completed" if finished == total else ("running" if finished or counts.get("running") else "pending"),
+            "options": json.loads(job["options"]),
+            "created_at": job["created_at"],
+            "total": total,
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+        }
+
+    def finished_items(self, job_id: str, after: int = 0, limit: int = 1000) -> list:
+        """Finished items in completion order, starting after the given completed_order."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, file_url, status, result, error, completed_order FROM job_items "
+                "WHERE job_id = ? AND completed_order > ? ORDER BY completed_order LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [
+            {
+                "index": row["idx"],
+                "fileUrl": row["file_url"],
+                "status": row["status"],
+                "result": json.loads(row["result"]) if row["result"] is not None else None,
+                "error": row["error"],
+                "completed_order": row["completed_order"],
+            }
+            for row in rows
+        ]
+
+
+job_store = JobStore(os.environ.get("MOZARTIFY_JOB_DB_PATH", default_job_db_path))
@@ -0,0 +1,82 @@
+import os
+import asyncio
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from job_store import JobStore
+from workers import max_workers
+from telemetry import Gauge, get_logger
+
+logger = get_logger("jobs")
+
+_runners = []
+
+# Tracks analysed at once; CPU work is still bounded by the shared thread pool
+default_job_concurrency = int(os.environ.get("MOZARTIFY_JOB_WORKERS", str(max_workers)))
+# How often idle workers look for new items when nobody has signalled them
+poll_interval = 1.0
+
+
+class JobRunner:
+    """Asyncio workers that drain a JobStore through process_item(file_url, options).
+
+    Downloads overlap with other tracks' analysis, so a backfill keeps the
+    CPU busy instead of waiting on one request at a time.
+    """
+
+    def __init__(self, store: JobStore, process_item, concurrency: int = default_job_concurrency):
+        self.store = store
+        self.process_item = process_item
+        self.concurrency = concurrency
+        self.active = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        _runners.append(self)
+
+    async def start(self):
+        requeued = await run_in_threadpool(self.store.requeue_interrupted)
+        if requeued:
+            logger.info("Resuming %d interrupted job items", requeued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        # Cancelled items stay running in the store and are requeued on the next start
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            # SQLite calls run off the event loop, which also serves /analyze
+            item = await run_in_threadpool(self.store.claim_next)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.active += 1
+            try:
+                result = await self.process_item(item["file_url"], item["options"])
+            except asyncio.CancelledError:
+                raise
+            except HTTPException as e:
+                await run_in_threadpool(self.store.finish_item, item["job_id"], item["idx"], error=str(e.detail))
+            except Exception as e:
+                logger.exception("Job item %s/%d failed", item["job_id"], item["idx"])
+                await run_in_threadpool(self.store.finish_item, item["job_id"], item["idx"], error=str(e))
+            else:
+                await run_in_threadpool(self.store.finish_item, item["job_id"], item["idx"], result=result)
+            finally:
+                self.active -= 1
+
+
+Gauge(
+    "mozartify_job_items_active", "Job items currently being analysed.",
+    collect=lambda: [({}, sum(runner.active for runner in _runners))],
+)
@@ -0,0 +1,214 @@
+import os
+import time
+import pickle
+import threading
+import numpy as np
+from fastapi.responses import JSONResponse
+from prediction_cache import model_fingerprint
+from inference_runtime import OptimizedModel
+from resources import log_configuration
+from telemetry import Gauge, get_logger, process_uptime
+
+logger = get_logger("models")
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+model_dir = os.environ.get("MOZARTIFY_MODEL_DIR", os.path.join(current_directory, "model"))
+# "background" (default) loads and warms models after the server starts and
+# reports readiness on /ready; "eager" loads them while the module is imported
+startup_mode = os.environ.get("MOZARTIFY_STARTUP_MODE", "background")
+
+
+def model_file(*parts) -> str:
+    return os.path.join(model_dir, *parts)
+
+
+def model_memory_bytes(model) -> int:
+    # Keras models by their weights, exported ones by their file, anything else (e.g. sklearn) by its pickled size
+    if isinstance(model, OptimizedModel):
+        return os.path.getsize(model.path)
+    if hasattr(model, "get_weights"):
+        return int(sum(np.asarray(weights).nbytes for weights in model.get_weights()))
+    try:
+        return len(pickle.dumps(model))
+    except Exception:
+        return 0
+
+
+class ModelHandle:
+    """A resident model that is reloaded when its file on disk changes."""
+
+    def __init__(self, name: str, path: str, loader, check_interval: float = 5.0):
+        self.name = name
+        self.path = path
+        self.loader = loader
+        self.check_interval = check_interval
+        self.loaded_at = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self._model = None
+        self._stat = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _file_stat(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime
+
+    def load(self):
+        with self._lock:
+            return self._load()
+
+    def ensure_loaded(self):
+        # Callers racing the background loader wait for it instead of loading twice
+        with self._lock:
+            return self._model if self._model is not None else self._load()
+
+    def _load(self):
+        started = time.perf_counter()
+        stat = self._file_stat()
+        self._model = self.loader(self.path)
+        self._stat = stat
+        self._checked_at = time.monotonic()
+        self.loaded_at = time.time()
+        self.load_seconds = time.perf_counter() - started
+        self.memory_bytes = model_memory_bytes(self._model)
+        logger.info("Loaded model '%s' from %s in %.2fs", self.name, self.path, self.load_seconds)
+        return self._model
+
+    @property
+    def model(self):
+        if self._model is None:
+            return self.ensure_loaded()
+
+        # Stat the file at most once per check_interval
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            try:
+                changed = self._file_stat() != self._stat
+            except OSError:
+                changed = False
+            if changed:
+                logger.info("Model file for '%s' changed on disk, reloading", self.name)
+                self.load()
+        return self._model
+
+    def predict(self, *args, **kwargs):
+        return self.model.predict(*args, **kwargs)
+
+    def fingerprint(self, version: str = "1") -> str:
+        return model_fingerprint(self.path, version)
+
+    def status(self) -> dict:
+        return {
+            "path": self.path,
+            "loaded": self._model is not None,
+            "loaded_at": self.loaded_at,
+            "load_seconds": self.load_seconds,
+            "memory_bytes": self.memory_bytes,
+        }
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._handles = {}
+        self._warmups = {}
+        self._warmup_seconds = {}
+        self._loader_thread = None
+        self._lock = threading.Lock()
+        self.error = None
+        self.ready_at = None
+        self.startup_seconds = None
+
+    def register(self, name: str, path: str, loader, eager: bool = None) -> ModelHandle:
+        handle = ModelHandle(name, path, loader)
+        self._handles[name] = handle
+        if eager if eager is not None else startup_mode == "eager":
+            handle.load()
+        return handle
+
+    def add_warmup(self, name: str, func):
+        """Run func once every model is loaded, so graph tracing happens before traffic does."""
+        self._warmups[name] = func
+
+    def get(self, name: str) -> ModelHandle:
+        return self._handles[name]
+
+    def reload(self, name: str):
+        return self._handles[name].load()
+
+    def warm(self):
+        # Loads whatever is not loaded yet, then runs each warmup once
+        try:
+            for handle in list(self._handles.values()):
+                handle.ensure_loaded()
+            for name, func in list(self._warmups.items()):
+                if name in self._warmup_seconds:
+                    continue
+                started = time.perf_counter()
+                func()
+                self._warmup_seconds[name] = time.perf_counter() - started
+                logger.info("Warmed up '%s' in %.2fs", name, self._warmup_seconds[name])
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.exception("Model loading failed")
+            return
+        if self.ready_at is None:
+            self.ready_at = time.time()
+            self.startup_seconds = process_uptime()
+            logger.info("Ready %.2fs after process start", self.startup_seconds)
+
+    def start_background_loading(self):
+        # Idempotent: several apps in one process (e.g. analyze) may call it at startup
+        with self._lock:
+            if self._loader_thread is None:
+                self._loader_thread = threading.Thread(target=self.warm, name="model-loader", daemon=True)
+                self._loader_thread.start()
+
+    @property
+    def ready(self) -> bool:
+        # Models registered later (e.g. instrument, imported on demand by analyze) load on first use
+        return self.ready_at is not None
+
+    def status(self) -> dict:
+        return {name: handle.status() for name, handle in self._handles.items()}
+
+    def readiness(self) -> dict:
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "startup_seconds": self.startup_seconds,
+            "warmup_seconds": dict(self._warmup_seconds),
+            "models": self.status(),
+        }
+
+
+registry = ModelRegistry()
+
+
+async def startup_models():
+    log_configuration()
+    # Background mode lets the server accept /ready and /metrics while models load
+    if startup_mode == "eager":
+        registry.warm()
+    else:
+        registry.start_background_loading()
+
+
+def readiness_response() -> JSONResponse:
+    return JSONResponse(registry.readiness(), status_code=200 if registry.ready else 503)
+
+
+Gauge("mozartify_ready", "1 once every model is loaded and warmed up.", collect=lambda: [({}, int(registry.ready))])
+Gauge(
+    "mozartify_startup_seconds", "Seconds from process start until the service was ready.",
+    collect=lambda: [({}, registry.startup_seconds)] if registry.startup_seconds is not None else [],
+)
+
+Gauge(
+    "mozartify_model_memory_bytes", "Approximate size of each resident model.", ("model",),
+    collect=lambda: [
+        ({"model": name}, handle.memory_bytes)
+        for name, handle in list(registry._handles.items()) if handle.memory_bytes is not None
+    ],
+)
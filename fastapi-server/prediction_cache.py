@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+default_cache_path = os.path.join(current_directory, "cache", "predictions.sqlite3")
+
+
+def model_fingerprint(model_path: str, version: str = "1") -> str:
+    # A retrained model file changes size or mtime, which invalidates its entries
+    try:
+        stat = os.stat(model_path)
+        file_id = f"{os.path.basename(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        file_id = os.path.basename(model_path)
+    return f"{file_id}:v{version}"
+
+
+class PredictionCache:
+    """Prediction results keyed by decoded-audio hash, with LRU eviction in SQLite."""
+
+    def __init__(self, path: str = default_cache_path, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several services may share the same file, so wait on the lock instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(tagger: str, audio_hash: str, model_id: str, **params) -> str:
+        parts = [tagger, audio_hash, model_id] + [f"{k}={params[k]}" for k in sorted(params)]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM predictions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE predictions SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO predictions (key, value, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+            # Evict the least recently used entries beyond the size bound
+            self._conn.execute(
+                "DELETE FROM predictions WHERE key IN ("
+                "SELECT key FROM predictions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def get_or_compute(self, key: str, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM predictions")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
+
+
+prediction_cache = PredictionCache(
+    os.environ.get("MOZARTIFY_CACHE_PATH", default_cache_path),
+    int(os.environ.get("MOZARTIFY_CACHE_MAX_ENTRIES", "10000")),
+)
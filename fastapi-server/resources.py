@@ -0,0 +1,219 @@
+"""One CPU thread budget per service process.
+
+TensorFlow, torch, OpenMP/BLAS and the worker pools each size themselves to
+every core by default, so a service running several of them side by side
+ends up with many times more runnable threads than cores. This module splits
+the process's cores between them once, from MOZARTIFY_* settings:
+
+- MOZARTIFY_CPU_AFFINITY pins the process (and its pool workers) to CPUs, e.g. "0-3" or "0,2,4,6"
+- MOZARTIFY_CPUS is the cores to plan for (default: the CPUs the process may run on)
+- MOZARTIFY_MAX_CONCURRENT is the analyses admitted at once (default: min(4, cores))
+- MOZARTIFY_INTRAOP_THREADS is the intra-op pool of TensorFlow and torch (default: cores).
+  Each library has one pool per process, shared by every concurrent model call
+- MOZARTIFY_INFERENCE_THREADS is the threads of one TFLite or ONNX Runtime model, which
+  each have a pool of their own (default: cores / concurrent analyses)
+- MOZARTIFY_INTEROP_THREADS is the inter-op threads for TensorFlow and torch (default 1,
+  raised by reserve_interop_threads() for graphs with independent branches)
+- MOZARTIFY_BLAS_THREADS is the OpenMP/BLAS threads for numpy, librosa and scipy (default 1;
+  the parallelism comes from the worker pools)
+- MOZARTIFY_WORKERS and MOZARTIFY_PROCESS_WORKERS size the worker thread and process pools
+
+The BLAS limits are passed through the usual environment variables, so this
+module must be imported before numpy. Explicitly set OMP_NUM_THREADS and the
+like still win. benchmarks/thread_search.py measures which split is fastest
+for a given core count.
+"""
+import os
+import sys
+import threading
+from telemetry import Gauge, get_logger
+
+logger = get_logger("resources")
+
+
+def parse_cpus(spec: str) -> set:
+    # "0-3,6" -> {0, 1, 2, 3, 6}
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _setting(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return max(1, int(value)) if value else default
+
+
+affinity = None
+if os.environ.get("MOZARTIFY_CPU_AFFINITY") and hasattr(os, "sched_setaffinity"):
+    affinity = sorted(parse_cpus(os.environ["MOZARTIFY_CPU_AFFINITY"]))
+    # Threads started from here on, and forked pool workers, inherit the mask
+    os.sched_setaffinity(0, affinity)
+
+cores = _setting("MOZARTIFY_CPUS", _available_cpus())
+concurrency = _setting("MOZARTIFY_MAX_CONCURRENT", min(4, cores))
+intra_op_threads = _setting("MOZARTIFY_INTRAOP_THREADS", cores)
+inference_threads = _setting("MOZARTIFY_INFERENCE_THREADS", max(1, cores // concurrency))
+interop_threads = _setting("MOZARTIFY_INTEROP_THREADS", 1)
+blas_threads = _setting("MOZARTIFY_BLAS_THREADS", 1)
+worker_threads = _setting("MOZARTIFY_WORKERS", min(8, cores))
+process_workers = _setting("MOZARTIFY_PROCESS_WORKERS", cores)
+
+_native_settings = {
+    "OMP_NUM_THREADS": blas_threads,
+    "OPENBLAS_NUM_THREADS": blas_threads,
+    "MKL_NUM_THREADS": blas_threads,
+    "BLIS_NUM_THREADS": blas_threads,
+    "VECLIB_MAXIMUM_THREADS": blas_threads,
+    "NUMEXPR_NUM_THREADS": blas_threads,
+    "NUMBA_NUM_THREADS": blas_threads,
+    "TF_NUM_INTRAOP_THREADS": intra_op_threads,
+    "TF_NUM_INTEROP_THREADS": interop_threads,
+}
+for name, value in _native_settings.items():
+    os.environ.setdefault(name, str(value))
+
+_configured = set()
+_configure_lock = threading.Lock()
+
+
+def limit_native_threads():
+    """Apply the BLAS/OpenMP limit to libraries that were loaded before this module (needs threadpoolctl)."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=blas_threads)
+
+
+def reserve_interop_threads(branches: int):
+    """At least this many inter-op threads, for a graph whose branches should run concurrently.
+
+    Call before configure_tensorflow().
+    """
+    global interop_threads
+    if branches <= interop_threads:
+        return
+    if "tensorflow" in _configured:
+        logger.warning("Inter-op threads raised to %d after TensorFlow was configured", branches)
+    # Unless the operator set the variable themselves
+    if os.environ.get("TF_NUM_INTEROP_THREADS") == str(interop_threads):
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(branches)
+    interop_threads = branches
+    _native_settings["TF_NUM_INTEROP_THREADS"] = branches
+
+
+def configure_tensorflow():
+    """Give TensorFlow its share; call before the first model is loaded."""
+    with _configure_lock:
+        if "tensorflow" in _configured:
+            return
+        import tensorflow as tf
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(interop_threads)
+        except RuntimeError as e:
+            # Only possible before TensorFlow's runtime starts; the environment variables still applied
+            logger.warning("TensorFlow thread settings not applied: %s", e)
+        logger.info(
+            "TensorFlow threads: intra-op %d, inter-op %d",
+            tf.config.threading.get_intra_op_parallelism_threads(),
+            tf.config.threading.get_inter_op_parallelism_threads(),
+        )
+        _configured.add("tensorflow")
+
+
+def configure_torch():
+    with _configure_lock:
+        if "torch" in _configured:
+            return
+        import torch
+        torch.set_num_threads(intra_op_threads)
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logger.warning("torch inter-op threads not applied: %s", e)
+        logger.info("torch threads: intra-op %d, inter-op %d", torch.get_num_threads(), torch.get_num_interop_threads())
+        _configured.add("torch")
+
+
+def init_worker_process():
+    """ProcessPoolExecutor initializer: pool workers run single-threaded native code."""
+    limit_native_threads()
+
+
+def configuration() -> dict:
+    """The effective thread budget, including what the native libraries actually report."""
+    config = {
+        "cores": cores,
+        "affinity": affinity,
+        "concurrency": concurrency,
+        "intra_op_threads": intra_op_threads,
+        "inference_threads": inference_threads,
+        "interop_threads": interop_threads,
+        "blas_threads": blas_threads,
+        "worker_threads": worker_threads,
+        "process_workers": process_workers,
+        "environment": {name: os.environ.get(name) for name in _native_settings},
+    }
+    try:
+        from threadpoolctl import threadpool_info
+        config["native_pools"] = [
+            {"library": pool["internal_api"], "threads": pool["num_threads"]} for pool in threadpool_info()
+        ]
+    except ImportError:
+        pass
+    # Only once configure_*() ran: a model may still be importing the library on the loader thread
+    if "tensorflow" in _configured:
+        tf = sys.modules["tensorflow"]
+        config["tensorflow"] = {
+            "intra_op": tf.config.threading.get_intra_op_parallelism_threads(),
+            "inter_op": tf.config.threading.get_inter_op_parallelism_threads(),
+        }
+    if "torch" in _configured:
+        torch = sys.modules["torch"]
+        config["torch"] = {"intra_op": torch.get_num_threads(), "inter_op": torch.get_num_interop_threads()}
+    return config
+
+
+def log_configuration():
+    config = configuration()
+    logger.info(
+        "CPU budget: %d cores%s, %d concurrent analyses, intra-op %d (inter-op %d), %d threads per "
+        "exported model, BLAS %d, %d worker threads, %d process workers",
+        cores, f" pinned to {affinity}" if affinity else "", concurrency, intra_op_threads, interop_threads,
+        inference_threads, blas_threads, worker_threads, process_workers,
+    )
+    if "native_pools" in config:
+        logger.info("Native thread pools: %s", config["native_pools"])
+    # Settings the operator overrode in the environment rather than through MOZARTIFY_*
+    overridden = {
+        name: value for name, value in config["environment"].items() if value != str(_native_settings[name])
+    }
+    if overridden:
+        logger.warning("Thread settings taken from the environment instead of the budget: %s", overridden)
+
+
+Gauge(
+    "mozartify_thread_budget", "Threads (or processes) the CPU budget gives each consumer.", ("pool",),
+    collect=lambda: [({"pool": pool}, value) for pool, value in (
+        ("cores", cores), ("concurrency", concurrency), ("intra_op", intra_op_threads),
+        ("inference", inference_threads),
+        ("interop", interop_threads), ("blas", blas_threads), ("workers", worker_threads),
+        ("process_workers", process_workers),
+    )],
+)
+
+# numpy may have been imported before this module, e.g. by a test harness
+limit_native_threads()
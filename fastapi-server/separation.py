@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import torch
+import openunmix
+from resources import configure_torch
+
+configure_torch()
+
+window_seconds = float(os.environ.get("MOZARTIFY_SEPARATION_WINDOW_SECONDS", "20"))
+overlap_seconds = float(os.environ.get("MOZARTIFY_SEPARATION_OVERLAP_SECONDS", "1"))
+
+
+class StemSeparator:
+    """Open-Unmix separation that only estimates the stems a caller consumes.
+
+    Only the requested target networks are built; everything else is folded
+    into a residual source for the Wiener filter. Audio is separated in
+    overlapping windows that are cross-faded back together, so the
+    separator's working memory depends on the window length, not the track.
+    """
+
+    def __init__(self, targets=("drums",), window_seconds: float = window_seconds,
+                 overlap_seconds: float = overlap_seconds):
+        self.targets = list(targets)
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.separator = openunmix.umxl(targets=self.targets, residual=True)
+        self.separator.eval()
+
+    def separate(self, waveform: np.ndarray, sample_rate: int) -> dict:
+        """Return {target: (channels, samples) float32 array} for a (channels, samples) waveform."""
+        # The umxl networks are stereo-only
+        if waveform.shape[0] == 1:
+            waveform = np.repeat(waveform, 2, axis=0)
+        num_samples = waveform.shape[1]
+        window = max(int(self.window_seconds * sample_rate), 1)
+        overlap = min(int(self.overlap_seconds * sample_rate), window // 2)
+        step = window - overlap
+
+        stems = {target: np.zeros(waveform.shape, dtype=np.float32) for target in self.targets}
+        for start in range(0, max(num_samples - overlap, 1), step):
+            end = min(start + window, num_samples)
+            segment = torch.from_numpy(np.ascontiguousarray(waveform[:, start:end], dtype=np.float32))
+            with torch.no_grad():
+                estimates = self.separator(segment.unsqueeze(0))[0].numpy()
+
+            fade = self._crossfade(end - start, overlap, fade_in=start > 0, fade_out=end < num_samples)
+            for k, target in enumerate(self.targets):
+                stems[target][:, start:end] += estimates[k] * fade
+        return stems
+
+    @staticmethod
+    def _crossfade(length: int, overlap: int, fade_in: bool, fade_out: bool) -> np.ndarray:
+        # Linear ramps over the overlap; neighbouring windows' ramps sum to one
+        fade = np.ones(length, dtype=np.float32)
+        if overlap > 0:
+            ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+            if fade_in:
+                fade[:overlap] *= ramp
+            if fade_out:
+                fade[-overlap:] *= ramp[::-1]
+        return fade
@@ -0,0 +1,111 @@
+import itertools
+import numpy as np
+import librosa
+
+
+class Spectrogram:
+    """STFT of a whole signal computed once, with the mel, MFCC and dB views derived from it.
+
+    Every view goes through the same librosa calls the services used before,
+    just fed the precomputed spectrogram instead of the raw signal.
+    """
+
+    def __init__(self, y: np.ndarray, sr: int, n_fft: int = 2048, hop_length: int = 512):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.magnitude = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+        self._power = None
+        self._mel = {}
+
+    @property
+    def power(self) -> np.ndarray:
+        if self._power is None:
+            self._power = self.magnitude ** 2
+        return self._power
+
+    def stft_db(self) -> np.ndarray:
+        return librosa.amplitude_to_db(self.magnitude)
+
+    def mel(self, n_mels: int = 128, fmin: float = 0.0, fmax=None) -> np.ndarray:
+        key = (n_mels, fmin, fmax)
+        if key not in self._mel:
+            self._mel[key] = librosa.feature.melspectrogram(
+                S=self.power, sr=self.sr, n_fft=self.n_fft, hop_length=self.hop_length,
+                n_mels=n_mels, fmin=fmin, fmax=fmax,
+            )
+        return self._mel[key]
+
+    def mfcc(self, n_mfcc: int = 20, n_mels: int = 128) -> np.ndarray:
+        return librosa.feature.mfcc(S=librosa.power_to_db(self.mel(n_mels)), n_mfcc=n_mfcc)
+
+
+def chunk_bounds(num_samples: int, chunk_samples: int, step_samples: int, max_chunks=None) -> list:
+    # (start, end) of each overlapping chunk; the last one is pulled back to end at the track end
+    num_chunks = int(np.ceil((num_samples - chunk_samples) / step_samples)) + 1
+    if max_chunks is not None:
+        num_chunks = min(num_chunks, max_chunks)
+
+    bounds = []
+    for i in range(num_chunks):
+        start = i * step_samples
+        end = start + chunk_samples
+        if end > num_samples:
+            end = num_samples
+            start = end - chunk_samples
+        # Resolve negative starts (tracks shorter than a chunk) the way y[start:end] does
+        start, end, _ = slice(start, end).indices(num_samples)
+        bounds.append((start, end))
+    return bounds
+
+
+def chunk_mel_spectrograms(y: np.ndarray, sr: int, bounds: list, block_size: int = 16, **mel_kwargs):
+    """Yield the mel spectrogram of each y[start:end] chunk, in order.
+
+    Chunks are stacked into blocks of block_size so each block costs one batched
+    STFT and one filterbank multiply instead of a Python-level call per chunk.
+    """
+    for block_start in range(0, len(bounds), block_size):
+        chunks = [y[start:end] for start, end in bounds[block_start:block_start + block_size]]
+        # Truncated chunks at the end of a track cannot be stacked with full-length ones
+        for _, run in itertools.groupby(chunks, key=len):
+            run = list(run)
+            if len(run) == 1:
+                yield librosa.feature.melspectrogram(y=run[0], sr=sr, **mel_kwargs)
+            else:
+                yield from librosa.feature.melspectrogram(y=np.stack(run), sr=sr, **mel_kwargs)
+
+
+def stream_chunks(blocks, chunk_samples: int, step_samples: int, bounds_for_length):
+    """Yield (y, bounds) batches of chunks over a signal arriving as 1-D blocks.
+
+    The chunks are exactly bounds_for_length(total samples) over the whole
+    signal, e.g. chunk_bounds, but only about one chunk plus one block of
+    samples is held at a time. bounds_for_length must begin with the regular
+    chunks (i * step_samples, i * step_samples + chunk_samples); whatever
+    follows them (pulled-back or truncated tail chunks) is resolved once the
+    stream ends and its length is known.
+    """
+    buffer = np.zeros(0, dtype=np.float32)
+    offset = 0  # stream position of buffer[0]
+    emitted = 0
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        end = offset + len(buffer)
+        bounds = []
+        while emitted * step_samples + chunk_samples <= end:
+            start = emitted * step_samples - offset
+            bounds.append((start, start + chunk_samples))
+            emitted += 1
+        if bounds:
+            yield buffer, bounds
+        # Keep what the next regular chunk or a chunk ending at the track end could still need
+        keep_from = min(emitted * step_samples, end - chunk_samples)
+        if keep_from > offset:
+            buffer = buffer[keep_from - offset:]
+            offset = keep_from
+
+    total = offset + len(buffer)
+    tail = [(start - offset, end - offset) for start, end in bounds_for_length(total)[emitted:]]
+    if tail:
+        yield buffer, tail
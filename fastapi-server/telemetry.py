@@ -0,0 +1,300 @@
+import io
+import os
+import json
+import time
+import pstats
+import random
+import logging
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from fastapi.responses import PlainTextResponse, Response
+from starlette.middleware.base import BaseHTTPMiddleware
+
+log_level = os.environ.get("MOZARTIFY_LOG_LEVEL", "INFO").upper()
+# Fraction of per-chunk and per-prediction detail lines that are actually written
+log_sample_rate = float(os.environ.get("MOZARTIFY_LOG_SAMPLE_RATE", "0.01"))
+# ?profile=stages|cprofile is ignored unless this is set
+profiling_enabled = os.environ.get("MOZARTIFY_PROFILING", "0") == "1"
+
+_logger = logging.getLogger("mozartify")
+if not _logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _logger.addHandler(_handler)
+    _logger.setLevel(log_level)
+    _logger.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"mozartify.{name}")
+
+
+def log_sampled(logger: logging.Logger, level: int, msg: str, *args, rate: float = None):
+    # For details that would flood the log at one line per chunk or prediction
+    if logger.isEnabledFor(level) and random.random() < (log_sample_rate if rate is None else rate):
+        logger.log(level, msg, *args)
+
+
+# Prometheus text-format metrics
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_metrics = []
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, [], value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A settable value, or one read from collect() at scrape time.
+
+    collect returns (labels dict, value) pairs.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        return [
+            (self.name, tuple(str(labels.get(name, "")) for name in self.labels), [], value)
+            for labels, value in self.collect()
+        ]
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key, [("le", bound)], bucket_count))
+                samples.append((f"{self.name}_bucket", key, [("le", "+Inf")], count))
+                samples.append((f"{self.name}_sum", key, [], total))
+                samples.append((f"{self.name}_count", key, [], count))
+        return samples
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, extra, value in metric.samples():
+            lines.append(f"{name}{_format_labels(metric.labels, key, extra)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response() -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+stage_seconds = Histogram(
+    "mozartify_stage_seconds", "Time spent in each pipeline stage.", ("stage", "tagger")
+)
+request_seconds = Histogram(
+    "mozartify_request_seconds", "End-to-end request latency.", ("path", "status")
+)
+requests_in_flight = Gauge("mozartify_requests_in_flight", "Requests currently being served.")
+
+
+def _resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return [({}, int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))]
+    except (OSError, ValueError, IndexError):
+        return []
+
+
+Gauge("mozartify_process_resident_memory_bytes", "Resident memory of this process.", collect=_resident_memory)
+
+_imported_at = time.time()
+
+
+def process_uptime() -> float:
+    """Seconds since the process started, falling back to since this module was imported."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 is the start time in clock ticks after boot; the name before it may hold spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            boot_uptime = float(f.read().split()[0])
+        return boot_uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time() - _imported_at
+
+
+# Latency of the first request per route after a restart, which pays any cold-start cost
+first_request_seconds = Gauge(
+    "mozartify_first_request_seconds", "Latency of the first request to each route.", ("path",)
+)
+_first_requests = set()
+
+
+# Stage timing and request-scoped profiling
+
+_profile = contextvars.ContextVar("mozartify_profile", default=None)
+
+
+class RequestProfile:
+    """Stage timings, and optionally cProfile stats, collected for one request."""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.stages = []
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def run(self, func):
+        # cProfile only sees its own thread, so each worker call is profiled and merged
+        if self.mode != "cprofile":
+            return func()
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func)
+        finally:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+
+    def report(self, limit: int = 40) -> dict:
+        totals = {}
+        for name, tagger, seconds in self.stages:
+            key = f"{tagger}.{name}" if tagger else name
+            totals[key] = totals.get(key, 0.0) + seconds
+        report = {
+            "stages": [{"stage": name, "tagger": tagger, "seconds": seconds} for name, tagger, seconds in self.stages],
+            "totals": totals,
+        }
+        if self._stats is not None:
+            out = io.StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats("cumulative").print_stats(limit)
+            report["cprofile"] = out.getvalue()
+        return report
+
+
+@contextmanager
+def stage(name: str, tagger: str = ""):
+    """Time a block (or, as a decorator, a function) into mozartify_stage_seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stage_seconds.observe(seconds, stage=name, tagger=tagger)
+        profile = _profile.get()
+        if profile is not None:
+            profile.stages.append((name, tagger, seconds))
+
+
+def run_profiled(func):
+    # Called in worker threads, inside a copy of the request's context
+    profile = _profile.get()
+    return func() if profile is None else profile.run(func)
+
+
+class TelemetryMiddleware(BaseHTTPMiddleware):
+    """Request latency and in-flight metrics, plus the ?profile= switch."""
+
+    async def dispatch(self, request, call_next):
+        # Scrapes and readiness probes would drown out real traffic
+        if request.url.path in ("/metrics", "/ready"):
+            return await call_next(request)
+
+        mode = request.query_params.get("profile") or request.headers.get("x-mozartify-profile")
+        profile = RequestProfile(mode) if profiling_enabled and mode in ("stages", "cprofile") else None
+        token = _profile.set(profile)
+        requests_in_flight.inc()
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            requests_in_flight.dec()
+            route = request.scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            elapsed = time.perf_counter() - started
+            request_seconds.observe(elapsed, path=path, status=status)
+            if path not in _first_requests:
+                _first_requests.add(path)
+                first_request_seconds.set(elapsed, path=path)
+                _logger.info("First request to %s took %.3fs", path, elapsed)
+            _profile.reset(token)
+
+        if profile is None:
+            return response
+        return await _attach_profile(response, profile)
+
+
+async def _attach_profile(response, profile: RequestProfile):
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    report = profile.report()
+    headers = dict(response.headers)
+    headers.pop("content-length", None)
+    headers["server-timing"] = ", ".join(
+        f"{key.replace('.', '-')};dur={seconds * 1000:.1f}" for key, seconds in report["totals"].items()
+    )
+    # JSON object responses gain a "profile" key; anything else only gets the header
+    if response.headers.get("content-type", "").startswith("application/json"):
+        payload = json.loads(body)
+        if isinstance(payload, dict):
+            payload["profile"] = report
+            body = json.dumps(payload).encode()
+    return Response(body, status_code=response.status_code, headers=headers)
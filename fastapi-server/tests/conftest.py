@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+server_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, server_directory)
+
+# The modules open their stores at import time, so point them away from the real ones first
+_state_directory = tempfile.mkdtemp(prefix="mozartify-tests-")
+os.environ.setdefault("MOZARTIFY_CACHE_PATH", os.path.join(_state_directory, "predictions.sqlite3"))
+os.environ.setdefault("MOZARTIFY_JOB_DB_PATH", os.path.join(_state_directory, "jobs.sqlite3"))
+os.environ.setdefault("MOZARTIFY_FEATURE_STORE_DIR", os.path.join(_state_directory, "features"))
+os.environ.setdefault("MOZARTIFY_EMBEDDING_INDEX_DIR", os.path.join(_state_directory, "embeddings"))
@@ -0,0 +1,179 @@
+import time
+import asyncio
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from admission import (
+    AdmissionController, AdmissionMiddleware, AdmissionRejected, RequestCancelled, Ticket, checkpoint, _ticket,
+)
+
+
+async def started(task) -> bool:
+    # Give a waiting acquire() the chance to run up to its grant
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    return task.done()
+
+
+def test_interactive_lane_keeps_a_slot_while_bulk_work_holds_them_all():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, bulk_concurrency=1)
+        await controller.acquire("bulk")
+        # An upload still starts although the only slot is taken by a backfill
+        await asyncio.wait_for(controller.acquire("interactive"), 0.1)
+        assert controller.active == {"interactive": 1, "bulk": 1}
+
+        bulk = asyncio.create_task(controller.acquire("bulk"))
+        interactive = asyncio.create_task(controller.acquire("interactive"))
+        assert not await started(bulk) and not await started(interactive)
+
+        # A freed interactive slot goes to the waiting upload, never to the backfill
+        controller.release("interactive")
+        assert await started(interactive) and not bulk.done()
+        controller.release("bulk")
+        assert not await started(bulk)
+        controller.release("interactive")
+        assert await started(bulk)
+        assert controller.active == {"interactive": 0, "bulk": 1}
+
+    asyncio.run(scenario())
+
+
+def test_waiting_interactive_requests_are_granted_before_bulk_ones():
+    async def scenario():
+        controller = AdmissionController(concurrency=2, bulk_concurrency=2)
+        await controller.acquire("interactive")
+        await controller.acquire("interactive")
+        bulk = asyncio.create_task(controller.acquire("bulk"))
+        assert not await started(bulk)
+        interactive = asyncio.create_task(controller.acquire("interactive"))
+        assert not await started(interactive)
+
+        controller.release("interactive")
+        assert await started(interactive) and not bulk.done()
+        controller.release("interactive")
+        assert await started(bulk)
+
+    asyncio.run(scenario())
+
+
+def test_bulk_lane_never_takes_more_than_its_share():
+    async def scenario():
+        controller = AdmissionController(concurrency=2, bulk_concurrency=1)
+        await controller.acquire("bulk")
+        second = asyncio.create_task(controller.acquire("bulk"))
+        assert not await started(second)
+        # The slot bulk work may not take is still there for an upload
+        await asyncio.wait_for(controller.acquire("interactive"), 0.1)
+        controller.release("bulk")
+        assert await started(second)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, bulk_concurrency=1, queue_limit=1)
+        await controller.acquire("interactive")
+        waiting = asyncio.create_task(controller.acquire("interactive"))
+        await started(waiting)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("interactive")
+        assert rejected.value.status_code == 429
+        # Without reject, e.g. for job workers, the request queues instead
+        extra = asyncio.create_task(controller.acquire("interactive", reject=False))
+        assert not await started(extra)
+        assert controller.queued("interactive") == 2
+        for task in (waiting, extra):
+            task.cancel()
+        await asyncio.gather(waiting, extra, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_request_that_cannot_meet_its_deadline_is_rejected_up_front():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, bulk_concurrency=1)
+        controller.service_seconds = 10.0
+        await controller.acquire("interactive")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("interactive", deadline=time.monotonic() + 5)
+        assert rejected.value.status_code == 503
+        assert rejected.value.retry_after == pytest.approx(10.0)
+        assert controller.queued("interactive") == 0
+
+    asyncio.run(scenario())
+
+
+def test_deadline_passing_in_the_queue_gives_503_and_leaves_the_queue():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, bulk_concurrency=1)
+        await controller.acquire("interactive")
+        with pytest.raises(AdmissionRejected, match="Deadline passed while queued") as rejected:
+            await controller.acquire("interactive", deadline=time.monotonic() + 0.05)
+        assert rejected.value.status_code == 503
+        assert controller.queued("interactive") == 0
+
+        # Nothing was leaked: the next request gets the slot once it is released
+        controller.release("interactive")
+        await asyncio.wait_for(controller.acquire("interactive"), 0.1)
+        assert controller.active["interactive"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_hold_a_slot():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, bulk_concurrency=1)
+        await controller.acquire("bulk")
+        waiting = asyncio.create_task(controller.acquire("bulk"))
+        await started(waiting)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert controller.queued("bulk") == 0
+        controller.release("bulk")
+        assert controller.active == {"interactive": 0, "bulk": 0}
+
+    asyncio.run(scenario())
+
+
+def test_slot_records_the_service_time():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, bulk_concurrency=1)
+        assert controller.estimated_wait("interactive") is None
+        async with controller.slot("interactive"):
+            await asyncio.sleep(0.02)
+        assert controller.active["interactive"] == 0
+        assert controller.service_seconds >= 0.02
+        assert controller.estimated_wait("interactive") == pytest.approx(controller.service_seconds)
+
+    asyncio.run(scenario())
+
+
+def test_checkpoint_stops_work_past_the_deadline():
+    checkpoint()  # no ticket outside an admitted request
+    token = _ticket.set(Ticket("interactive", time.monotonic() - 1))
+    try:
+        with pytest.raises(RequestCancelled) as cancelled:
+            checkpoint()
+        assert cancelled.value.reason == "deadline"
+    finally:
+        _ticket.reset(token)
+
+
+def test_middleware_answers_504_when_the_deadline_passes_mid_request():
+    app = FastAPI()
+    controller = AdmissionController(concurrency=1, bulk_concurrency=1)
+    app.add_middleware(AdmissionMiddleware, paths=["/work"], controller=controller)
+
+    @app.post("/work")
+    async def work():
+        await asyncio.sleep(0.2)
+        checkpoint()
+        return {"done": True}
+
+    with TestClient(app) as client:
+        assert client.post("/work").json() == {"done": True}
+        response = client.post("/work", headers={"X-Mozartify-Deadline": "0.05"})
+        assert response.status_code == 504
+    assert controller.active == {"interactive": 0, "bulk": 0}
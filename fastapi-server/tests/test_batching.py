@@ -0,0 +1,119 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from batching import BatchingPredictor
+
+
+class FakeModel:
+    """Doubles its input, or returns whatever output() gives; records each batch's row count."""
+
+    def __init__(self, output=None, fail=None):
+        self.output = output
+        self.fail = fail
+        self.batches = []
+
+    def predict(self, x, verbose=0):
+        rows = len(x[0]) if isinstance(x, list) else len(x)
+        self.batches.append(rows)
+        if self.fail is not None:
+            raise self.fail
+        if self.output is not None:
+            return self.output(x)
+        if isinstance(x, list):
+            return [a * 2 for a in x]
+        return x * 2
+
+
+def predict_concurrently(predictor, inputs):
+    # Hold every caller at a barrier so their calls land in the same batching window
+    barrier = threading.Barrier(len(inputs))
+
+    def call(x):
+        barrier.wait()
+        try:
+            return predictor.predict(x)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(len(inputs)) as pool:
+        return list(pool.map(call, inputs))
+
+
+def test_concurrent_calls_share_a_batch_and_get_their_own_rows():
+    model = FakeModel()
+    predictor = BatchingPredictor(model, max_latency_ms=200, name="test")
+    inputs = [np.full((rows, 3), i, dtype=np.float32) for i, rows in enumerate([1, 2, 3, 4])]
+    results = predict_concurrently(predictor, inputs)
+    for x, y in zip(inputs, results):
+        np.testing.assert_array_equal(y, x * 2)
+    assert sum(model.batches) == 10
+    assert len(model.batches) < 4
+    assert predictor.stats()["rows"] == 10
+
+
+def test_batch_flushes_at_max_batch_size():
+    model = FakeModel()
+    predictor = BatchingPredictor(model, max_batch_size=2, max_latency_ms=200, name="test")
+    predict_concurrently(predictor, [np.ones((2, 3), dtype=np.float32)] * 3)
+    assert model.batches == [2, 2, 2]
+
+
+def test_multi_input_models_take_and_return_lists():
+    predictor = BatchingPredictor(FakeModel(), max_latency_ms=200, name="test")
+    inputs = [[np.full((2, 3), i, dtype=np.float32), np.full((2, 5), -i, dtype=np.float32)] for i in range(3)]
+    for x, y in zip(inputs, predict_concurrently(predictor, inputs)):
+        assert isinstance(y, list)
+        np.testing.assert_array_equal(y[0], x[0] * 2)
+        np.testing.assert_array_equal(y[1], x[1] * 2)
+
+
+def test_inputs_of_different_shapes_run_as_separate_batches():
+    model = FakeModel()
+    predictor = BatchingPredictor(model, max_latency_ms=200, name="test")
+    inputs = [np.ones((1, 3), dtype=np.float32), np.ones((1, 4), dtype=np.float32)]
+    for x, y in zip(inputs, predict_concurrently(predictor, inputs)):
+        np.testing.assert_array_equal(y, x * 2)
+    assert model.batches == [1, 1]
+
+
+def test_model_error_reaches_every_caller_in_the_batch():
+    model = FakeModel(fail=ValueError("bad batch"))
+    predictor = BatchingPredictor(model, max_latency_ms=200, name="test")
+    results = predict_concurrently(predictor, [np.ones((1, 3), dtype=np.float32)] * 3)
+    assert all(isinstance(result, ValueError) for result in results)
+
+    model.fail = None
+    np.testing.assert_array_equal(predictor.predict(np.ones((1, 3), dtype=np.float32)), np.full((1, 3), 2))
+
+
+def test_unbatchable_input_fails_only_its_caller():
+    predictor = BatchingPredictor(FakeModel(), max_latency_ms=200, name="test")
+    good = np.ones((2, 3), dtype=np.float32)
+    bad, ok = predict_concurrently(predictor, [object(), good])
+    assert isinstance(bad, TypeError)
+    np.testing.assert_array_equal(ok, good * 2)
+    with pytest.raises(TypeError):
+        predictor.predict(None)
+    np.testing.assert_array_equal(predictor.predict(good), good * 2)
+
+
+def test_error_splitting_the_output_is_raised_and_the_worker_survives():
+    model = FakeModel(output=lambda x: 42)
+    predictor = BatchingPredictor(model, name="test")
+    with pytest.raises(TypeError):
+        predictor.predict(np.ones((1, 3), dtype=np.float32))
+
+    model.output = None
+    np.testing.assert_array_equal(predictor.predict(np.ones((1, 3), dtype=np.float32)), np.full((1, 3), 2))
+
+
+def test_predict_raises_once_the_worker_is_gone():
+    class StoppedPredictor(BatchingPredictor):
+        def _run(self):
+            return
+
+    predictor = StoppedPredictor(FakeModel(), name="test")
+    predictor._worker.join()
+    with pytest.raises(RuntimeError, match="has stopped"):
+        predictor.predict(np.ones((1, 3), dtype=np.float32))
@@ -0,0 +1,41 @@
+import io
+import numpy as np
+import pytest
+import soundfile as sf
+from audio_loader import decode_audio
+from benchmarks import fixtures
+from budget import AnalysisBudget, CombinedBudget
+
+sr = 22050
+
+
+@pytest.fixture(scope="module")
+def wav_bytes():
+    buffer = io.BytesIO()
+    sf.write(buffer, fixtures.synthesize("mixed", 90, sr=sr), sr, format="WAV")
+    return buffer.getvalue()
+
+
+def test_budget_samples_spread_segments():
+    assert AnalysisBudget(60, 30).plan(50) is None
+    assert AnalysisBudget(None).plan(1000) is None
+    assert AnalysisBudget(60, 30).plan(120) == [(15.0, 30), (75.0, 30)]
+    assert AnalysisBudget(60, 30).with_max_seconds(0).max_seconds is None
+
+
+def test_combined_plan_is_the_padded_union_of_the_regions():
+    combined = CombinedBudget([AnalysisBudget(60, 30), AnalysisBudget(20, 20)])
+    assert combined.max_seconds == 80
+    assert combined.plan(120) == [(14.0, 32.0), (49.0, 22.0), (74.0, 32.0)]
+    # One tagger reading whole tracks means the whole track is decoded
+    assert CombinedBudget([AnalysisBudget(60, 30), AnalysisBudget(None)]).plan(120) is None
+    assert CombinedBudget([AnalysisBudget(60, 30), AnalysisBudget(None)]).max_seconds is None
+
+
+def test_each_tagger_reads_the_same_samples_as_from_a_full_decode(wav_bytes):
+    budgets = [AnalysisBudget(30, 10), AnalysisBudget(24, 12), AnalysisBudget(20, 20)]
+    full = decode_audio(wav_bytes)
+    partial = decode_audio(wav_bytes, CombinedBudget(budgets))
+    assert partial.duration == pytest.approx(full.duration)
+    for budget in budgets:
+        np.testing.assert_array_equal(budget.apply(partial).mono, budget.apply(full).mono)
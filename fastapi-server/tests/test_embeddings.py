@@ -0,0 +1,163 @@
+import time
+import threading
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import embeddings
+from embeddings import Backfill, EmbeddingIndex, cached_prediction, l2_normalize, pool_embeddings, similarity_router
+from prediction_cache import PredictionCache
+
+
+def random_vectors(rows: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((rows, dim)).astype(np.float32)
+
+
+@pytest.fixture
+def index(tmp_path):
+    # Small blocks so a search spans several of them
+    return EmbeddingIndex(str(tmp_path / "index"), block_rows=64)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_exact_search_matches_brute_force(index):
+    vectors = random_vectors(300)
+    for i, vector in enumerate(vectors):
+        index.add(f"track-{i}", vector)
+    query = random_vectors(1, seed=1)[0]
+
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = unit @ l2_normalize(query)
+    expected = np.argsort(-scores)[:10]
+    found = index.search(query, k=10)
+    assert [row for row, _ in found] == list(expected)
+    np.testing.assert_allclose([score for _, score in found], scores[expected], rtol=1e-5)
+
+    result = index.similar(track_id="track-7", k=5)
+    assert result["track_id"] == "track-7" and result["catalog_size"] == 300
+    assert "track-7" not in [match["track_id"] for match in result["similar"]]
+    assert [match["track_id"] for match in result["similar"]] == [
+        f"track-{row}" for row, _ in index.search(vectors[7], k=6) if row != 7
+    ][:5]
+
+
+def test_approximate_search_finds_near_duplicates(index):
+    vectors = random_vectors(500)
+    for i, vector in enumerate(vectors):
+        index.add(f"track-{i}", vector)
+    index.add("copy-of-42", vectors[42] + 0.01 * random_vectors(1, seed=2)[0])
+
+    result = index.similar(track_id="track-42", k=3, approximate=True, min_similarity=0.98)
+    assert result["mode"] == "approximate"
+    assert [match["track_id"] for match in result["similar"]] == ["copy-of-42"]
+
+
+def test_rows_are_replaced_linked_and_shared_between_instances(tmp_path, index):
+    index.add("a", np.ones(4), url="http://a/1")
+    index.add("b", -np.ones(4))
+    index.add("a", np.array([1.0, 0, 0, 0]))
+    index.link("b", "http://b/1")
+    assert len(index) == 2
+
+    # Another process opening the same directory sees the same rows
+    other = EmbeddingIndex(index.directory)
+    assert len(other) == 2
+    assert other.lookup(url="http://a/1") == other.lookup(track_id="a") == 0
+    assert other.lookup(url="http://b/1") == 1
+    np.testing.assert_allclose(other._vectors[0], [1, 0, 0, 0])
+    with pytest.raises(ValueError):
+        other.add("c", np.ones(5))
+    with pytest.raises(KeyError):
+        other.similar(track_id="missing")
+
+
+def test_pool_embeddings_is_the_unit_mean():
+    np.testing.assert_allclose(pool_embeddings(np.array([[3.0, 0], [1.0, 0]])), [1, 0])
+    assert pool_embeddings(None) is None
+    assert pool_embeddings(np.empty((0, 4))) is None
+
+
+def test_backfill_is_claimed_once_per_track(index):
+    assert index.claim_backfill("a")
+    assert not index.claim_backfill("a")
+    index.release_backfill("a")
+    assert index.claim_backfill("a")
+    index.add("a", np.ones(4))
+    assert not index.claim_backfill("a")
+
+
+def test_cached_prediction_indexes_new_tracks_and_backfills_cached_ones(index, monkeypatch):
+    monkeypatch.setattr(embeddings, "backfill", Backfill())
+    cache = PredictionCache(":memory:")
+    calls = []
+
+    def compute():
+        calls.append(threading.current_thread().name)
+        return "Rock", np.ones(4)
+
+    assert cached_prediction(cache, "key", compute, index, "track", "http://track/1") == "Rock"
+    assert "track" in index and len(calls) == 1
+
+    # A prediction cached before the track could be indexed is served at once and indexed in the background
+    cache.put("other-key", "Jazz")
+    assert cached_prediction(cache, "other-key", compute, index, "other", "http://other/1") == "Jazz"
+    wait_until(lambda: "other" in index)
+    assert calls[1] == "embedding-backfill"
+    assert index.lookup(url="http://other/1") == index.lookup(track_id="other")
+
+    # Once indexed, a cache hit computes nothing
+    assert cached_prediction(cache, "other-key", compute, index, "other", "http://other/2") == "Jazz"
+    assert len(calls) == 2
+    assert index.lookup(url="http://other/2") == index.lookup(track_id="other")
+
+
+def test_full_backfill_queue_releases_the_claim(index):
+    backfill = Backfill(max_pending=1)
+    release = threading.Event()
+
+    def compute():
+        release.wait()
+        return "Rock", np.ones(4)
+
+    for track_id in ("a", "b", "c"):
+        assert index.claim_backfill(track_id)
+    assert backfill.submit(index, "a", compute)
+    wait_until(lambda: backfill.pending() == 0)  # the worker is busy with a
+    assert backfill.submit(index, "b", compute)
+    assert not backfill.submit(index, "c", compute)
+    # c is picked up again on its next request
+    assert index.claim_backfill("c")
+
+    release.set()
+    wait_until(lambda: "a" in index and "b" in index)
+
+
+def test_similar_route(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings, "index_dir", str(tmp_path / "indexes"))
+    handle = SimpleNamespace(model=SimpleNamespace(outputs=[None, None]), fingerprint=lambda version: f"fake:{version}")
+    app = FastAPI()
+    app.include_router(similarity_router("fake", handle, "1"))
+    index = embeddings.index_for("fake", handle, "1")
+    vectors = random_vectors(3, dim=8)
+    for i, vector in enumerate(vectors):
+        index.add(f"track-{i}", vector, url=f"http://track/{i}")
+
+    with TestClient(app) as client:
+        assert client.post("/similar", json={}).status_code == 400
+        assert client.post("/similar", json={"trackId": "track-0", "k": 0}).status_code == 400
+        assert client.post("/similar", json={"trackId": "missing"}).status_code == 404
+        response = client.post("/similar", json={"fileUrl": "http://track/0", "k": 5})
+        assert response.status_code == 200
+        assert response.json()["track_id"] == "track-0"
+        assert {match["track_id"] for match in response.json()["similar"]} == {"track-1", "track-2"}
+
+        # A model without an embedding output has no index to search
+        handle.model = SimpleNamespace(outputs=[None])
+        assert client.post("/similar", json={"trackId": "track-0"}).status_code == 503
@@ -0,0 +1,110 @@
+import os
+import json
+import argparse
+import numpy as np
+import pytest
+import export_models
+from inference_runtime import exported_path, parity_report_path, serving_loader, serving_path
+
+
+def test_parity_compares_top_classes():
+    reference = np.array([[0.7, 0.2, 0.1], [0.1, 0.3, 0.6]])
+    candidate = np.array([[0.6, 0.3, 0.1], [0.3, 0.6, 0.1]])
+    report = export_models.parity(reference, candidate, top_k=2)
+    assert report["samples"] == 2
+    assert report["top1_agreement"] == 0.5
+    assert report["topk_overlap"] == 0.75
+    assert report["max_abs_diff"] == pytest.approx(0.5)
+    assert export_models.parity(reference, reference, top_k=5)["top_k"] == 3
+
+
+@pytest.fixture(scope="module")
+def keras_model(tmp_path_factory):
+    tf = pytest.importorskip("tensorflow")
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((16, 16, 1)),
+        tf.keras.layers.Conv2D(4, 3, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(5, activation="softmax"),
+    ])
+    path = str(tmp_path_factory.mktemp("model") / "Trained_model.h5")
+    model.save(path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def features():
+    return np.random.default_rng(0).standard_normal((24, 16, 16, 1)).astype(np.float32)
+
+
+def export_args(runtime: str, quantization: str, min_top1: float = 0.97, min_topk: float = 0.95):
+    return argparse.Namespace(runtime=runtime, quantization=quantization, min_top1=min_top1, min_topk=min_topk)
+
+
+def check_export(keras_path, features, runtime, quantization, monkeypatch):
+    result = export_models.export_and_check(
+        keras_path, features, export_args(runtime, quantization), top_k=3, fixtures="test features"
+    )
+    path = exported_path(keras_path, runtime, quantization)
+    assert result["path"] == path and os.path.exists(path)
+    with open(parity_report_path(path)) as f:
+        report = json.load(f)
+    assert report["passed"] == result["passed"]
+    assert report["samples"] == (len(features) // 2 if quantization == "int8" else len(features))
+
+    monkeypatch.setenv("MOZARTIFY_TEST_RUNTIME", runtime)
+    monkeypatch.setenv("MOZARTIFY_TEST_QUANTIZATION", quantization)
+    assert serving_path(keras_path, "test") == (path if report["passed"] else keras_path)
+    model = serving_loader(None)(path)
+    assert model.predict(features[:3]).shape == (3, 5)
+    return report
+
+
+def test_tflite_export_matches_keras_and_is_served(keras_model, features, monkeypatch):
+    report = check_export(keras_model, features, "tflite", "none", monkeypatch)
+    assert report["passed"]
+    assert report["top1_agreement"] == 1.0
+    assert report["max_abs_diff"] < 1e-5
+
+
+def test_int8_export_is_calibrated_and_checked_on_separate_halves(keras_model, features, monkeypatch):
+    check_export(keras_model, features, "tflite", "int8", monkeypatch)
+
+
+def test_export_is_not_served_without_a_passing_current_report(keras_model, features, tmp_path, monkeypatch):
+    monkeypatch.setenv("MOZARTIFY_TEST_RUNTIME", "tflite")
+    monkeypatch.setenv("MOZARTIFY_TEST_QUANTIZATION", "float16")
+    keras_path = str(tmp_path / "Trained_model.h5")
+    with open(keras_model, "rb") as src, open(keras_path, "wb") as dst:
+        dst.write(src.read())
+    # No export yet
+    assert serving_path(keras_path, "test") == keras_path
+
+    export_models.export_and_check(keras_path, features, export_args("tflite", "float16"), 3, "test features")
+    path = exported_path(keras_path, "tflite", "float16")
+    assert serving_path(keras_path, "test") == path
+
+    report_path = parity_report_path(path)
+    with open(report_path) as f:
+        report = json.load(f)
+    with open(report_path, "w") as f:
+        json.dump({**report, "passed": False}, f)
+    assert serving_path(keras_path, "test") == keras_path
+
+    with open(report_path, "w") as f:
+        json.dump(report, f)
+    # A retrained .h5 makes the report stale
+    with open(keras_path, "ab") as f:
+        f.write(b"\0")
+    assert serving_path(keras_path, "test") == keras_path
+
+
+@pytest.mark.parametrize("quantization", ["none", "dynamic"])
+def test_onnx_export_matches_keras_and_is_served(keras_model, features, quantization, monkeypatch):
+    pytest.importorskip("tf2onnx")
+    pytest.importorskip("onnxruntime")
+    report = check_export(keras_model, features, "onnx", quantization, monkeypatch)
+    if quantization == "none":
+        assert report["passed"]
+        assert report["max_abs_diff"] < 1e-4
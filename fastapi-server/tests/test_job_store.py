@@ -0,0 +1,138 @@
+import os
+import asyncio
+import pytest
+from fastapi import HTTPException
+import job_store as job_store_module
+from job_store import JobStore
+from jobs import JobRunner
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return os.path.join(tmp_path, "jobs.sqlite3")
+
+
+def test_items_are_claimed_in_order_and_finished_in_completion_order(db_path):
+    store = JobStore(db_path)
+    job_id = store.create_job(["a", "b", "c"], {"taggers": ["genre"]})
+    claimed = [store.claim_next() for _ in range(3)]
+    assert [item["file_url"] for item in claimed] == ["a", "b", "c"]
+    assert claimed[0]["options"] == {"taggers": ["genre"]}
+    assert store.claim_next() is None
+
+    store.finish_item(job_id, 2, result={"genre": "Rock"})
+    store.finish_item(job_id, 0, error="Download failed")
+    assert store.get_job(job_id)["status"] == "running"
+    finished = store.finished_items(job_id)
+    assert [(item["index"], item["status"], item["completed_order"]) for item in finished] == [
+        (2, "done", 1), (0, "failed", 2),
+    ]
+    assert finished[0]["result"] == {"genre": "Rock"}
+    assert [item["index"] for item in store.finished_items(job_id, after=1)] == [0]
+
+    store.finish_item(job_id, 1, result={})
+    job = store.get_job(job_id)
+    assert (job["status"], job["done"], job["failed"], job["total"]) == ("completed", 2, 1, 3)
+
+
+def test_restart_requeues_running_items_and_keeps_finished_ones(db_path):
+    store = JobStore(db_path)
+    job_id = store.create_job(["a", "b", "c"], {})
+    store.claim_next()
+    store.claim_next()
+    store.finish_item(job_id, 0, result={"ok": True})
+
+    # A new process opens the same database with item 1 still marked running
+    restarted = JobStore(db_path)
+    assert restarted.requeue_interrupted() == 1
+    job = restarted.get_job(job_id)
+    assert (job["done"], job["running"], job["pending"]) == (1, 0, 2)
+    assert [restarted.claim_next()["idx"] for _ in range(2)] == [1, 2]
+    assert restarted.finished_items(job_id)[0]["result"] == {"ok": True}
+
+
+def test_item_interrupted_too_often_is_failed(db_path, monkeypatch):
+    monkeypatch.setattr(job_store_module, "max_attempts", 2)
+    store = JobStore(db_path)
+    job_id = store.create_job(["a"], {})
+    store.claim_next()
+    assert store.requeue_interrupted() == 1
+    store.claim_next()
+    assert store.requeue_interrupted() == 0
+    [item] = store.finished_items(job_id)
+    assert (item["status"], item["error"]) == ("failed", "Interrupted too many times")
+    assert store.get_job(job_id)["status"] == "completed"
+
+
+async def wait_for_job(store, job_id, timeout=5.0):
+    async def completed():
+        while store.get_job(job_id)["status"] != "completed":
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(completed(), timeout)
+
+
+def test_runner_drains_a_job_and_records_failures(db_path):
+    async def process_item(file_url, options):
+        if file_url == "missing":
+            raise HTTPException(status_code=404, detail="Not found")
+        if file_url == "broken":
+            raise ValueError("decode failed")
+        return {"url": file_url, **options}
+
+    async def scenario():
+        store = JobStore(db_path)
+        runner = JobRunner(store, process_item, concurrency=2)
+        await runner.start()
+        job_id = store.create_job(["a", "missing", "broken", "b"], {"k": 1})
+        runner.notify()
+        try:
+            await wait_for_job(store, job_id)
+        finally:
+            await runner.stop()
+        return {item["fileUrl"]: item for item in store.finished_items(job_id)}
+
+    items = asyncio.run(scenario())
+    assert items["a"]["result"] == {"url": "a", "k": 1}
+    assert items["missing"]["error"] == "Not found"
+    assert items["broken"]["error"] == "decode failed"
+    assert items["b"]["status"] == "done"
+
+
+def test_item_interrupted_by_a_stop_is_resumed_on_the_next_start(db_path):
+    release = None
+
+    async def hang(file_url, options):
+        await release.wait()
+        return {"url": file_url}
+
+    async def first_run():
+        nonlocal release
+        release = asyncio.Event()
+        store = JobStore(db_path)
+        runner = JobRunner(store, hang, concurrency=1)
+        await runner.start()
+        job_id = store.create_job(["a"], {})
+        runner.notify()
+        while store.get_job(job_id)["running"] == 0:
+            await asyncio.sleep(0.01)
+        await runner.stop()
+        return job_id
+
+    async def second_run(job_id):
+        nonlocal release
+        release = asyncio.Event()
+        release.set()
+        store = JobStore(db_path)
+        runner = JobRunner(store, hang, concurrency=1)
+        await runner.start()
+        try:
+            await wait_for_job(store, job_id)
+        finally:
+            await runner.stop()
+        return store.finished_items(job_id)
+
+    job_id = asyncio.run(first_run())
+    assert JobStore(db_path).get_job(job_id)["running"] == 1
+    [item] = asyncio.run(second_run(job_id))
+    assert (item["status"], item["result"]) == ("done", {"url": "a"})
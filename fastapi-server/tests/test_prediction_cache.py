@@ -0,0 +1,80 @@
+import os
+import itertools
+from types import SimpleNamespace
+import pytest
+import prediction_cache as prediction_cache_module
+from prediction_cache import PredictionCache, model_fingerprint
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # Every write and read gets a later last_used, so eviction order does not depend on timer resolution
+    ticks = itertools.count(1)
+    monkeypatch.setattr(prediction_cache_module, "time", SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = PredictionCache(":memory:", max_entries=3)
+    for key in "abc":
+        cache.put(key, key.upper())
+    assert cache.get("a") == "A"  # a is now more recent than b and c
+
+    cache.put("d", "D")
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.stats()["entries"] == 3
+
+    cache.put("e", "E")
+    cache.put("f", "F")
+    assert [key for key in "acdef" if cache.get(key) is not None] == ["d", "e", "f"]
+
+
+def test_replacing_an_entry_does_not_evict_others():
+    cache = PredictionCache(":memory:", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 3)
+    assert (cache.get("a"), cache.get("b")) == (3, 2)
+
+
+def test_get_or_compute_computes_once_and_counts_hits():
+    cache = PredictionCache(":memory:")
+    calls = []
+
+    def compute():
+        calls.append(True)
+        return ["Rock", [["Rock", 0.5]]]
+
+    assert cache.get_or_compute("key", compute) == ["Rock", [["Rock", 0.5]]]
+    assert cache.get_or_compute("key", compute) == ["Rock", [["Rock", 0.5]]]
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"], stats["entries"]) == (1, 1, 0.5, 1)
+
+    cache.clear()
+    assert cache.get("key") is None
+
+
+def test_entries_survive_reopening_the_file(tmp_path):
+    path = os.path.join(tmp_path, "cache", "predictions.sqlite3")
+    PredictionCache(path).put("key", {"gender": "Female"})
+    assert PredictionCache(path).get("key") == {"gender": "Female"}
+
+
+def test_keys_depend_on_every_part_but_not_on_parameter_order():
+    key = PredictionCache.make_key("gender", "hash", "model:v1", chunk_duration=30, overlap_duration=2)
+    assert key == PredictionCache.make_key("gender", "hash", "model:v1", overlap_duration=2, chunk_duration=30)
+    assert key != PredictionCache.make_key("gender", "hash", "model:v2", chunk_duration=30, overlap_duration=2)
+    assert key != PredictionCache.make_key("gender", "other", "model:v1", chunk_duration=30, overlap_duration=2)
+    assert key != PredictionCache.make_key("gender", "hash", "model:v1", chunk_duration=20, overlap_duration=2)
+
+
+def test_model_fingerprint_changes_with_the_model_file(tmp_path):
+    path = os.path.join(tmp_path, "model.h5")
+    with open(path, "wb") as f:
+        f.write(b"weights")
+    before = model_fingerprint(path)
+    assert model_fingerprint(path, "2") != before
+    with open(path, "ab") as f:
+        f.write(b" retrained")
+    assert model_fingerprint(path) != before
@@ -0,0 +1,139 @@
+import numpy as np
+import librosa
+import pytest
+from benchmarks import fixtures
+from spectral import Spectrogram, chunk_bounds, chunk_mel_spectrograms, stream_chunks
+
+sr = 22050
+
+
+def signal(seconds: float, kind: str = "mixed") -> np.ndarray:
+    return fixtures.synthesize(kind, seconds, sr=sr).mean(axis=1)
+
+
+# The chunking and features as the services computed them before spectral.py, one chunk at a time
+
+def old_genre_features(audio_data, sample_rate, target_shape=(128, 128)):
+    data = []
+    audio_data = librosa.util.normalize(audio_data)
+    chunk_samples = 4 * sample_rate
+    overlap_samples = 2 * sample_rate
+    num_chunks = int(np.ceil((len(audio_data) - chunk_samples) / (chunk_samples - overlap_samples))) + 1
+    for i in range(num_chunks):
+        start = i * (chunk_samples - overlap_samples)
+        end = start + chunk_samples
+        if end > len(audio_data):
+            end = len(audio_data)
+            start = end - chunk_samples
+        chunk = audio_data[start:end]
+        mel_spectrogram = librosa.feature.melspectrogram(
+            y=chunk, sr=sample_rate, n_mels=128, fmax=8000, n_fft=2048, hop_length=512
+        )
+        mel_spectrogram = librosa.power_to_db(mel_spectrogram, ref=np.max)
+        mel_spectrogram = (mel_spectrogram - mel_spectrogram.mean()) / (mel_spectrogram.std() + 1e-6)
+        data.append(np.resize(mel_spectrogram, target_shape))
+    return np.array(data)[..., np.newaxis]
+
+
+def old_gender_features(y, sr, chunk_duration=30, overlap_duration=2):
+    means = []
+    step_size = chunk_duration - overlap_duration
+    for start in range(0, len(y), step_size * sr):
+        chunk = y[start:start + chunk_duration * sr]
+        if len(chunk) == 0:
+            continue
+        mfccs = librosa.feature.mfcc(y=chunk, sr=sr, n_mfcc=128)
+        means.append(np.mean(mfccs.T, axis=0))
+    return np.array(means)
+
+
+def old_emotion_features(y, sr):
+    stft_db = librosa.amplitude_to_db(abs(librosa.stft(y)))
+    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20)
+    mel = librosa.amplitude_to_db(librosa.feature.melspectrogram(y=y, sr=sr), ref=np.max)
+    return stft_db, mfccs, mel
+
+
+def old_chunks(num_samples, chunk_samples, step_samples):
+    num_chunks = int(np.ceil((num_samples - chunk_samples) / step_samples)) + 1
+    for i in range(num_chunks):
+        start = i * step_samples
+        end = start + chunk_samples
+        if end > num_samples:
+            end = num_samples
+            start = end - chunk_samples
+        yield start, end
+
+
+@pytest.mark.parametrize("seconds", [1, 4, 5, 10, 10.5])
+def test_chunk_bounds_select_the_old_chunks(seconds):
+    y = signal(seconds)
+    bounds = chunk_bounds(len(y), 4 * sr, 2 * sr)
+    old = list(old_chunks(len(y), 4 * sr, 2 * sr))
+    assert len(bounds) == len(old)
+    for (start, end), (old_start, old_end) in zip(bounds, old):
+        np.testing.assert_array_equal(y[start:end], y[old_start:old_end])
+
+
+def test_chunk_bounds_max_chunks():
+    assert chunk_bounds(20 * sr, 4 * sr, 2 * sr, max_chunks=5) == chunk_bounds(20 * sr, 4 * sr, 2 * sr)[:5]
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 16])
+def test_chunk_mel_spectrograms_match_one_call_per_chunk(block_size):
+    y = signal(13)
+    # Gender's bounds end in truncated chunks, which are batched apart from the full ones
+    bounds = [(start, min(start + 4 * sr, len(y))) for start in range(0, len(y), 2 * sr)]
+    mels = list(chunk_mel_spectrograms(y, sr, bounds, block_size=block_size, n_mels=64, fmax=8000))
+    assert len(mels) == len(bounds)
+    for mel, (start, end) in zip(mels, bounds):
+        expected = librosa.feature.melspectrogram(y=y[start:end], sr=sr, n_mels=64, fmax=8000)
+        np.testing.assert_array_equal(mel, expected)
+
+
+@pytest.mark.parametrize("seconds", [3, 10, 11.3])
+def test_genre_features_match_the_old_code(seconds):
+    import genre
+
+    y = signal(seconds)
+    np.testing.assert_array_equal(genre.load_and_preprocess_data(y, sr), old_genre_features(y, sr))
+
+
+def test_gender_features_match_the_old_code():
+    import gender
+
+    y = signal(65)
+    np.testing.assert_array_equal(gender.chunk_mfcc_means(y, sr, 30, 2), old_gender_features(y, sr))
+
+
+def test_emotion_features_match_the_old_code():
+    import emotion
+
+    y = signal(8, "tone")
+    for new, old in zip(emotion.feature2d(y, sr), old_emotion_features(y, sr)):
+        np.testing.assert_array_equal(new, old)
+
+
+def test_spectrogram_views_are_cached():
+    spec = Spectrogram(signal(2), sr)
+    assert spec.mel() is spec.mel()
+    assert spec.mel(n_mels=64).shape[0] == 64
+
+
+@pytest.mark.parametrize("block_seconds", [0.7, 3, 50])
+def test_stream_chunks_yield_the_whole_signal_chunks(block_seconds):
+    y = signal(23)
+    chunk_samples, step_samples = 4 * sr, 2 * sr
+    block = int(block_seconds * sr)
+    blocks = (y[start:start + block] for start in range(0, len(y), block))
+    streamed = [
+        y_block[start:end]
+        for y_block, bounds in stream_chunks(
+            blocks, chunk_samples, step_samples, lambda n: chunk_bounds(n, chunk_samples, step_samples)
+        )
+        for start, end in bounds
+    ]
+    expected = [y[start:end] for start, end in chunk_bounds(len(y), chunk_samples, step_samples)]
+    assert len(streamed) == len(expected)
+    for chunk, expected_chunk in zip(streamed, expected):
+        np.testing.assert_array_equal(chunk, expected_chunk)
@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import threading
+import contextvars
+import numpy as np
+import resources
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from telemetry import Gauge, run_profiled
+from admission import checkpoint
+
+# Decode, features and inference release the GIL in numpy, librosa and TensorFlow,
+# so a bounded thread pool lets one process overlap them with network I/O.
+max_workers = resources.worker_threads
+executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mozartify-worker")
+
+# Process pool for pure-Python-heavy DSP, created on first use and kept across requests
+max_process_workers = resources.process_workers
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# Thread-pool calls waiting for and holding a worker thread
+_task_counts = {"queued": 0, "running": 0}
+_task_counts_lock = threading.Lock()
+
+
+def _count_task(state: str, amount: int):
+    with _task_counts_lock:
+        _task_counts[state] += amount
+
+
+def _worker_tasks():
+    with _task_counts_lock:
+        return [({"state": state}, count) for state, count in _task_counts.items()]
+
+
+Gauge("mozartify_worker_tasks", "Thread-pool calls by state.", ("state",), collect=_worker_tasks)
+
+
+def _run_checked(call):
+    # Work still queued for a request that has gone away is skipped
+    checkpoint()
+    return run_profiled(call)
+
+
+async def run_blocking(func, *args, **kwargs):
+    # Run in a copy of the caller's context so stage timings reach the request's profile
+    context = contextvars.copy_context()
+    call = functools.partial(func, *args, **kwargs)
+
+    def run():
+        _count_task("queued", -1)
+        _count_task("running", 1)
+        try:
+            return context.run(_run_checked, call)
+        finally:
+            _count_task("running", -1)
+
+    _count_task("queued", 1)
+    future = executor.submit(run)
+    # A call cancelled before it started never reaches run()
+    future.add_done_callback(lambda f: f.cancelled() and _count_task("queued", -1))
+    return await asyncio.wrap_future(future)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=max_process_workers, initializer=resources.init_worker_process,
+            )
+        return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(cancel_futures=True)
+            _process_pool = None
+
+
+class SharedArray:
+    """Copies an array into shared memory once so pool workers can read it without pickling."""
+
+    def __init__(self, array: np.ndarray):
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=self._shm.buf)
+        view[...] = array
+        del view
+        # Picklable description handed to the workers
+        self.spec = (self._shm.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def attach_shared_array(spec):
+    """Worker side of SharedArray; returns (shm, array). Close shm once done with array."""
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
@@ -28,6 +28,7 @@ const fastApiEndpoints = {
   gender: `${FASTAPI_BASE_URL}:9000/predict-gender`,
   genre: `${FASTAPI_BASE_URL}:8001/predict-genre`,
   instrument: `${FASTAPI_BASE_URL}:8000/predict-instrument`,
+  analyze: `${FASTAPI_BASE_URL}:8002/analyze`,
 };
 
 // Configure file storage for uploads
@@ -194,6 +195,28 @@ router.post("/predictGenre", async (req, res) => {
   }
 });
 
+// All selected tags from a single download and decode of the file
+router.post("/analyzeAudio", async (req, res) => {
+  const { fileUrl, emotion, gender, genre, instrument } = req.body;
+  if (!fileUrl) {
+    return res.status(400).send("No file URL provided.");
+  }
+
+  try {
+    const response = await axios.post(fastApiEndpoints.analyze, {
+      fileUrl,
+      emotion,
+      gender,
+      genre,
+      instrument,
+    });
+    res.json(response.data);
+  } catch (error) {
+    console.error("Error analyzing audio:", error);
+    res.status(500).send("Error analyzing audio");
+  }
+});
+
 // // Endpoint for instrument prediction from URL
 // router.post('/predictInstrument', async (req, res) => {
 //   const { fileUrl } = req.body;
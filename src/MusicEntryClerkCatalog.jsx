@@ -432,40 +432,18 @@ export default function MusicEntryClerkCatalog() {
         mp3FileName: file.name,
       }));
 
-      // Call emotion prediction API
-      const emotionResponse = await axios.post(
-        "http://127.0.0.1:5173/predict-emotion",
+      // Emotion, gender and genre from one download and decode
+      const analyzeResponse = await axios.post(
+        `${API_BASE_URL}/analyzeAudio`,
         { fileUrl }
       );
 
-      // Update catalogData with the new emotion
+      // Update catalogData with the predicted tags
       setCatalogData((prevData) => ({
         ...prevData,
-        emotion: emotionResponse.data.predicted_mood,
-      }));
-
-      // Call gender prediction API
-      const genderResponse = await axios.post(
-        "http://127.0.0.1:9000/predict-gender",
-        { file_url: fileUrl }
-      );
-
-      // Update catalogData with the predicted gender
-      setCatalogData((prevData) => ({
-        ...prevData,
-        gender: genderResponse.data.gender,
-      }));
-
-      // Call genre prediction API
-      const genreResponse = await axios.post(
-        "http://127.0.0.1:8001/predict-genre",
-        { fileUrl }
-      );
-
-      // Update catalogData with the new genre
-      setCatalogData((prevData) => ({
-        ...prevData,
-        genre: genreResponse.data.genre,
+        emotion: analyzeResponse.data.predicted_mood,
+        gender: analyzeResponse.data.gender,
+        genre: analyzeResponse.data.genre,
       }));
 
       setDialogTitle("Prediction Complete");